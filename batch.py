@@ -0,0 +1,64 @@
+from datetime import datetime
+from pathlib import Path
+from parser import parse_batch_args
+from src.batch import runner
+from src.data import results
+
+# Runs calculate_one_half on every match of a directory (e.g. a whole season) using all the
+# cores of the machine:
+#   python batch.py data/processed -o 25 -iv
+#   python batch.py 'data/processed/*_10748*.csv' -o 25 -w 8 --manifest results/season.json
+
+
+def run_match(**kwargs):
+    import main
+    return main.calculate_one_half(**kwargs)
+
+
+def existing_result(name, kwargs):
+    """Returns the result of the match if it is already in results/"""
+    pickle_file = results.one_half_result_path(kwargs['filename'], kwargs['include_velocities'],
+                                               kwargs['home_stamine_factor'],
+                                               kwargs['away_stamine_factor'],
+                                               kwargs['positions_to_increase'],
+                                               kwargs['results_path'])
+    return pickle_file if pickle_file.exists() else None
+
+
+def create_tasks(matches, args, results_path=results.RESULTS_PATH):
+    """Returns the arguments of calculate_one_half for each match"""
+    tasks = {}
+    for match in matches:
+        tasks[match.stem] = {
+            'filename': match.stem,
+            'frames_step': args.one_half,
+            'include_velocities': args.include_velocities,
+            'home_stamine_factor': args.stamine_home,
+            'away_stamine_factor': args.stamine_away,
+            'positions_to_increase': args.position_increase or results.DEFAULT_POSITIONS,
+            'engine': args.engine,
+            'data_path': match.parent,
+            'results_path': results_path,
+            'metrics_path': args.metrics,
+            'progress': False
+        }
+    return tasks
+
+
+if __name__ == "__main__":
+    args = parse_batch_args()
+
+    matches = runner.find_matches(args.matches)
+    if not matches:
+        exit(f'No matches found in {args.matches}')
+    manifest_path = Path(args.manifest) if args.manifest else \
+        results.RESULTS_PATH / f'manifest_{datetime.now().strftime("%Y%m%d-%H%M%S")}.json'
+
+    print(f'Running {len(matches)} matches')
+    manifest = runner.run_batch(create_tasks(matches, args), run_match, workers=args.workers,
+                                retries=args.retries, manifest_path=manifest_path,
+                                is_done=None if args.force else existing_result,
+                                options=vars(args))
+    print(f'{runner.summary(manifest)}, manifest saved in {manifest_path}')
+    if any(entry['status'] == 'failed' for entry in manifest['tasks'].values()):
+        exit(1)
@@ -0,0 +1,222 @@
+"""
+Scaling benchmarks of the pitch control pipeline on synthetic matches.
+
+Synthetic matches with the schema of data/processed are generated with src.data.synthetic and
+the following cases are timed, each one in a fresh process so that the peak memory is its own:
+    prepare_df: reading and preparing a match of each length in --frame-counts
+    frame: generate_pitch_control_for_event for each grid size in --grid-sizes
+    one_half: calculate_one_half for each grid size and each frame step in --frame-steps
+
+The results are saved as JSON in benchmarks/results/ (one file per run) and can be compared
+with a previous run:
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --quick --compare benchmarks/results/<previous run>.json
+"""
+import argparse
+import json
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stderr, redirect_stdout
+from datetime import datetime
+from io import StringIO
+from multiprocessing import get_context
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+RESULTS_PATH = ROOT / 'benchmarks' / 'results'
+
+
+def peak_rss_mb():
+    """Peak resident memory of the current process in MB"""
+    # On Linux ru_maxrss survives exec, so a new process would report the peak of its parent.
+    # VmHWM belongs to the address space of the process
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def bench_prepare_df(csv_file):
+    import src.data.utils as utils
+
+    start_rss = peak_rss_mb()
+    start = time.perf_counter()
+    df, _, _ = utils.prepare_df(csv_file, Path(csv_file).stem, include_player_velocities=True)
+    elapsed = time.perf_counter() - start
+    return {'elapsed_s': elapsed, 'frames': len(df), 'start_rss_mb': start_rss}
+
+
+def bench_frame(csv_file, n_grid_cells_x, n_frames):
+    import src.data.utils as utils
+    from src.pitch_control.pitch_control import PitchControl
+
+    df, home_velocities, away_velocities = utils.prepare_df(csv_file, Path(csv_file).stem,
+                                                            include_player_velocities=True)
+    pitch_control = PitchControl(df, include_individual_velocities=True,
+                                 home_individual_velocities=home_velocities,
+                                 away_individual_velocities=away_velocities,
+                                 n_grid_cells_x=n_grid_cells_x)
+    frames = df['frame'].iloc[:n_frames]
+    start_rss = peak_rss_mb()
+    start = time.perf_counter()
+    for frame in frames:
+        pitch_control.generate_pitch_control_for_event(df.loc[df['frame'] == frame])
+    elapsed = time.perf_counter() - start
+    return {'elapsed_s': elapsed, 'frames': len(frames), 'start_rss_mb': start_rss}
+
+
+def bench_one_half(csv_file, n_grid_cells_x, frames_step):
+    import pandas as pd
+    import main
+    import src.data.utils as utils
+
+    csv_file = Path(csv_file)
+    ball_status = pd.read_csv(csv_file, usecols=['ball_status'])
+    n_frames = len(utils.select_every_n_rows(utils.only_live_ball(ball_status), frames_step))
+    start_rss = peak_rss_mb()
+    with tempfile.TemporaryDirectory() as results_path:
+        start = time.perf_counter()
+        main.calculate_one_half(csv_file.stem, frames_step, include_velocities=True,
+                                n_grid_cells_x=n_grid_cells_x, data_path=csv_file.parent,
+                                results_path=results_path)
+        elapsed = time.perf_counter() - start
+    return {'elapsed_s': elapsed, 'frames': n_frames, 'start_rss_mb': start_rss}
+
+
+def run_case(function, *args):
+    """Runs a benchmark in the current process hiding its output, and adds the peak memory"""
+    with redirect_stdout(StringIO()), redirect_stderr(StringIO()):
+        result = function(*args)
+    result['peak_rss_mb'] = peak_rss_mb()
+    result['frames_per_second'] = result['frames'] / result['elapsed_s'] \
+        if result['elapsed_s'] else None
+    return result
+
+
+def run_isolated(function, *args):
+    """Runs the benchmark in a new process, so that the peak memory only belongs to it"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(run_case, function, *args).result()
+
+
+def environment():
+    import numpy as np
+    import pandas as pd
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+    }
+
+
+def compare(results, previous_file):
+    """Prints the speed up of each case with respect to a previous run"""
+    with open(previous_file) as f:
+        previous = {case['name']: case for case in json.load(f)['cases']}
+    print(f'\nComparison with {previous_file}')
+    for case in results['cases']:
+        old = previous.get(case['name'])
+        if old is None or not old['frames_per_second'] or not case['frames_per_second']:
+            continue
+        speed_up = case['frames_per_second'] / old['frames_per_second']
+        memory = case['peak_rss_mb'] / old['peak_rss_mb']
+        print(f'{case["name"]:<32} speed x{speed_up:6.2f}   peak memory x{memory:5.2f}')
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frame-counts', type=int, nargs='+', default=[1500, 15000, 67500],
+                        help='Length (in frames) of the matches used to time prepare_df')
+    parser.add_argument('--grid-sizes', type=int, nargs='+', default=[25, 50, 75],
+                        help='Values of n_grid_cells_x')
+    parser.add_argument('--frame-steps', type=int, nargs='+', default=[25, 50],
+                        help='Frame steps used by calculate_one_half')
+    parser.add_argument('--match-frames', type=int, default=1500,
+                        help='Length (in frames) of the match used for pitch control')
+    parser.add_argument('--timed-frames', type=int, default=5,
+                        help='Frames timed in the single frame benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--quick', action='store_true',
+                        help='Small configuration to check that everything runs')
+    parser.add_argument('--compare', help='Previous result file to compare with')
+    parser.add_argument('--output', help='Output file (default benchmarks/results/<date>.json)')
+    args = parser.parse_args(args)
+    if args.quick:
+        args.frame_counts = [1500]
+        args.grid_sizes = [25]
+        args.frame_steps = [250]
+        args.match_frames = 750
+        args.timed_frames = 2
+    return args
+
+
+def main(args=sys.argv[1:]):
+    from src.data import synthetic
+
+    args = parse_args(args)
+    cases = []
+    with tempfile.TemporaryDirectory() as data_path:
+        data_path = Path(data_path)
+
+        def add_case(name, function, *case_args):
+            result = run_isolated(function, *case_args)
+            result['name'] = name
+            cases.append(result)
+            print(f'{name:<32} {result["elapsed_s"]:9.3f} s {result["frames_per_second"]:10.2f} '
+                  f'frames/s {result["peak_rss_mb"]:9.1f} MB')
+
+        for n_frames in args.frame_counts:
+            csv_file = data_path / f'synthetic_{n_frames}.csv'
+            synthetic.write_tracking_csv(csv_file, n_frames=n_frames, seed=args.seed)
+            add_case(f'prepare_df/frames={n_frames}', bench_prepare_df, csv_file)
+
+        csv_file = data_path / f'synthetic_{args.match_frames}.csv'
+        if not csv_file.exists():
+            synthetic.write_tracking_csv(csv_file, n_frames=args.match_frames, seed=args.seed)
+        for grid in args.grid_sizes:
+            add_case(f'frame/grid={grid}', bench_frame, csv_file, grid, args.timed_frames)
+        for grid in args.grid_sizes:
+            for step in args.frame_steps:
+                add_case(f'one_half/grid={grid}/step={step}', bench_one_half, csv_file, grid, step)
+
+    results = {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'environment': environment(),
+        'config': vars(args),
+        'cases': cases
+    }
+    output = Path(args.output) if args.output else \
+        RESULTS_PATH / f'{datetime.now().strftime("%Y%m%d-%H%M%S")}.json'
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results saved in {output}')
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
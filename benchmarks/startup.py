@@ -0,0 +1,72 @@
+"""
+Measures the startup time of the CLI and checks it against a time budget.
+
+Run it from the root of the repository:
+    python benchmarks/startup.py
+    python benchmarks/startup.py --budget 0.3 --repeat 10
+
+The script exits with a non-zero status if any of the commands goes over the budget or if
+importing main.py loads one of the heavy modules.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+# Seconds allowed for the median run of each command
+STARTUP_BUDGET = 0.15
+
+# Modules that should only be loaded when their code path is used
+HEAVY_MODULES = ['pandas', 'scipy', 'tqdm', 'matplotlib', 'seaborn', 'joypy', 'sklearn',
+                 'src.pitch_control.pitch_control']
+
+COMMANDS = {
+    'help': ['main.py', '--help'],
+    'cached lookup': ['main.py', 'artificial_data_1', '-o', '25', '--use-cache'],
+}
+
+
+def time_command(command, repeat):
+    """Returns the wall time of each run of the command"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + command, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def heavy_modules_loaded():
+    """Returns the heavy modules that are loaded just by importing main.py"""
+    code = ('import sys, main; '
+            f'print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))')
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True,
+                            text=True).stdout.strip()
+    return [m for m in output.split(',') if m]
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget', type=float, default=STARTUP_BUDGET,
+                        help='Seconds allowed for the median run of each command')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs of each command')
+    args = parser.parse_args(args)
+
+    failed = False
+    for name, command in COMMANDS.items():
+        median = statistics.median(time_command(command, args.repeat))
+        status = 'ok' if median <= args.budget else 'OVER BUDGET'
+        failed |= median > args.budget
+        print(f'{name:<15} {median * 1000:8.1f} ms  (budget {args.budget * 1000:.0f} ms) {status}')
+
+    loaded = heavy_modules_loaded()
+    if loaded:
+        failed = True
+        print(f'importing main.py loads heavy modules: {", ".join(loaded)}')
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,164 @@
+import os
+import pickle
+import time
+from multiprocessing import Process
+from pathlib import Path
+from parser import parse_cluster_args
+from src.batch import file_queue, runner
+from src.data import results
+
+# Runs the halves of a season on several hosts that share a directory (NFS, a mounted bucket...):
+#   python cluster.py submit /shared/queue data/processed -o 25 -iv --results /shared/results
+#   python cluster.py work /shared/queue              (on every host, as many times as cores)
+#   python cluster.py merge /shared/queue --wait      (once, writes the results of split halves)
+# A half can be split in frame ranges with --parts, so that a single match uses several hosts.
+# To try it on a single machine:
+#   python cluster.py submit /tmp/queue data/processed -o 25 --parts 4
+#   python cluster.py local /tmp/queue -w 4
+
+
+def output_name(kwargs):
+    return results.one_half_output_name(kwargs['filename'], kwargs['include_velocities'],
+                                        kwargs['home_stamine_factor'],
+                                        kwargs['away_stamine_factor'],
+                                        kwargs['positions_to_increase'])
+
+
+def output_path(kwargs):
+    return Path(kwargs['results_path']) / f'{output_name(kwargs)}.pkl'
+
+
+def submit(queue, matches, args):
+    """Adds a task for each match, or one for each frame range if the halves are split"""
+    added = 0
+    for match in matches:
+        kwargs = {
+            'filename': match.stem,
+            'frames_step': args.one_half,
+            'include_velocities': args.include_velocities,
+            'home_stamine_factor': args.stamine_home,
+            'away_stamine_factor': args.stamine_away,
+            'positions_to_increase': args.position_increase or results.DEFAULT_POSITIONS,
+            'engine': args.engine,
+            'data_path': str(match.parent),
+            'results_path': args.results
+        }
+        if output_path(kwargs).exists() and not args.force:
+            print(f'{match.stem} is already in {args.results}')
+            continue
+        name = output_name(kwargs)
+        if args.parts == 1:
+            added += queue.add(name, {'type': 'match', 'match': name, 'kwargs': kwargs})
+        else:
+            for part in range(args.parts):
+                added += queue.add(f'{name}_part{part + 1:03d}of{args.parts:03d}',
+                                   {'type': 'part', 'match': name, 'part': part,
+                                    'parts': args.parts, 'kwargs': kwargs})
+    return added
+
+
+def run_task(task_id, task, queue):
+    """Runs a task of the queue, returning the path of its output"""
+    import main
+
+    kwargs = dict(task['kwargs'])
+    Path(kwargs['results_path']).mkdir(parents=True, exist_ok=True)
+    if task['type'] == 'match':
+        return str(main.calculate_one_half(**kwargs, progress=False))
+
+    del kwargs['results_path']
+    partial = main.calculate_one_half_part(part=task['part'], parts=task['parts'],
+                                           progress=False, **kwargs)
+    partial_file = queue.path / 'partials' / f'{task_id}.pkl'
+    temporary = partial_file.with_name(f'.{partial_file.name}.{os.getpid()}.tmp')
+    with open(temporary, 'wb') as f:
+        pickle.dump(partial, f)
+    os.replace(temporary, partial_file)
+    return str(partial_file)
+
+
+def merge(queue):
+    """Writes the result of every split half whose frame ranges are all done
+
+    Returns the number of halves that are still waiting for some range
+    """
+    import main
+    from src.data import analysis
+
+    halves = {}
+    for task_id, task in queue.tasks().items():
+        if task['type'] == 'part':
+            halves.setdefault(task['match'], []).append((task['part'], task_id, task))
+
+    waiting = 0
+    for name, parts in halves.items():
+        kwargs = parts[0][2]['kwargs']
+        pickle_file = output_path(kwargs)
+        states = [queue.state(task_id) for _, task_id, _ in parts]
+        if 'failed' in states:
+            print(f'{name} has failed ranges, it can not be merged')
+            continue
+        if any(state != 'done' for state in states):
+            waiting += 1
+            continue
+        if pickle_file.exists():
+            continue
+
+        partials = []
+        for _, task_id, _ in sorted(parts, key=lambda part: part[0]):
+            with open(queue.path / 'partials' / f'{task_id}.pkl', 'rb') as f:
+                partials.append(pickle.load(f))
+        velocities_df = partials[0][1]
+        result_df = analysis.merge_partial_contributions([partial for partial, _ in partials])
+        result_df = result_df.to_dataframe().merge(velocities_df, on=['id', 'team'], how='left')
+        pickle_file.parent.mkdir(parents=True, exist_ok=True)
+        main.save_one_half(kwargs['filename'], result_df, pickle_file)
+    return waiting
+
+
+def work(queue_path, worker=None, heartbeat=30., poll=10.):
+    queue = file_queue.JobQueue(queue_path)
+    return file_queue.work(queue, run_task, worker=worker, heartbeat_interval=heartbeat,
+                           poll_interval=poll)
+
+
+def print_status(queue):
+    status = queue.status()
+    counts = {}
+    for task_id, entry in status.items():
+        counts[entry['state']] = counts.get(entry['state'], 0) + 1
+        elapsed = f'{entry["elapsed_s"]:.1f} s' if entry.get('elapsed_s') is not None else ''
+        print(f'{task_id:<60} {entry["state"]:<8} {entry["attempts"]} attempts '
+              f'{entry["worker"] or ""} {elapsed}')
+    print(counts)
+
+
+if __name__ == "__main__":
+    args = parse_cluster_args()
+
+    if args.command == 'submit':
+        matches = runner.find_matches(args.matches)
+        if not matches:
+            exit(f'No matches found in {args.matches}')
+        queue = file_queue.JobQueue.create(args.queue, args.lease_timeout, args.max_attempts)
+        print(f'{submit(queue, matches, args)} tasks added to {args.queue}')
+    elif args.command == 'work':
+        work(args.queue, args.worker, args.heartbeat, args.poll)
+    elif args.command == 'local':
+        queue = file_queue.JobQueue(args.queue)
+        workers = [Process(target=work, args=(args.queue, None, args.heartbeat, 1.))
+                   for _ in range(args.workers or os.cpu_count())]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        merge(queue)
+        print_status(queue)
+        if any(entry['state'] == 'failed' for entry in queue.status().values()):
+            exit(1)
+    elif args.command == 'merge':
+        queue = file_queue.JobQueue(args.queue)
+        while merge(queue) and args.wait:
+            time.sleep(10.)
+    elif args.command == 'status':
+        print_status(file_queue.JobQueue(args.queue))
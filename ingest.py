@@ -0,0 +1,22 @@
+import time
+from parser import parse_ingest_args
+
+# Converts the raw Tracab feed of a match into data/processed, with its goalkeepers, pitch size
+# and periods in <output>.meta.json, which main.py uses instead of guessing them:
+#   python ingest.py raw/match_10748.dat data/processed/match_10748.csv -x raw/match_10748.xml
+#   python ingest.py raw/match_10748.dat data/processed/match_10748_1.npz -x raw/match_10748.xml --period 1
+
+
+if __name__ == "__main__":
+    args = parse_ingest_args()
+
+    from src.data import tracab
+
+    start = time.perf_counter()
+    try:
+        metadata = tracab.convert(args.dat, args.metadata, args.output, period=args.period)
+    except tracab.TracabError as e:
+        exit(f'Could not convert {args.dat}: {e}')
+    print(f'{metadata["frames"]} frames and {len(metadata["converted_players"])} players written '
+          f'in {args.output} in {time.perf_counter() - start:.1f} s, '
+          f'goalkeepers: {metadata["goalkeepers"] or "not in the metadata"}')
@@ -1,22 +1,77 @@
 import pickle
-import pandas as pd
-import re
 from pathlib import Path
 from parser import parse_args
-import src.data.utils as utils
-from src.data import analysis
-from src.pitch_control.pitch_control import PitchControl
-from tqdm import tqdm
+from src.data import results
+
+# Heavy modules (pandas, tqdm, the pitch control stack) are imported inside the functions that
+# use them so that `--help` and cached lookups do not pay for them.
+# See benchmarks/startup.py for the startup budget.
 
 DATA_PATH = Path('data/processed')
 
 
-# TODO: sacar goalkeeperes y size del campo del XML
+def create_profiler(profile, name):
+    """Returns a Profiler for the run if profiling was requested"""
+    if not profile:
+        return None
+    from src.instrumentation.profiler import Profiler
+    return Profiler(name)
+
+
+def save_profile(profiler, results_path=results.RESULTS_PATH):
+    """Writes the JSON report of the profiler next to the results"""
+    if profiler is None or not profiler.enabled:
+        return
+    profile_file = Path(results_path) / f'profile_{profiler.name}.json'
+    profiler.save(profile_file)
+    print(f'Profile saved in {profile_file}')
+
+
+def match_file(filename, data_path=DATA_PATH):
+    """Returns the tracking file of the match, the CSV or else the .npz converted by ingest.py"""
+    filepath = Path(data_path) / (filename + '.csv')
+    if not filepath.exists() and filepath.with_suffix('.npz').exists():
+        return filepath.with_suffix('.npz')
+    return filepath
+
+
+def match_metadata(filepath):
+    """Returns the goalkeepers and the PitchControl arguments given by the metadata of the match
+    (see src/data/tracab.py), empty if the match has no metadata"""
+    from src.data import tracab
 
+    metadata = tracab.read_match_metadata(filepath) or {}
+    goalkeepers = metadata.get('goalkeepers') or None
+    pitch_control_args = {'goalkeepers': goalkeepers}
+    if metadata.get('pitch_length') and metadata.get('pitch_width'):
+        pitch_control_args['field_dimen'] = (metadata['pitch_length'], metadata['pitch_width'])
+    return goalkeepers, pitch_control_args
 
-def estimate_single_frame(filename, frame, include_velocities=False):
+
+def load_profiles(profiles_path):
+    """Returns the ProfileStore saved in profiles_path, or None if no path is given"""
+    if not profiles_path:
+        return None
+    from src.data.profiles import ProfileStore
+    if not Path(profiles_path).exists():
+        exit(f'The profile store {profiles_path} does not exist, create it with profiles.py')
+    return ProfileStore(profiles_path)
+
+
+def estimate_single_frame(filename, frame, include_velocities=False, profile=False,
+                          engine='reference'):
     """Estimate pitch control in a single frame"""
-    df, home_velocities, away_velocities = utils.prepare_df(DATA_PATH / (filename + '.csv'))
+    import src.data.utils as utils
+    from src.pitch_control.pitch_control import PitchControl
+
+    profiler = create_profiler(profile, f'single_frame_{filename}_{frame}')
+    filepath = match_file(filename)
+    goalkeepers, metadata_args = match_metadata(filepath)
+    df, home_velocities, away_velocities = utils.prepare_df(filepath,
+                                                            filename,
+                                                            include_player_velocities=include_velocities,
+                                                            profiler=profiler,
+                                                            goalkeepers=goalkeepers)
 
     # Estimate pitch control
     if frame not in df['frame'].values:
@@ -25,12 +80,14 @@ def estimate_single_frame(filename, frame, include_velocities=False):
     if include_velocities:
         pitch_control = PitchControl(df, include_individual_velocities=True,
                                      home_individual_velocities=home_velocities,
-                                     away_individual_velocities=away_velocities)
+                                     away_individual_velocities=away_velocities,
+                                     engine=engine, profiler=profiler, **metadata_args)
     else:
-        pitch_control = PitchControl(df)
+        pitch_control = PitchControl(df, engine=engine, profiler=profiler, **metadata_args)
 
     PPCFa = pitch_control.generate_pitch_control_for_event(df.loc[df['frame'] == frame])
     data = pitch_control.get_individual_contributions()
+    save_profile(profiler)
 
     output = {
         'match': filename,
@@ -38,97 +95,738 @@ def estimate_single_frame(filename, frame, include_velocities=False):
         'PPCFa': PPCFa,
         'individual_contributions': data
     }
-    pickle_file = Path('results') / f'single_frame_{filename}_{frame}.pkl'
+    pickle_file = results.RESULTS_PATH / f'single_frame_{filename}_{frame}.pkl'
     with open(pickle_file, 'wb') as f:
         pickle.dump(output, f)
 
 
-def calculate_one_half(filename, frames_step, include_velocities=False,
-                       home_stamine_factor=None, away_stamine_factor=None,
-                       positions_to_increase = ['Defender','Midfielder','Striker','Substitute']):
+def load_one_half(filename, frames_step, include_velocities=False, home_stamine_factor=None,
+                  away_stamine_factor=None, positions_to_increase=results.DEFAULT_POSITIONS,
+                  n_grid_cells_x=50, data_path=DATA_PATH, engine='reference', profiler=None,
+                  profiles=None, teams=None, compact=False, zone_map='thirds',
+                  counterfactual=False, integrator='fixed', surrogate=None,
+                  aggregates_only=False, precision='float64', backend='numpy'):
+    """Reads the match and creates the PitchControl used to analyze the half
+
+    profiles: optional ProfileStore with the max velocity and position of the players, whose
+    teams are named as in the teams dictionary ('home'/'away' -> name)
+    compact: keep the tracking data in float32 (see utils.prepare_df)
+    zone_map: zones of the contributions (see src/pitch_control/zones.py)
+    counterfactual: estimate the pitch control lost without each player (see
+    src/pitch_control/counterfactual.py)
+    integrator: integrator of the contested cells, 'fixed' or 'adaptive' (see PitchControl)
+    surrogate: file of the SurrogateModel of the surrogate engine (see
+    src/pitch_control/surrogate.py)
+    aggregates_only: only accumulate the contributions, without keeping the surfaces (see
+    PitchControl)
+    precision: dtype of the arrays of the vectorized engine, 'float64' or 'float32' (see
+    src/pitch_control/precision.py)
+    backend: name of the backend of the kernels of the vectorized engine (see
+    src/pitch_control/backends/)
+    """
+    import pandas as pd
+    import src.data.utils as utils
+    from src.pitch_control.pitch_control import PitchControl
+
     # read and process the data
-    df, home_velocities, away_velocities = utils.prepare_df(DATA_PATH / (filename + '.csv'), filename,frames_step,
+    filepath = match_file(filename, data_path)
+    goalkeepers, metadata_args = match_metadata(filepath)
+    df, home_velocities, away_velocities = utils.prepare_df(filepath, filename,frames_step,
                                                             include_player_velocities=include_velocities,
                                                             stamine_home=home_stamine_factor,
                                                             stamine_away=away_stamine_factor,
-                                                            positions_to_increase=positions_to_increase)
+                                                            positions_to_increase=positions_to_increase,
+                                                            profiler=profiler, profiles=profiles,
+                                                            teams=teams, compact=compact,
+                                                            goalkeepers=goalkeepers)
 
     # Initialite the teams
 
 
-    pitch_control = PitchControl(df, include_individual_velocities=True, 
+    pitch_control = PitchControl(df, include_individual_velocities=True,
                                      home_individual_velocities=home_velocities,
                                      away_individual_velocities=away_velocities,
                                      home_stamine_factor=home_stamine_factor,
-                                     away_stamine_factor=away_stamine_factor)
+                                     away_stamine_factor=away_stamine_factor,
+                                     n_grid_cells_x=n_grid_cells_x,
+                                     engine=engine, profiler=profiler, zone_map=zone_map,
+                                     counterfactual=counterfactual, integrator=integrator,
+                                     surrogate=load_surrogate_model(engine, surrogate),
+                                     aggregates_only=aggregates_only, precision=precision,
+                                     backend=backend, **metadata_args)
 
     if any(pd.isnull(df['frame'])):
         exit(f'There are some NaNs in the frames!')
+    return df, pitch_control
+
+
+def load_one_half_chunks(filename, frames_step, include_velocities=False,
+                         home_stamine_factor=None, away_stamine_factor=None, n_grid_cells_x=50,
+                         data_path=DATA_PATH, engine='reference', memory_limit=None,
+                         profiler=None, profiles=None, teams=None, compact=False,
+                         zone_map='thirds', counterfactual=False, integrator='fixed',
+                         surrogate=None, aggregates_only=False, precision='float64',
+                         backend='numpy'):
+    """Same as load_one_half reading the match in chunks that fit in memory_limit MB
+
+    Returns a generator with the frames of each chunk and the PitchControl
+    """
+    from src.data import chunked
+    from src.pitch_control.pitch_control import PitchControl
+
+    filepath = match_file(filename, data_path)
+    goalkeepers, metadata_args = match_metadata(filepath)
+    chunk_rows = chunked.rows_per_chunk(filepath, memory_limit or chunked.DEFAULT_MEMORY_LIMIT,
+                                        compact=compact)
+    first_frame, home_velocities, away_velocities = chunked.prepare_match(
+        filepath, chunk_rows, include_player_velocities=include_velocities,
+        stamine_home=home_stamine_factor, stamine_away=away_stamine_factor, profiler=profiler,
+        profiles=profiles, teams=teams, compact=compact, goalkeepers=goalkeepers)
+    pitch_control = PitchControl(first_frame, include_individual_velocities=True,
+                                 home_individual_velocities=home_velocities,
+                                 away_individual_velocities=away_velocities,
+                                 home_stamine_factor=home_stamine_factor,
+                                 away_stamine_factor=away_stamine_factor,
+                                 n_grid_cells_x=n_grid_cells_x,
+                                 engine=engine, profiler=profiler, zone_map=zone_map,
+                                 counterfactual=counterfactual, integrator=integrator,
+                                 surrogate=load_surrogate_model(engine, surrogate),
+                                 aggregates_only=aggregates_only, precision=precision,
+                                 backend=backend, **metadata_args)
+    chunks = chunked.read_sampled_chunks(filepath, chunk_rows, frames_step, profiler, compact)
+    return chunks, pitch_control
+
+
+def set_offside_lines(pitch_control, df):
+    """Computes the offside lines of all the frames of df at once (see
+    src/pitch_control/offsides.py), returning the frames without the defending goalkeeper, whose
+    offsides are not checked"""
+    from src.data.shared_tracking import TrackingArrays
+
+    lines = pitch_control.set_offside_lines(TrackingArrays.from_dataframe(df))
+    return lines.missing_goalkeeper_frames()
+
+
+def report_missing_goalkeeper(frames):
+    if len(frames):
+        print(f'The defending goalkeeper is missing in {len(frames)} frames (first: {frames[0]}), '
+              f'their offsides were not checked')
 
+
+def run_chunks(pitch_control, chunks, metrics=None, progress=True):
+    """Estimates pitch control in the frames of each chunk, returning the sum by player of the
+    accumulated contributions without keeping the ones of every frame and the frames without the
+    defending goalkeeper"""
+    import numpy as np
+    from tqdm import tqdm
+    from src.data import analysis
+
+    contributions = None
+    running = None
+    if pitch_control.aggregates_only:
+        running = analysis.RunningContributions(pitch_control.get_individual_contributions())
+    missing_goalkeeper = []
+    with tqdm(desc='Analyzing Frames', unit='frames', disable=not progress) as progress_bar:
+        for chunk in chunks:
+            missing_goalkeeper.append(set_offside_lines(pitch_control, chunk))
+            PPCF_array = run_frames(pitch_control, chunk, chunk['frame'], metrics, progress=False,
+                                    running=running)
+            progress_bar.update(len(chunk))
+            if not PPCF_array:
+                continue
+            with pitch_control.profiler.stage('aggregation'):
+                chunk_contributions = analysis.sum_contributions(PPCF_array)
+                contributions = chunk_contributions if contributions is None else \
+                    contributions.add(chunk_contributions, fill_value=0.)
+    if running is not None and running.frames:
+        contributions = running.to_partial().running_sum
+    missing_goalkeeper = np.concatenate(missing_goalkeeper) if missing_goalkeeper else []
+    return contributions, missing_goalkeeper
+
+
+def run_frames(pitch_control, df, frames, metrics=None, progress=True, running=None,
+               weights=None):
+    """Estimates pitch control in each frame, returning the individual contributions after each one
+
+    running: optional analysis.RunningContributions where the contributions after each frame are
+    added instead, each frame standing for its number of frames in weights, and the returned list
+    is empty
+    """
+    from tqdm import tqdm
+
+    profiler = pitch_control.profiler
     PPCF_array = []
+    try:
+        for k, frame in enumerate(tqdm(frames, desc='Analyzing Frames', disable=not progress)):
+            _ = pitch_control.generate_pitch_control_for_event(df.loc[df['frame'] == frame])
+            with profiler.stage('aggregation'):
+                if running is None:
+                    data = pitch_control.get_individual_contributions()
+                    PPCF_array.append(data)
+                else:
+                    running.add_frame(pitch_control.get_accumulated_contributions(),
+                                      1 if weights is None else weights[k])
+            profiler.count('frames')
+            if metrics is not None:
+                metrics.update()
+    except Exception:
+        if metrics is not None:
+            metrics.close('failed')
+        raise
+    return PPCF_array
 
-    # Calculate the contributions for each frame
-    print('Optimized code with love and a sprinkle of magic ✨')
-    leng = len(df)
-    for frame in tqdm(df['frame'], desc='Analyzing Frames'):
-        _ = pitch_control.generate_pitch_control_for_event(df.loc[df['frame'] == frame])
-        data = pitch_control.get_individual_contributions()
-        PPCF_array.append(data)
-
-    PPCF_concatenated = pd.concat(PPCF_array, ignore_index=True)
-    result_df = PPCF_concatenated.groupby(['id', 'team']).agg({
-        'PPCF': 'sum',
-        'PPCF_attacking_first_zone': 'sum',
-        'PPCF_attacking_second_zone': 'sum',
-        'PPCF_attacking_third_zone': 'sum',
-        'PPCF_defending_first_zone': 'sum',
-        'PPCF_defending_second_zone': 'sum',
-        'PPCF_defending_third_zone': 'sum'
-    }).reset_index()
-    velocities_df = pitch_control.get_vmax_df()
-    result_df = result_df.merge(velocities_df, on=['id', 'team'], how='left')
 
+def sample_keyframes(df, max_step, player_displacement=None, profiler=None):
+    """Keeps the keyframes of the half (see src/data/sampling.py), returning them and the number
+    of frames that each one stands for"""
+    from src.data import sampling
+    from src.data.shared_tracking import TrackingArrays
+    from src.instrumentation.profiler import NULL_PROFILER
+
+    with (profiler or NULL_PROFILER).stage('keyframes'):
+        keyframes, weights = sampling.select_keyframes(
+            TrackingArrays.from_dataframe(df), max_step,
+            player_displacement or sampling.PLAYER_DISPLACEMENT)
+    print(f'Adaptive sampling: {len(keyframes)} keyframes out of {len(df)} frames')
+    return df.iloc[keyframes], weights
+
+
+def run_possession_segments(pitch_control, df, frames_step, cache_path, rerun=None, workers=1,
+                            metrics=None):
+    """Runs the half by possession segments (see src/data/segments.py), reusing the ones cached in
+    cache_path. Returns the contributions of the half and the table of contributions per
+    possession"""
+    from src.data import analysis, segments
+
+    match_segments = segments.find_segments(df, frames_step)
+    try:
+        partials = segments.run_segments(pitch_control, df, match_segments,
+                                         segments.SegmentCache(cache_path), rerun, workers,
+                                         metrics)
+    except Exception:
+        if metrics is not None:
+            metrics.close('failed')
+        raise
+    contributions = analysis.merge_partial_contributions(partials).running_sum
+    return contributions, segments.possession_table(match_segments, partials)
+
+
+def estimate_targets(filename, targets_file, include_velocities=False, attribution=False,
+                     profile=False):
+    """Estimate pitch control only at the query points of a CSV file with the columns frame, x
+    and y (e.g. the end locations of the passes), solving all the points at once instead of the
+    grid of each frame (see src/pitch_control/queries.py)"""
+    import pandas as pd
+    from src.data.shared_tracking import TrackingArrays
+
+    profiler = create_profiler(profile, f'targets_{filename}_{Path(targets_file).stem}')
+    queries = pd.read_csv(targets_file)
+    missing_columns = {'frame', 'x', 'y'} - set(queries.columns)
+    if missing_columns:
+        exit(f'The query file {targets_file} has no columns {sorted(missing_columns)}')
+
+    df, pitch_control = load_one_half(filename, None, include_velocities, engine='vectorized',
+                                      profiler=profiler)
+    tracking = TrackingArrays.from_dataframe(df)
+    output = pitch_control.generate_pitch_control_at_points(
+        tracking, queries['frame'].values, queries['x'].values, queries['y'].values,
+        attribution=attribution)
+    if attribution:
+        output, contributions = output
+    save_profile(profiler)
+
+    missing = output['PPCF_attacking'].isna().sum()
+    if missing:
+        print(f'{missing} of {len(output)} query points are in frames without live ball')
     output = {
         'match': filename,
-        'match_id': re.search(r'\d+$', filename).group(),
+        'targets': output
+    }
+    if attribution:
+        output['individual_contributions'] = contributions
+    pickle_file = results.RESULTS_PATH / f'targets_{filename}_{Path(targets_file).stem}.pkl'
+    with open(pickle_file, 'wb') as f:
+        pickle.dump(output, f)
+    print(f'Pitch control at {len(queries)} query points saved in {pickle_file}')
+
+
+def save_one_half(filename, result_df, pickle_file, possessions=None,
+                  missing_goalkeeper_frames=None, removal_impact=None, precision_deviation=None):
+    output = {
+        'match': filename,
+        'match_id': results.get_match_id(filename),
         'individual_contributions': result_df
     }
-    if len(positions_to_increase)==4:
-        filename = utils.create_output_filename(f'one_half_{filename}', include_velocities,
-                                            home_stamine_factor, away_stamine_factor)
-        
-    else:
-        filename = utils.create_output_filename(f'one_half_{filename}', include_velocities,
-                                            home_stamine_factor, away_stamine_factor,positions=positions_to_increase)
-    print(f'filename es : {filename}')
+    if possessions is not None:
+        output['possessions'] = possessions
+    if missing_goalkeeper_frames is not None and len(missing_goalkeeper_frames):
+        output['missing_goalkeeper_frames'] = list(missing_goalkeeper_frames)
+    if removal_impact is not None:
+        output['removal_impact'] = removal_impact
+    if precision_deviation is not None:
+        output['precision_deviation'] = precision_deviation
+    print(f'filename es : {pickle_file.stem}')
 
-    pickle_file = Path('results') / f'{filename}.pkl'
     with open(pickle_file, 'wb') as f:
         pickle.dump(output, f)
 
 
+def calculate_one_half(filename, frames_step, include_velocities=False,
+                       home_stamine_factor=None, away_stamine_factor=None,
+                       positions_to_increase=results.DEFAULT_POSITIONS, use_cache=False,
+                       profile=False, n_grid_cells_x=50, data_path=DATA_PATH,
+                       results_path=results.RESULTS_PATH, engine='reference',
+                       metrics_path=None, metrics_interval=10., worker=None, progress=True,
+                       workers=1, memory_limit=None, profiles_path=None, teams=None,
+                       compact=False, adaptive=False, keyframe_displacement=None,
+                       segments=False, rerun_segments=None, zone_map='thirds',
+                       counterfactual=False, integrator='fixed', surrogate=None,
+                       aggregates_only=False, precision='float64', backend='numpy'):
+    """Calculates the contributions of the players in the frames of the half, every frames_step
+    frames or, with adaptive, in keyframes at most frames_step frames apart, weighted so that
+    the result approximates the one of every frame
+
+    segments: run the half by possession segments, cached in results_path/segments, and save
+    the contributions of each possession in the result. rerun_segments are the numbers of the
+    segments that are run again even if they are cached
+    zone_map: zones where the contributions of the players are added, the name of a map or a
+    JSON file with polygons (see src/pitch_control/zones.py)
+    counterfactual: also save the pitch control lost by the team of each player without him/her
+    (removal_impact), integrating again only the cells where the player took part (see
+    src/pitch_control/counterfactual.py). Needs the vectorized engine and a single process
+    integrator: 'adaptive' integrates the contested cells with an error-controlled time step
+    instead of the fixed one (see src/pitch_control/vectorized.py)
+    surrogate: file of the SurrogateModel of the surrogate engine, which predicts the contested
+    cells instead of integrating them (see src/pitch_control/surrogate.py)
+    aggregates_only: add the contributions of each frame to running sums instead of keeping a
+    dataframe per frame, and keep no surfaces, only their convergence statistics. The result is
+    the same
+    precision: 'float32' solves the vectorized engine in float32, keeping the per-player sums in
+    float64, and saves in the result its deviation from float64 on a sample of the frames of the
+    run (see src/pitch_control/precision.py)
+    backend: backend of the kernels of the vectorized and surrogate engines, 'numpy' or an
+    accelerated one available on the host, with the same results up to rounding (see
+    src/pitch_control/backends/ and --check-backends)
+    """
+    surrogate = surrogate if engine == 'surrogate' else None
+    pickle_file = results.one_half_result_path(filename, include_velocities,
+                                               home_stamine_factor, away_stamine_factor,
+                                               positions_to_increase, results_path,
+                                               profiles=profiles_path, compact=compact,
+                                               adaptive=adaptive, zone_map=zone_map,
+                                               counterfactual=counterfactual,
+                                               integrator=integrator,
+                                               surrogate=surrogate, precision=precision)
+    if use_cache and pickle_file.exists():
+        print(f'Using cached result {pickle_file}')
+        return pickle_file
+
+    if memory_limit and workers > 1:
+        raise ValueError('The out-of-core mode (memory_limit) runs in a single process')
+    if memory_limit and adaptive:
+        raise ValueError('The adaptive sampling needs the whole half, it can not be used with '
+                         'the out-of-core mode (memory_limit)')
+    if segments and (memory_limit or adaptive):
+        raise ValueError('The possession segments can not be used with the out-of-core mode '
+                         '(memory_limit) nor with the adaptive sampling')
+    if counterfactual and (workers > 1 or segments or adaptive):
+        raise ValueError('The counterfactual mode runs every frame in a single process, it can '
+                         'not be used with workers, segments nor the adaptive sampling')
+
+    from src.data import analysis
+
+    check_backend_available(backend)
+    profiles = load_profiles(profiles_path)
+    # The live metrics read the model counters from the profiler
+    profiler = create_profiler(profile or metrics_path, pickle_file.stem)
+    if memory_limit:
+        # The match is read in chunks, so the number of frames is not known in advance
+        chunks, pitch_control = load_one_half_chunks(filename, frames_step, include_velocities,
+                                                     home_stamine_factor, away_stamine_factor,
+                                                     n_grid_cells_x, data_path, engine,
+                                                     memory_limit, profiler, profiles, teams,
+                                                     compact, zone_map, counterfactual,
+                                                     integrator, surrogate, aggregates_only,
+                                                     precision, backend)
+        total_frames = None
+    else:
+        df, pitch_control = load_one_half(filename, None if adaptive else frames_step,
+                                          include_velocities, home_stamine_factor,
+                                          away_stamine_factor, positions_to_increase,
+                                          n_grid_cells_x, data_path, engine, profiler, profiles,
+                                          teams, compact, zone_map, counterfactual,
+                                          integrator, surrogate, aggregates_only, precision,
+                                          backend)
+        weights = None
+        if adaptive:
+            df, weights = sample_keyframes(df, frames_step, keyframe_displacement, profiler)
+        total_frames = len(df)
+        missing_goalkeeper = set_offside_lines(pitch_control, df)
+    profiler = pitch_control.profiler
+
+    metrics = None
+    if metrics_path:
+        from src.instrumentation.metrics import MetricsExporter
+        metrics = MetricsExporter(metrics_path, filename, total_frames=total_frames,
+                                  worker=worker, interval=metrics_interval, profiler=profiler)
+
+    # Calculate the contributions for each frame
+    print('Optimized code with love and a sprinkle of magic ✨')
+    possessions = None
+    if segments:
+        # The cache depends on the frames analyzed and how, besides the options in the name
+        cache_path = Path(results_path) / 'segments' / \
+            f'{pickle_file.stem}_o{frames_step}_{engine}_{n_grid_cells_x}'
+        contributions, possessions = run_possession_segments(pitch_control, df, frames_step,
+                                                             cache_path, rerun_segments,
+                                                             workers, metrics)
+    elif memory_limit:
+        contributions, missing_goalkeeper = run_chunks(pitch_control, chunks, metrics, progress)
+    elif workers > 1:
+        # The frames are split among processes that read the tracking data from shared memory
+        from src.batch import frame_pool
+        try:
+            contributions = frame_pool.run_frames_parallel(pitch_control, df, workers,
+                                                           metrics=metrics,
+                                                           weights=weights).running_sum
+        except Exception:
+            if metrics is not None:
+                metrics.close('failed')
+            raise
+    elif aggregates_only:
+        running = analysis.RunningContributions(pitch_control.get_individual_contributions())
+        run_frames(pitch_control, df, df['frame'], metrics, progress, running, weights)
+        with profiler.stage('aggregation'):
+            contributions = running.to_partial().running_sum
+    else:
+        PPCF_array = run_frames(pitch_control, df, df['frame'], metrics, progress)
+        with profiler.stage('aggregation'):
+            if weights is not None:
+                contributions = analysis.PartialContributions.from_weighted_frames(
+                    PPCF_array, weights).running_sum
+            else:
+                contributions = analysis.sum_contributions(PPCF_array)
+
+    with profiler.stage('aggregation'):
+        result_df = contributions.reset_index()
+        velocities_df = pitch_control.get_vmax_df()
+        result_df = result_df.merge(velocities_df, on=['id', 'team'], how='left')
+
+    convergence = pitch_control.get_convergence_stats()
+    if aggregates_only and convergence['frames']:
+        print(f'Checksums of {convergence["frames"]} frames: mean '
+              f'{convergence["mean_checksum"]:.6f}, min {convergence["min_checksum"]:.6f}')
+
+    precision_deviation = None
+    if pitch_control.precision_deviation is not None:
+        precision_deviation = pitch_control.precision_deviation.to_dict()
+        print(f'{precision} deviation from float64 on {precision_deviation["checked_frames"]} '
+              f'frames: max surface error {precision_deviation["max_surface_error"]:.2e}, max '
+              f'contribution error {precision_deviation["max_contribution_error"]:.2e}')
+
+    removal_impact = None
+    if counterfactual:
+        removal_impact = pitch_control.get_removal_impact()
+        print(f'Counterfactual: integrated {pitch_control.counterfactual_cells} cells instead of '
+              f'{pitch_control.counterfactual_rerun_cells} solving each frame once per player')
+    report_missing_goalkeeper(missing_goalkeeper)
+    save_one_half(filename, result_df, pickle_file, possessions, missing_goalkeeper,
+                  removal_impact, precision_deviation)
+    if metrics is not None:
+        metrics.close()
+    if profile:
+        save_profile(profiler, results_path)
+    return pickle_file
+
+
+def calculate_one_half_part(filename, frames_step, part, parts, include_velocities=False,
+                            home_stamine_factor=None, away_stamine_factor=None,
+                            positions_to_increase=results.DEFAULT_POSITIONS, n_grid_cells_x=50,
+                            data_path=DATA_PATH, engine='reference', progress=True):
+    """Calculates the part-th of 'parts' consecutive ranges of frames of one half
+
+    The whole match is still read, so that the max velocities and the goalkeepers are the same in
+    every part. Returns the PartialContributions of the range and the max velocities of the
+    players; the parts are merged in order with analysis.merge_partial_contributions
+    """
+    import numpy as np
+    from src.data import analysis
+
+    df, pitch_control = load_one_half(filename, frames_step, include_velocities,
+                                      home_stamine_factor, away_stamine_factor,
+                                      positions_to_increase, n_grid_cells_x, data_path, engine)
+    set_offside_lines(pitch_control, df)
+    frames = np.array_split(df['frame'].values, parts)[part]
+    if len(frames) == 0:
+        partial = analysis.PartialContributions.zeros(pitch_control.get_individual_contributions())
+    else:
+        partial = analysis.PartialContributions.from_frames(
+            run_frames(pitch_control, df, frames, progress=progress))
+    return partial, pitch_control.get_vmax_df()
+
+
+def prepare_validation(filename, include_velocities=False, home_stamine_factor=None,
+                       away_stamine_factor=None):
+    """Reads the match to compare engines on it, returning the dataframe and the PitchControl
+    arguments of the match shared by the engines"""
+    import src.data.utils as utils
+
+    filepath = match_file(filename)
+    goalkeepers, metadata_args = match_metadata(filepath)
+    df, home_velocities, away_velocities = utils.prepare_df(filepath,
+                                                            filename,
+                                                            include_player_velocities=include_velocities,
+                                                            stamine_home=home_stamine_factor,
+                                                            stamine_away=away_stamine_factor,
+                                                            goalkeepers=goalkeepers)
+    pitch_control_args = {
+        **metadata_args,
+        'include_individual_velocities': True,
+        'home_individual_velocities': home_velocities,
+        'away_individual_velocities': away_velocities,
+        'home_stamine_factor': home_stamine_factor,
+        'away_stamine_factor': away_stamine_factor
+    }
+    return df, pitch_control_args
+
+
+def save_validation_report(report, filename, candidate):
+    """Writes the report of validation.compare_engines in results/ and prints its summary"""
+    import json
+
+    report['match'] = filename
+    report_file = results.RESULTS_PATH / f'validation_{filename}_{candidate}.json'
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'{candidate} vs {report["reference"]["engine"]} on {len(report["frames"])} frames: '
+          f'max surface error {report["max_surface_error"]:.2e}, '
+          f'mean surface error {report["mean_surface_error"]:.2e}, '
+          f'max zone error {report["max_zone_error"]:.2e}, speedup x{report["speedup"]:.1f}')
+    print(f'Report saved in {report_file}')
+
+
+def validate_engine(filename, n_frames, engine, include_velocities=False,
+                    home_stamine_factor=None, away_stamine_factor=None, tolerance=None,
+                    surrogate=None, precision='float64', backend='numpy'):
+    """Compares the engine (with the precision and the backend) with the reference model in
+    float64 on n_frames sampled frames of the match
+    and exits with an error if the tolerance is exceeded. The surrogate engine, with the model
+    saved in surrogate, is compared with the exact vectorized engine"""
+    from src.pitch_control import validation
+
+    check_backend_available(backend)
+    df, pitch_control_args = prepare_validation(filename, include_velocities,
+                                                home_stamine_factor, away_stamine_factor)
+    frames = validation.sample_frames(df, n_frames)
+    candidate = {'engine': engine}
+    reference = validation.REFERENCE
+    name = engine
+    if precision != 'float64':
+        candidate['precision'] = precision
+        name = f'{name}_{precision}_precision'
+    if backend != 'numpy':
+        candidate['backend'] = backend
+        name = f'{name}_{backend}_backend'
+    if engine == 'surrogate':
+        candidate['surrogate'] = load_surrogate_model(engine, surrogate)
+        reference = {'engine': 'vectorized'}
+        name = f'{name}_{Path(surrogate).stem}'
+    report = validation.compare_engines(df, frames, candidate, reference,
+                                        pitch_control_args=pitch_control_args,
+                                        tolerance=tolerance or validation.DEFAULT_TOLERANCE)
+    if engine == 'surrogate':
+        report['candidate'] = {**candidate, 'surrogate': str(surrogate)}
+    save_validation_report(report, filename, name)
+    try:
+        validation.check_report(report)
+    except validation.ValidationError as e:
+        exit(f'Validation failed: {e}')
+
+
+def check_backend_available(backend):
+    """Exits with an error if the backend can not be used on this host"""
+    if backend == 'numpy':
+        return
+    from src.pitch_control.backends import BackendError, get_backend
+    try:
+        get_backend(backend)
+    except BackendError as e:
+        exit(str(e))
+
+
+def check_backends(filename, n_frames, include_velocities=False, home_stamine_factor=None,
+                   away_stamine_factor=None, tolerance=None, integrator='fixed'):
+    """Checks every backend available on this host against the numpy one on n_frames sampled
+    frames of the match (see src/pitch_control/backends/conformance.py), saving a report per
+    backend in results/ and printing their speedups. Exits with an error if a backend does not
+    conform"""
+    import json
+    import numpy as np
+    from src.data.shared_tracking import TrackingArrays
+    from src.pitch_control.backends import BACKENDS, BackendError, conformance, get_backend
+    from src.pitch_control.pitch_control import PitchControl
+
+    df, pitch_control_args = prepare_validation(filename, include_velocities,
+                                                home_stamine_factor, away_stamine_factor)
+    pitch_control = PitchControl(df, engine='vectorized', integrator=integrator,
+                                 **pitch_control_args)
+    tracking = TrackingArrays.from_dataframe(df)
+    pitch_control.set_offside_lines(tracking)
+    rows = np.unique(np.linspace(0, len(df) - 1, min(n_frames, len(df))).round().astype(int))
+    cases = conformance.frame_cases(pitch_control, tracking, rows)
+
+    failed = []
+    for backend in BACKENDS:
+        if backend == 'numpy':
+            continue
+        try:
+            get_backend(backend)
+        except BackendError as e:
+            print(f'{backend}: not available ({e})')
+            continue
+        report = conformance.check_backend(backend, cases,
+                                           tolerance or conformance.CONFORMANCE_TOLERANCE)
+        report['match'] = filename
+        report_file = results.RESULTS_PATH / f'backend_{filename}_{backend}.json'
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=2)
+        max_error = max(report['max_errors'].values())
+        print(f'{backend}: {"conforms" if report["passed"] else "DOES NOT CONFORM"} on '
+              f'{len(report["frames"])} frames, max error {max_error:.2e}, speedup '
+              f'x{report["speedup"]:.2f} (report in {report_file})')
+        if not report['passed']:
+            failed.append(backend)
+    if failed:
+        exit(f'Backends that do not conform: {failed}')
+
+
+def load_surrogate_model(engine, surrogate):
+    """Returns the SurrogateModel saved in surrogate for the surrogate engine, None for the other
+    engines"""
+    if engine != 'surrogate':
+        return None
+    if not surrogate:
+        exit('The surrogate engine needs a model: train it with --train-surrogate and give its '
+             'file with --surrogate')
+    from src.pitch_control.surrogate import SurrogateError, load_surrogate
+    try:
+        return load_surrogate(surrogate)
+    except SurrogateError as e:
+        exit(str(e))
+
+
+def train_surrogate(filename, surrogate, n_frames, validation_frames=20,
+                    include_velocities=False, home_stamine_factor=None,
+                    away_stamine_factor=None, tolerance=None, profile=False):
+    """Trains a surrogate of the pitch control model (see src/pitch_control/surrogate.py) on the
+    exact surfaces of n_frames sampled frames of the match, compares it with the exact vectorized
+    engine on validation_frames other frames and saves it, with the report of the comparison, in
+    surrogate"""
+    import numpy as np
+    from src.data.shared_tracking import TrackingArrays
+    from src.pitch_control import validation
+    from src.pitch_control.pitch_control import PitchControl
+    from src.pitch_control.surrogate import SurrogateError, train
+
+    profiler = create_profiler(profile, f'surrogate_{filename}_{Path(surrogate).stem}')
+    df, pitch_control_args = prepare_validation(filename, include_velocities,
+                                                home_stamine_factor, away_stamine_factor)
+    pitch_control = PitchControl(df, engine='vectorized', profiler=profiler,
+                                 **pitch_control_args)
+    tracking = TrackingArrays.from_dataframe(df)
+    pitch_control.set_offside_lines(tracking)
+    rows = np.unique(np.linspace(0, len(df) - 1, n_frames).round().astype(int))
+    try:
+        model = train(pitch_control, tracking, rows)
+    except SurrogateError as e:
+        exit(str(e))
+    print(f'Surrogate trained on {model.training["cells"]} contested cells of {len(rows)} frames')
+    save_profile(profiler)
+
+    # The surrogate is validated on frames that it was not trained with
+    training_frames = set(tracking.frame[rows])
+    frames = [frame for frame in validation.sample_frames(df, validation_frames)
+              if frame not in training_frames]
+    report = validation.compare_engines(df, frames, {'engine': 'surrogate', 'surrogate': model},
+                                        {'engine': 'vectorized'},
+                                        pitch_control_args=pitch_control_args,
+                                        tolerance=tolerance or validation.DEFAULT_TOLERANCE)
+    report['candidate'] = {'engine': 'surrogate', 'surrogate': str(surrogate)}
+    save_validation_report(report, filename, f'surrogate_{Path(surrogate).stem}')
+    model.report = report
+    model.save(surrogate)
+    print(f'Surrogate saved in {surrogate}')
+
+
 if __name__ == "__main__":
     args = parse_args()
 
-    if args.single_frame:
-        estimate_single_frame(args.filename, args.single_frame, args.include_velocities)
+    if args.train_surrogate:
+        if not args.surrogate:
+            exit('Give the file where the surrogate is saved with --surrogate')
+        train_surrogate(args.filename, args.surrogate, args.train_surrogate,
+                        validation_frames=args.validate or 20,
+                        include_velocities=args.include_velocities,
+                        home_stamine_factor=args.stamine_home,
+                        away_stamine_factor=args.stamine_away,
+                        tolerance=args.tolerance, profile=args.profile)
+    elif args.check_backends:
+        check_backends(args.filename, args.check_backends,
+                       include_velocities=args.include_velocities,
+                       home_stamine_factor=args.stamine_home,
+                       away_stamine_factor=args.stamine_away,
+                       tolerance=args.tolerance, integrator=args.integrator)
+    elif args.validate:
+        validate_engine(args.filename, args.validate, args.engine,
+                        include_velocities=args.include_velocities,
+                        home_stamine_factor=args.stamine_home,
+                        away_stamine_factor=args.stamine_away,
+                        tolerance=args.tolerance,
+                        surrogate=args.surrogate,
+                        precision=args.precision,
+                        backend=args.backend)
+    elif args.targets:
+        estimate_targets(args.filename, args.targets, args.include_velocities,
+                         attribution=args.attribution, profile=args.profile)
+    elif args.single_frame:
+        estimate_single_frame(args.filename, args.single_frame, args.include_velocities,
+                              profile=args.profile, engine=args.engine)
     else:
         if args.multiple_frames:
+            from src.data import analysis
+
             for frame in args.multiple_frames:
-                estimate_single_frame(args.filename, frame)
+                estimate_single_frame(args.filename, frame, engine=args.engine)
             analysis.sum_mutiple_frames_contributions(args.filename, args.multiple_frames)
         else:
             if args.one_half:
-                if args.position_increase:
-                    calculate_one_half(args.filename, args.one_half,
-                                    include_velocities=args.include_velocities,
-                                    home_stamine_factor=args.stamine_home,
-                                    away_stamine_factor=args.stamine_away,
-                                    positions_to_increase=args.position_increase)
-                else:
-                    calculate_one_half(args.filename, args.one_half,
-                                    include_velocities=args.include_velocities,
-                                    home_stamine_factor=args.stamine_home,
-                                    away_stamine_factor=args.stamine_away)
+                teams = dict(zip(('home', 'away'), args.teams)) if args.teams else None
+                calculate_one_half(args.filename, args.one_half,
+                                   include_velocities=args.include_velocities,
+                                   home_stamine_factor=args.stamine_home,
+                                   away_stamine_factor=args.stamine_away,
+                                   positions_to_increase=(args.position_increase or
+                                                          results.DEFAULT_POSITIONS),
+                                   use_cache=args.use_cache,
+                                   profile=args.profile,
+                                   engine=args.engine,
+                                   metrics_path=args.metrics,
+                                   metrics_interval=args.metrics_interval,
+                                   workers=args.workers,
+                                   memory_limit=args.memory_limit,
+                                   profiles_path=args.profiles,
+                                   teams=teams,
+                                   compact=args.compact,
+                                   adaptive=args.adaptive,
+                                   keyframe_displacement=args.keyframe_displacement,
+                                   segments=args.segments,
+                                   rerun_segments=args.rerun_segments,
+                                   zone_map=args.zones,
+                                   counterfactual=args.counterfactual,
+                                   integrator=args.integrator,
+                                   surrogate=args.surrogate,
+                                   aggregates_only=args.aggregates_only,
+                                   precision=args.precision,
+                                   backend=args.backend)
             else:
                 exit('Please, enter a valid option')
@@ -1,6 +1,16 @@
 import sys
 import argparse
 
+# Engines of src.pitch_control.pitch_control (not imported here to keep the CLI fast). The
+# surrogate engine also needs a trained model, so only main.py offers it
+ENGINES = ['reference', 'vectorized']
+# Integrators of src.pitch_control.vectorized.INTEGRATORS
+INTEGRATORS = ['fixed', 'adaptive']
+# Precisions of src.pitch_control.precision.PRECISIONS
+PRECISIONS = ['float64', 'float32']
+# Backends of src.pitch_control.backends.BACKENDS
+BACKENDS = ['numpy', 'numba']
+
 
 def parse_args(args=sys.argv[1:]):
     custom_parser = argparse.ArgumentParser()
@@ -65,4 +75,519 @@ def parse_args(args=sys.argv[1:]):
         help="Analyze this list of frames"
     )
 
+    custom_parser.add_argument(
+        "-c",
+        "--use-cache",
+        action=argparse.BooleanOptionalAction,
+        help="Do not recompute the half if its result is already in results/"
+    )
+
+    custom_parser.add_argument(
+        "-p",
+        "--profile",
+        action=argparse.BooleanOptionalAction,
+        help="Time each stage of the run and save a JSON report in results/"
+    )
+
+    custom_parser.add_argument(
+        "-e",
+        "--engine",
+        choices=ENGINES + ['surrogate'],
+        default='reference',
+        help="Engine used to solve the pitch control model. surrogate predicts the contested "
+             "cells with a model trained with --train-surrogate (see --surrogate)"
+    )
+
+    custom_parser.add_argument(
+        "--train-surrogate",
+        type=int,
+        help="Train a surrogate of the pitch control model on this number of sampled frames, "
+             "compare it with the vectorized engine on --validate other frames (default 20) "
+             "and save it in the file given by --surrogate"
+    )
+
+    custom_parser.add_argument(
+        "--surrogate",
+        help="Surrogate model file written by --train-surrogate and used by -e surrogate"
+    )
+
+    custom_parser.add_argument(
+        "-val",
+        "--validate",
+        type=int,
+        help="Compare the engine with the reference model on this number of sampled frames"
+    )
+
+    custom_parser.add_argument(
+        "-tol",
+        "--tolerance",
+        type=float,
+        help="Maximum error allowed when validating an engine (default: 0.01) or checking the "
+             "backends (default: 1e-9)"
+    )
+
+    custom_parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes that share the frames of the half"
+    )
+
+    custom_parser.add_argument(
+        "--memory-limit",
+        type=float,
+        help="Read the match in chunks so that the tracking data in memory stays below this "
+             "number of MB, whatever the length of the match"
+    )
+
+    custom_parser.add_argument(
+        "-a",
+        "--adaptive",
+        action=argparse.BooleanOptionalAction,
+        help="Analyze keyframes where the players, the ball or the possession changed, at most "
+             "-o frames apart, weighted to approximate the result of every frame (-o 1)"
+    )
+
+    custom_parser.add_argument(
+        "--keyframe-displacement",
+        type=float,
+        help="Metres that a player has to move to make a new keyframe (default: 2)"
+    )
+
+    custom_parser.add_argument(
+        "--segments",
+        action=argparse.BooleanOptionalAction,
+        help="Run the half by possession segments, cached in results/segments so that only the "
+             "new ones run, and save the contributions of each possession in the result"
+    )
+
+    custom_parser.add_argument(
+        "--rerun-segments",
+        type=int,
+        nargs='+',
+        help="Numbers of the possession segments that run again even if they are cached"
+    )
+
+    custom_parser.add_argument(
+        "--zones",
+        default='thirds',
+        help="Zones where the contributions of the players are added: thirds (default), "
+             "channels, boxes or a JSON file with a polygon per zone, in metres from the centre "
+             "for a team attacking to the right"
+    )
+
+    custom_parser.add_argument(
+        "--integrator",
+        choices=INTEGRATORS,
+        default='fixed',
+        help="Integrator of the contested cells: fixed (time step of 0.04 s, default) or "
+             "adaptive (error-controlled time step, fewer and more accurate steps)"
+    )
+
+    custom_parser.add_argument(
+        "--precision",
+        choices=PRECISIONS,
+        default='float64',
+        help="Precision of the arrays of the vectorized engine: float64 (default) or float32, "
+             "with the per-player sums in float64 and the deviation from float64 measured on "
+             "one frame out of 50 and saved in the result. With --validate it is compared with "
+             "the float64 reference"
+    )
+
+    custom_parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default='numpy',
+        help="Backend of the kernels of the vectorized engine: numpy (default) or numba, "
+             "compiled if numba is installed. --check-backends compares them"
+    )
+
+    custom_parser.add_argument(
+        "--check-backends",
+        type=int,
+        help="Check every backend available on this host against the numpy one on this number "
+             "of frames of the match and print their speedups"
+    )
+
+    custom_parser.add_argument(
+        "--aggregates-only",
+        action=argparse.BooleanOptionalAction,
+        help="Add the contributions of the players to running sums after each frame, without "
+             "keeping the pitch control surfaces nor a table per frame (same result, less memory)"
+    )
+
+    custom_parser.add_argument(
+        "--targets",
+        help="CSV file with the columns frame, x and y: estimate pitch control only at these "
+             "points (e.g. the end locations of the passes) instead of the whole grid"
+    )
+
+    custom_parser.add_argument(
+        "--attribution",
+        action=argparse.BooleanOptionalAction,
+        help="With --targets, also save the contribution of each player to each point"
+    )
+
+    custom_parser.add_argument(
+        "--counterfactual",
+        action=argparse.BooleanOptionalAction,
+        help="Also estimate the pitch control lost by the team without each player (needs -e "
+             "vectorized), integrating again only the cells where the player took part"
+    )
+
+    custom_parser.add_argument(
+        "--compact",
+        action=argparse.BooleanOptionalAction,
+        help="Keep the positions and velocities in float32 and drop the referee and ball_z "
+             "columns, which about halves the memory of the tracking data"
+    )
+
+    custom_parser.add_argument(
+        "--profiles",
+        help="JSON player profile store (see profiles.py) with the max velocity and position of "
+             "the players, used instead of the ones of this match"
+    )
+
+    custom_parser.add_argument(
+        "--teams",
+        nargs=2,
+        metavar=("HOME", "AWAY"),
+        help="Names of the home and away teams in the profile store (default: home away)"
+    )
+
+    custom_parser.add_argument(
+        "--metrics",
+        help="File where the progress metrics are written while the half runs (.prom for the "
+             "Prometheus textfile format, JSON lines otherwise). Can contain {match} and {worker}"
+    )
+
+    custom_parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=10.,
+        help="Seconds between two writes of the progress metrics"
+    )
+
+    return custom_parser.parse_args(args)
+
+
+def parse_batch_args(args=sys.argv[1:]):
+    custom_parser = argparse.ArgumentParser(
+        description="Calculate one half of every match in a directory or glob pattern")
+
+    custom_parser.add_argument(
+        "matches",
+        help="Directory with the match files (.csv or .npz) or glob pattern, "
+             "e.g. 'data/processed/*.csv'"
+    )
+
+    custom_parser.add_argument(
+        "-o",
+        "--one-half",
+        type=int,
+        required=True,
+        help="Number of frames between each pitch control computation"
+    )
+
+    custom_parser.add_argument(
+        "-iv",
+        "--include-velocities",
+        action=argparse.BooleanOptionalAction,
+        help="Use individual max velocities"
+    )
+
+    custom_parser.add_argument(
+        "-sh",
+        "--stamine-home",
+        type=float,
+        help="Apply a stamine factor to the home team"
+    )
+
+    custom_parser.add_argument(
+        "-sa",
+        "--stamine-away",
+        type=float,
+        help="Apply a stamine factor to the away team"
+    )
+
+    custom_parser.add_argument(
+        "-pos",
+        "--position-increase",
+        type=str,
+        nargs='+',
+        help="Increase the velocities only for the positions given"
+    )
+
+    custom_parser.add_argument(
+        "-e",
+        "--engine",
+        choices=ENGINES,
+        default='reference',
+        help="Engine used to solve the pitch control model"
+    )
+
+    custom_parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        help="Maximum number of matches running at the same time (default: number of CPUs)"
+    )
+
+    custom_parser.add_argument(
+        "-r",
+        "--retries",
+        type=int,
+        default=2,
+        help="Times a failed match is run again"
+    )
+
+    custom_parser.add_argument(
+        "-f",
+        "--force",
+        action=argparse.BooleanOptionalAction,
+        help="Run the matches even if their result is already in results/"
+    )
+
+    custom_parser.add_argument(
+        "--manifest",
+        help="JSON file with the outcome and timing of each match "
+             "(default: results/manifest_<date>.json)"
+    )
+
+    custom_parser.add_argument(
+        "--metrics",
+        help="File where each match writes its progress metrics (see main.py --metrics), "
+             "e.g. 'metrics/{match}.prom'"
+    )
+
+    return custom_parser.parse_args(args)
+
+
+def parse_cluster_args(args=sys.argv[1:]):
+    custom_parser = argparse.ArgumentParser(
+        description="Distribute the halves of many matches among workers on several hosts "
+                    "through a job queue in a shared directory")
+    subparsers = custom_parser.add_subparsers(dest="command", required=True)
+
+    submit_parser = subparsers.add_parser("submit", help="Add matches to the queue")
+    submit_parser.add_argument(
+        "queue",
+        help="Directory of the queue, on storage shared by all the hosts"
+    )
+    submit_parser.add_argument(
+        "matches",
+        help="Directory with the match files (.csv or .npz) or glob pattern, "
+             "e.g. 'data/processed/*.csv'"
+    )
+    submit_parser.add_argument(
+        "-o",
+        "--one-half",
+        type=int,
+        required=True,
+        help="Number of frames between each pitch control computation"
+    )
+    submit_parser.add_argument(
+        "-iv",
+        "--include-velocities",
+        action=argparse.BooleanOptionalAction,
+        help="Use individual max velocities"
+    )
+    submit_parser.add_argument(
+        "-sh",
+        "--stamine-home",
+        type=float,
+        help="Apply a stamine factor to the home team"
+    )
+    submit_parser.add_argument(
+        "-sa",
+        "--stamine-away",
+        type=float,
+        help="Apply a stamine factor to the away team"
+    )
+    submit_parser.add_argument(
+        "-pos",
+        "--position-increase",
+        type=str,
+        nargs='+',
+        help="Increase the velocities only for the positions given"
+    )
+    submit_parser.add_argument(
+        "-e",
+        "--engine",
+        choices=ENGINES,
+        default='reference',
+        help="Engine used to solve the pitch control model"
+    )
+    submit_parser.add_argument(
+        "--parts",
+        type=int,
+        default=1,
+        help="Split each half in this number of frame ranges, which are merged by 'merge'"
+    )
+    submit_parser.add_argument(
+        "--results",
+        default='results',
+        help="Directory where the one_half_* results are written (default: results)"
+    )
+    submit_parser.add_argument(
+        "-f",
+        "--force",
+        action=argparse.BooleanOptionalAction,
+        help="Add the matches even if their result already exists"
+    )
+    submit_parser.add_argument(
+        "--lease-timeout",
+        type=float,
+        default=300.,
+        help="Seconds without heartbeat after which a task is taken from its worker "
+             "(only used when the queue is created)"
+    )
+    submit_parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=3,
+        help="Attempts of a task before it is marked as failed (only used when the queue is "
+             "created)"
+    )
+
+    work_parser = subparsers.add_parser("work", help="Run tasks until the queue is finished")
+    work_parser.add_argument(
+        "queue",
+        help="Directory of the queue"
+    )
+    work_parser.add_argument(
+        "--worker",
+        help="Name of the worker (default: <host>-<pid>)"
+    )
+    work_parser.add_argument(
+        "--heartbeat",
+        type=float,
+        default=30.,
+        help="Seconds between two heartbeats of the running task"
+    )
+    work_parser.add_argument(
+        "--poll",
+        type=float,
+        default=10.,
+        help="Seconds to wait when the remaining tasks are running in other workers"
+    )
+
+    local_parser = subparsers.add_parser(
+        "local", help="Run several workers on this machine and merge the results")
+    local_parser.add_argument(
+        "queue",
+        help="Directory of the queue"
+    )
+    local_parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        help="Number of workers (default: number of CPUs)"
+    )
+    local_parser.add_argument(
+        "--heartbeat",
+        type=float,
+        default=30.,
+        help="Seconds between two heartbeats of the running task"
+    )
+
+    merge_parser = subparsers.add_parser(
+        "merge", help="Merge the frame ranges of the finished matches into their results")
+    merge_parser.add_argument(
+        "queue",
+        help="Directory of the queue"
+    )
+    merge_parser.add_argument(
+        "--wait",
+        action=argparse.BooleanOptionalAction,
+        help="Wait until every task of the queue is done or failed"
+    )
+
+    status_parser = subparsers.add_parser("status", help="Show the state of every task")
+    status_parser.add_argument(
+        "queue",
+        help="Directory of the queue"
+    )
+
+    return custom_parser.parse_args(args)
+
+
+def parse_profiles_args(args=sys.argv[1:]):
+    custom_parser = argparse.ArgumentParser(
+        description="Add the player velocities of some matches to a player profile store")
+
+    custom_parser.add_argument(
+        "store",
+        help="JSON file of the store, created if it does not exist"
+    )
+
+    custom_parser.add_argument(
+        "matches",
+        nargs='*',
+        help="Directories with match files (.csv or .npz) or glob patterns, "
+             "e.g. 'data/processed/*.csv'"
+    )
+
+    custom_parser.add_argument(
+        "-t",
+        "--teams",
+        help="CSV with the columns match, home and away with the team names of each match. "
+             "Without it the teams are named home and away"
+    )
+
+    custom_parser.add_argument(
+        "-l",
+        "--lineups",
+        help="CSV with the columns team, jersey and position with the position of the players"
+    )
+
+    custom_parser.add_argument(
+        "--merge",
+        nargs='+',
+        help="Other stores (e.g. built on other hosts) merged into this one"
+    )
+
+    custom_parser.add_argument(
+        "--memory-limit",
+        type=float,
+        help="Read each match in chunks that fit in this number of MB (default: 512)"
+    )
+
+    custom_parser.add_argument(
+        "--show",
+        action=argparse.BooleanOptionalAction,
+        help="Print the profile of every player of the store"
+    )
+
+    return custom_parser.parse_args(args)
+
+
+def parse_ingest_args(args=sys.argv[1:]):
+    custom_parser = argparse.ArgumentParser(
+        description="Convert a raw Tracab frame file (.dat) and its metadata XML into a match of "
+                    "data/processed")
+
+    custom_parser.add_argument(
+        "dat",
+        help="Tracab frame file"
+    )
+
+    custom_parser.add_argument(
+        "output",
+        help="Converted match, .csv or .npz (binary, float32), e.g. data/processed/match_10748.npz"
+    )
+
+    custom_parser.add_argument(
+        "-x",
+        "--metadata",
+        help="Tracab metadata XML with the pitch size, the periods and the players of the match"
+    )
+
+    custom_parser.add_argument(
+        "--period",
+        type=int,
+        help="Convert only this period (e.g. 1 for the first half)"
+    )
+
     return custom_parser.parse_args(args)
@@ -0,0 +1,48 @@
+from parser import parse_profiles_args
+from src.batch import runner
+
+# Builds or updates a store with the velocity profile of each player across matches, which the
+# runs use instead of the velocities of a single match:
+#   python profiles.py results/profiles.json data/processed -t data/teams.csv -l data/lineups.csv
+#   python main.py match_10748 -o 25 -iv --profiles results/profiles.json --teams Home Away
+
+
+def add_matches(store, matches, teams, positions, memory_limit=None):
+    """Adds the velocities of each match to the store, returning the number of new matches"""
+    from src.data import chunked
+
+    added = 0
+    for match in matches:
+        if match.stem in store.matches:
+            print(f'{match.stem} is already in the store')
+            continue
+        if teams and match.stem not in teams:
+            print(f'{match.stem} is not in the teams file, its teams are named home and away')
+        chunk_rows = chunked.rows_per_chunk(match, memory_limit or chunked.DEFAULT_MEMORY_LIMIT)
+        store.add_match(match.stem, chunked.read_prepared_chunks(match, chunk_rows),
+                        (teams or {}).get(match.stem), positions)
+        added += 1
+        print(f'Added {match.stem}')
+    return added
+
+
+if __name__ == "__main__":
+    args = parse_profiles_args()
+
+    from src.data import profiles
+
+    store = profiles.ProfileStore(args.store)
+    matches = [match for source in args.matches for match in runner.find_matches(source)]
+    if args.matches and not matches:
+        exit(f'No matches found in {" ".join(args.matches)}')
+    teams = profiles.read_teams(args.teams) if args.teams else None
+    positions = profiles.read_positions(args.lineups) if args.lineups else None
+
+    added = add_matches(store, matches, teams, positions, args.memory_limit)
+    for other in args.merge or []:
+        store.merge(profiles.ProfileStore(other))
+    store.save()
+    print(f'{added} matches added, {len(store.matches)} matches and {len(store)} players '
+          f'in {args.store}')
+    if args.show:
+        print(store.to_dataframe().to_string(index=False))
@@ -0,0 +1,333 @@
+"""
+Job queue stored in a directory on shared storage (NFS, a mounted bucket...), so that workers on
+any number of hosts can take tasks from it without a server.
+
+    <queue>/config.json           lease timeout and maximum attempts of the queue
+    <queue>/tasks/<id>.json       description of each task
+    <queue>/leases/<id>.lease     the task is running: worker and token of the owner. The
+                                  modification time is the last heartbeat
+    <queue>/attempts/<id>.*.json  one file per failed or expired attempt
+    <queue>/done/<id>.json        the task finished: worker, time and result
+    <queue>/partials/             outputs written by the tasks (e.g. partial results)
+
+A lease is taken by hard linking a file written by the worker to the lease path, which fails if
+the lease already exists and is atomic on local filesystems and NFS. While the task runs the
+owner touches the lease every few seconds. Leases not touched for longer than the lease timeout
+belong to dead workers: any worker renames them away (only one rename can succeed), records the
+attempt and the task becomes pending again.
+"""
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+from src.instrumentation.metrics import default_worker
+
+LEASE_TIMEOUT = 300.
+HEARTBEAT_INTERVAL = 30.
+MAX_ATTEMPTS = 3
+
+
+class QueueError(Exception):
+    pass
+
+
+def write_json(path, data):
+    """Writes the file atomically, so that other hosts never read it half written"""
+    temporary = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.tmp')
+    with open(temporary, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(temporary, path)
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+class Lease:
+    """
+    Ownership of a running task by a worker
+
+    methods include:
+    -----------
+    holds(): whether the lease still belongs to this worker (it was not reclaimed)
+    heartbeat(): marks the lease as alive, returns False if it was lost
+    release(): deletes the lease
+    """
+
+    def __init__(self, queue, task_id, task, worker, token):
+        self.queue = queue
+        self.task_id = task_id
+        self.task = task
+        self.worker = worker
+        self.token = token
+        self.path = queue.lease_path(task_id)
+        self.start_time = time.time()
+
+    def holds(self):
+        try:
+            return read_json(self.path)['token'] == self.token
+        except (OSError, ValueError):
+            return False
+
+    def heartbeat(self):
+        if not self.holds():
+            return False
+        os.utime(self.path)
+        return True
+
+    def release(self):
+        if self.holds():
+            self.path.unlink(missing_ok=True)
+
+
+class JobQueue:
+    """
+    Queue of tasks in a shared directory, see the module documentation for the layout
+
+    __init__ Parameters
+    -----------
+    path: directory of the queue. It must have been created with JobQueue.create
+
+    methods include:
+    -----------
+    create(path, lease_timeout, max_attempts): creates the directory of a new queue
+    add(task_id, task): adds a task (a JSON serializable dictionary) if it is not in the queue
+    tasks(): dictionary id -> task
+    state(task_id): 'pending', 'running', 'done' or 'failed'
+    status(): state, attempts and worker of every task
+    claim(worker): takes a pending task, returning its Lease or None
+    complete(lease, result): marks the task as done
+    fail(lease, error): records a failed attempt and releases the task
+    reclaim_stale(): releases the leases of dead workers
+    finished(): whether every task is done or failed
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        config_file = self.path / 'config.json'
+        if not config_file.exists():
+            raise QueueError(f'{self.path} is not a job queue')
+        config = read_json(config_file)
+        self.lease_timeout = config['lease_timeout']
+        self.max_attempts = config['max_attempts']
+
+    @classmethod
+    def create(cls, path, lease_timeout=LEASE_TIMEOUT, max_attempts=MAX_ATTEMPTS):
+        """Creates the queue, or opens it if it already exists"""
+        path = Path(path)
+        for directory in ('tasks', 'leases', 'attempts', 'done', 'partials'):
+            (path / directory).mkdir(parents=True, exist_ok=True)
+        if not (path / 'config.json').exists():
+            write_json(path / 'config.json', {'lease_timeout': lease_timeout,
+                                              'max_attempts': max_attempts})
+        return cls(path)
+
+    def task_path(self, task_id):
+        return self.path / 'tasks' / f'{task_id}.json'
+
+    def lease_path(self, task_id):
+        return self.path / 'leases' / f'{task_id}.lease'
+
+    def done_path(self, task_id):
+        return self.path / 'done' / f'{task_id}.json'
+
+    def add(self, task_id, task):
+        if self.task_path(task_id).exists():
+            return False
+        write_json(self.task_path(task_id), task)
+        return True
+
+    def tasks(self):
+        return {path.stem: read_json(path) for path in sorted((self.path / 'tasks').glob('*.json'))}
+
+    def attempts(self, task_id):
+        # The ids can contain dots, so the token is split from the right
+        return [read_json(path) for path in (self.path / 'attempts').glob(f'{task_id}.*.json')
+                if path.name[:-len('.json')].rsplit('.', 1)[0] == task_id]
+
+    def state(self, task_id):
+        if self.done_path(task_id).exists():
+            return 'done'
+        if self.lease_path(task_id).exists():
+            return 'running'
+        if len(self.attempts(task_id)) >= self.max_attempts:
+            return 'failed'
+        return 'pending'
+
+    def status(self):
+        status = {}
+        for task_id in self.tasks():
+            state = self.state(task_id)
+            entry = {'state': state, 'attempts': len(self.attempts(task_id)), 'worker': None}
+            try:
+                if state == 'done':
+                    entry.update(read_json(self.done_path(task_id)))
+                elif state == 'running':
+                    entry['worker'] = read_json(self.lease_path(task_id))['worker']
+            except (OSError, ValueError):
+                # The task changed state while it was read
+                pass
+            status[task_id] = entry
+        return status
+
+    def finished(self):
+        return all(self.state(task_id) in ('done', 'failed') for task_id in self.tasks())
+
+    def claim(self, worker=None):
+        worker = worker or default_worker()
+        self.reclaim_stale()
+        for task_id, task in self.tasks().items():
+            if self.state(task_id) != 'pending':
+                continue
+            lease = self.take_lease(task_id, task, worker)
+            if lease is None:
+                continue
+            # The task could have finished between the check of its state and the lease
+            if self.done_path(task_id).exists():
+                lease.release()
+                continue
+            return lease
+        return None
+
+    def take_lease(self, task_id, task, worker):
+        token = uuid.uuid4().hex
+        temporary = self.path / 'leases' / f'.{task_id}.{token}.tmp'
+        write_json(temporary, {'worker': worker, 'token': token,
+                               'claimed': datetime.now().isoformat(timespec='seconds')})
+        try:
+            os.link(temporary, self.lease_path(task_id))
+        except FileExistsError:
+            return None
+        finally:
+            temporary.unlink()
+        return Lease(self, task_id, task, worker, token)
+
+    def reclaim_stale(self):
+        """Releases the leases that have not received a heartbeat within the lease timeout"""
+        now = time.time()
+        for path in (self.path / 'leases').glob('*.lease'):
+            try:
+                if now - path.stat().st_mtime <= self.lease_timeout:
+                    continue
+                stale = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.stale')
+                os.rename(path, stale)
+            except FileNotFoundError:
+                # Released or reclaimed by someone else
+                continue
+            if time.time() - stale.stat().st_mtime <= self.lease_timeout:
+                # Another worker reclaimed the lease and took the task after the check, so the
+                # renamed lease is alive and is put back
+                try:
+                    os.link(stale, path)
+                except FileExistsError:
+                    pass
+                stale.unlink()
+                continue
+            try:
+                owner = read_json(stale)
+            except (OSError, ValueError):
+                owner = {'worker': None, 'token': uuid.uuid4().hex}
+            self.record_attempt(path.stem, owner['worker'], owner['token'],
+                                f'lease expired (no heartbeat for {self.lease_timeout:.0f} s)')
+            stale.unlink(missing_ok=True)
+            print(f'Reclaimed {path.stem} from {owner["worker"]}')
+
+    def record_attempt(self, task_id, worker, token, error):
+        write_json(self.path / 'attempts' / f'{task_id}.{token}.json',
+                   {'worker': worker, 'error': error,
+                    'time': datetime.now().isoformat(timespec='seconds')})
+
+    def complete(self, lease, result=None):
+        """Marks the task as done. Returns False if the lease was lost, in which case the task
+        belongs to another worker and the result is discarded"""
+        if not lease.holds():
+            return False
+        write_json(self.done_path(lease.task_id),
+                   {'worker': lease.worker, 'elapsed_s': time.time() - lease.start_time,
+                    'result': result, 'finished': datetime.now().isoformat(timespec='seconds')})
+        lease.release()
+        return True
+
+    def fail(self, lease, error):
+        if not lease.holds():
+            return
+        self.record_attempt(lease.task_id, lease.worker, lease.token, error)
+        lease.release()
+
+
+@contextmanager
+def keep_alive(lease, interval=HEARTBEAT_INTERVAL):
+    """Sends heartbeats for the lease from a background thread while the block runs"""
+    stop = threading.Event()
+
+    def beat():
+        lost = False
+        while not stop.wait(interval):
+            # A lease can be missing for a moment while another worker checks it, so the
+            # heartbeats go on after a failure
+            alive = lease.heartbeat()
+            if not alive and not lost:
+                print(f'Lost the lease of {lease.task_id}')
+            lost = not alive
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def work(queue, handler, worker=None, heartbeat_interval=HEARTBEAT_INTERVAL, poll_interval=10.,
+         max_tasks=None):
+    """
+    Takes tasks from the queue and runs them until every task is done or failed
+
+    Parameters
+    -----------
+    queue: JobQueue
+    handler: function(task_id, task, queue) that runs a task and returns a JSON serializable
+        result. Exceptions mark the attempt as failed
+    worker: name of the worker. Default is <host>-<pid>
+    heartbeat_interval: seconds between two heartbeats, well below the lease timeout
+    poll_interval: seconds to wait when the remaining tasks are running in other workers. The
+        worker keeps polling to take over the tasks of workers that die
+    max_tasks: stop after running this number of tasks
+
+    Returns
+    -----------
+    Number of tasks completed by the worker
+    """
+    worker = worker or default_worker()
+    if heartbeat_interval >= queue.lease_timeout:
+        raise QueueError(f'The heartbeat interval ({heartbeat_interval} s) must be shorter than '
+                         f'the lease timeout ({queue.lease_timeout} s)')
+    completed = 0
+    while max_tasks is None or completed < max_tasks:
+        lease = queue.claim(worker)
+        if lease is None:
+            if queue.finished():
+                break
+            time.sleep(poll_interval)
+            continue
+        print(f'{worker} running {lease.task_id}')
+        try:
+            with keep_alive(lease, heartbeat_interval):
+                result = handler(lease.task_id, lease.task, queue)
+        except Exception as e:
+            error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+            print(f'{lease.task_id} failed in {worker}: {error}')
+            queue.fail(lease, error)
+        else:
+            if queue.complete(lease, result):
+                completed += 1
+                print(f'{lease.task_id} done in {time.time() - lease.start_time:.1f} s')
+    return completed
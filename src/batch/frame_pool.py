@@ -0,0 +1,125 @@
+"""
+Runs the frames of one half on a pool of processes. The tracking data is placed once in shared
+memory (see src/data/shared_tracking.py) and the tasks only carry a range of frames, each worker
+returning the PartialContributions of its range, which are merged in order.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from src.data.analysis import (PartialContributions, RunningContributions,
+                               merge_partial_contributions)
+from src.data.shared_tracking import SharedTracking, TrackingArrays
+from src.instrumentation.profiler import NULL_PROFILER, Profiler
+from src.pitch_control.precision import PrecisionDeviation
+
+# State of each worker process, set by init_worker
+worker_state = {}
+
+
+def init_worker(descriptor, pitch_control):
+    worker_state['shared'] = SharedTracking.attach(descriptor)
+    # The counters of the model are collected by the workers when the run is profiled or
+    # exports metrics, see run_range
+    worker_state['profiling'] = pitch_control.profiler.enabled
+    pitch_control.profiler = NULL_PROFILER
+    worker_state['pitch_control'] = pitch_control
+
+
+def run_range(start, stop, weights=None):
+    """Runs the frames [start, stop) of the shared tracking data in a worker, returning their
+    PartialContributions, the deviation from float64 of the frames checked in the range (None
+    in float64, see src/pitch_control/precision.py) and the Profiler with the counters of the
+    range (None if the run is not profiled)"""
+    pitch_control = worker_state['pitch_control']
+    if pitch_control.precision_deviation is not None:
+        pitch_control.precision_deviation = PrecisionDeviation(
+            pitch_control.precision_deviation.check_interval)
+    if worker_state['profiling']:
+        pitch_control.profiler = Profiler()
+    partial = run_tracking_range(pitch_control, worker_state['shared'].tracking, start, stop,
+                                 weights)
+    profiler = pitch_control.profiler if worker_state['profiling'] else None
+    return partial, pitch_control.precision_deviation, profiler
+
+
+def run_tracking_range(pitch_control, tracking, start, stop, weights=None):
+    """Runs the frames [start, stop) from scratch and returns their PartialContributions
+
+    weights: optional number of frames that each frame of the range stands for
+    """
+    pitch_control.reset_contributions()
+    if start == stop:
+        return PartialContributions.zeros(pitch_control.get_individual_contributions())
+    pitch_control.profiler.count('frames', int(stop - start))
+    if pitch_control.aggregates_only:
+        running = RunningContributions(pitch_control.get_individual_contributions())
+        for k, index in enumerate(range(start, stop)):
+            pitch_control.generate_pitch_control_for_arrays(tracking, index)
+            running.add_frame(pitch_control.get_accumulated_contributions(),
+                              1 if weights is None else weights[k])
+        return running.to_partial()
+    PPCF_array = []
+    for index in range(start, stop):
+        pitch_control.generate_pitch_control_for_arrays(tracking, index)
+        PPCF_array.append(pitch_control.get_individual_contributions())
+    if weights is not None:
+        return PartialContributions.from_weighted_frames(PPCF_array, weights)
+    return PartialContributions.from_frames(PPCF_array)
+
+
+def split_frames(n_frames, n_ranges):
+    """Returns n_ranges consecutive (start, stop) ranges covering n_frames"""
+    n_ranges = max(1, min(n_ranges, n_frames))
+    bounds = [round(i * n_frames / n_ranges) for i in range(n_ranges + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def run_frames_parallel(pitch_control, df, workers=None, ranges_per_worker=4, metrics=None,
+                        weights=None):
+    """
+    Runs every frame of the dataframe on a pool of processes
+
+    Parameters
+    -----------
+    pitch_control: PitchControl used as template by the workers. It is sent once to each worker
+        and its accumulated contributions are ignored
+    df: prepared tracking dataframe
+    workers: number of processes. Default is the number of CPUs
+    ranges_per_worker: the frames are split in workers * ranges_per_worker ranges, so that the
+        workers that finish early take more work
+    metrics: optional MetricsExporter updated as the ranges finish
+    weights: optional number of frames that each frame stands for (see src/data/sampling.py)
+
+    Returns
+    -----------
+    PartialContributions of all the frames, the same result as running them in order
+    """
+    workers = workers or os.cpu_count()
+    ranges = split_frames(len(df), workers * ranges_per_worker)
+    return merge_partial_contributions(run_ranges_parallel(pitch_control, df, ranges, workers,
+                                                           metrics, weights))
+
+
+def run_ranges_parallel(pitch_control, df, ranges, workers=None, metrics=None, weights=None):
+    """Runs the given (start, stop) ranges of rows of the dataframe on a pool of processes
+    (see run_frames_parallel), returning the PartialContributions of each range. The deviation
+    from float64 of the frames checked by the workers and their model counters are added to the
+    ones of pitch_control"""
+    workers = workers or os.cpu_count()
+    partials = [None] * len(ranges)
+    with SharedTracking.create(TrackingArrays.from_dataframe(df)) as shared:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(shared.descriptor(), pitch_control)) as executor:
+            futures = {executor.submit(run_range, start, stop,
+                                       None if weights is None else weights[start:stop]): i
+                       for i, (start, stop) in enumerate(ranges)}
+            for future in as_completed(futures):
+                i = futures[future]
+                partials[i], deviation, profiler = future.result()
+                if deviation is not None:
+                    pitch_control.precision_deviation.merge(deviation)
+                if profiler is not None:
+                    pitch_control.profiler.merge(profiler)
+                if metrics is not None:
+                    metrics.update(ranges[i][1] - ranges[i][0])
+    return partials
@@ -0,0 +1,157 @@
+"""
+Runs many independent tasks (e.g. one half of each match of a season) on a pool of processes,
+skipping the ones that are already done, retrying the failures and writing a manifest with the
+outcome and timing of every task.
+"""
+import glob
+import json
+import os
+import socket
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from pathlib import Path
+
+
+# Extensions of the match files, the first one is used when a match has both (as in main.py)
+MATCH_EXTENSIONS = ('.csv', '.npz')
+
+
+def find_matches(source, extensions=MATCH_EXTENSIONS):
+    """Returns the match files in a directory or matching a glob pattern, one per match"""
+    path = Path(source)
+    if path.is_dir():
+        paths = [p for extension in extensions for p in path.glob(f'*{extension}')]
+    else:
+        paths = [Path(p) for p in glob.glob(source)]
+    matches = {}
+    for p in sorted(paths, key=lambda p: extensions.index(p.suffix)
+                    if p.suffix in extensions else len(extensions)):
+        matches.setdefault(p.with_suffix(''), p)
+    return sorted(matches.values())
+
+
+def timed_call(function, kwargs):
+    """Runs the function in the worker, returning its result, the time spent and the worker"""
+    start = time.perf_counter()
+    result = function(**kwargs)
+    return result, time.perf_counter() - start, f'{socket.gethostname()}-{os.getpid()}'
+
+
+def run_batch(tasks, function, workers=None, retries=2, manifest_path=None, is_done=None,
+              options=None):
+    """
+    Runs function(**kwargs) for every task on a pool of processes
+
+    Parameters
+    -----------
+    tasks: dictionary name -> kwargs of the function
+    function: function to run for each task. It must be importable by the workers (defined at
+        module level)
+    workers: maximum number of tasks running at the same time. Default is the number of CPUs
+    retries: number of times a failed task is submitted again
+    manifest_path: JSON file with the outcome of each task, updated as tasks finish
+    is_done: optional function(name, kwargs) returning the existing output of a task that does
+        not have to run again, or None
+    options: dictionary stored in the manifest to describe the batch
+
+    Returns
+    -----------
+    The manifest, a dictionary with one entry per task with its status ('done', 'skipped' or
+    'failed'), attempts, time, worker, output and error
+    """
+    workers = workers or os.cpu_count()
+    manifest = {
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'finished': None,
+        'workers': workers,
+        'retries': retries,
+        'options': options or {},
+        'tasks': {name: {'status': 'pending', 'attempts': 0, 'elapsed_s': None, 'worker': None,
+                         'output': None, 'error': None} for name in tasks}
+    }
+
+    pending = []
+    for name, kwargs in tasks.items():
+        existing = is_done(name, kwargs) if is_done is not None else None
+        if existing is not None:
+            manifest['tasks'][name].update(status='skipped', output=str(existing))
+        else:
+            pending.append(name)
+    save_manifest(manifest, manifest_path)
+
+    executor = ProcessPoolExecutor(max_workers=workers)
+    # Future -> name of the task and pool that runs it
+    futures = {}
+
+    def submit(name):
+        nonlocal executor
+        manifest['tasks'][name]['attempts'] += 1
+        manifest['tasks'][name]['status'] = 'running'
+        try:
+            future = executor.submit(timed_call, function, tasks[name])
+        except BrokenProcessPool:
+            executor = replace_pool(executor, workers)
+            future = executor.submit(timed_call, function, tasks[name])
+        futures[future] = (name, executor)
+
+    try:
+        for name in pending:
+            submit(name)
+        while futures:
+            future = next(as_completed(futures))
+            name, pool = futures.pop(future)
+            entry = manifest['tasks'][name]
+            try:
+                output, elapsed, worker = future.result()
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool) and pool is executor:
+                    # A worker exited abruptly (e.g. killed for lack of memory) and the pool can
+                    # not run more tasks. The tasks that were running in it fail with this same
+                    # error and are submitted again to a new pool
+                    executor = replace_pool(executor, workers)
+                entry['error'] = ''.join(traceback.format_exception_only(type(e), e)).strip()
+                if entry['attempts'] <= retries:
+                    print(f'{name} failed ({entry["error"]}), retrying')
+                    submit(name)
+                else:
+                    entry['status'] = 'failed'
+                    print(f'{name} failed after {entry["attempts"]} attempts')
+            else:
+                entry.update(status='done', elapsed_s=elapsed, worker=worker,
+                             output=str(output) if output is not None else None, error=None)
+                print(f'{name} done in {elapsed:.1f} s')
+            save_manifest(manifest, manifest_path)
+    finally:
+        executor.shutdown()
+
+    manifest['finished'] = datetime.now().isoformat(timespec='seconds')
+    save_manifest(manifest, manifest_path)
+    return manifest
+
+
+def replace_pool(executor, workers):
+    """Returns a new pool of processes in place of a broken one"""
+    executor.shutdown(wait=False, cancel_futures=True)
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+def summary(manifest):
+    """Number of tasks with each status"""
+    counts = {}
+    for entry in manifest['tasks'].values():
+        counts[entry['status']] = counts.get(entry['status'], 0) + 1
+    return counts
+
+
+def save_manifest(manifest, manifest_path):
+    if manifest_path is None:
+        return
+    manifest_path = Path(manifest_path)
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = manifest_path.with_name(manifest_path.name + '.tmp')
+    with open(temporary, 'w') as f:
+        json.dump(dict(manifest, summary=summary(manifest)), f, indent=2)
+    os.replace(temporary, manifest_path)
@@ -1,5 +1,6 @@
 import pickle
 from pathlib import Path
+import numpy as np
 import pandas as pd
 
 
@@ -14,3 +15,151 @@ def sum_mutiple_frames_contributions(match, frames):
     result_df = PPCF_concatenated.groupby(['id', 'team'])['PPCF'].sum().reset_index()
     filename = Path('analysis') / f'single_frame_{match}_contributions.csv'
     result_df.to_csv(filename, index=False)
+
+
+def contribution_columns(contributions):
+    """Returns the columns of the contributions: the total (PPCF) and the ones of each zone of the
+    zone map, e.g. PPCF_attacking_first_zone (see src/pitch_control/zones.py)"""
+    return [column for column in contributions.columns if column.startswith('PPCF')]
+
+
+def sum_contributions(PPCF_array):
+    """Sums by player the individual contributions saved after each frame"""
+    PPCF_concatenated = pd.concat(PPCF_array, ignore_index=True)
+    return PPCF_concatenated.groupby(['id', 'team'])[contribution_columns(PPCF_array[0])].sum()
+
+
+class PartialContributions:
+    """
+    Result of one half over a range of consecutive frames, which can be merged with the result
+    of the following range to get the same result as a single run over both.
+
+    The players accumulate their contributions and the result of a half is the sum, over the
+    frames, of these accumulated values. A range computed from scratch therefore misses the
+    contributions accumulated before it: a range of nB frames that starts after a range with
+    total TA adds nB * TA to the result. Merging A followed by B gives
+        frames = nA + nB
+        total = TA + TB
+        running_sum = SA + SB + nB * TA
+
+    __init__ Parameters
+    -----------
+    running_sum: dataframe indexed by (id, team) with the sum over the frames of the
+        accumulated contributions
+    total: dataframe indexed by (id, team) with the contributions accumulated after the last frame
+    frames: number of frames of the range
+
+    methods include:
+    -----------
+    from_frames(PPCF_array): creates it from the contributions saved after each frame
+    from_weighted_frames(PPCF_array, weights): same for sampled frames that stand for several
+    zeros(contributions): creates an empty range for the players of the dataframe
+    merge(following): merges with the range that follows this one
+    to_dataframe(): returns the contributions in the format of calculate_one_half
+    """
+
+    def __init__(self, running_sum, total, frames):
+        self.running_sum = running_sum
+        self.total = total
+        self.frames = frames
+
+    @classmethod
+    def from_frames(cls, PPCF_array):
+        total = PPCF_array[-1].set_index(['id', 'team'])[contribution_columns(PPCF_array[-1])]
+        return cls(sum_contributions(PPCF_array), total.sort_index(), len(PPCF_array))
+
+    @classmethod
+    def from_weighted_frames(cls, PPCF_array, weights):
+        """
+        Creates it from the contributions saved after each of some sampled frames, where the
+        k-th frame stands for weights[k] frames with its same contributions. Each one is a range
+        of w frames with a contribution d per frame (frames = w, total = w * d and
+        running_sum = d * w * (w + 1) / 2) and the ranges are merged in order. With weights of 1
+        it is the same as from_frames
+        """
+        index = PPCF_array[0].set_index(['id', 'team']).index
+        columns = contribution_columns(PPCF_array[0])
+        accumulated = np.stack([frame.set_index(['id', 'team']).reindex(index)[columns].values
+                                for frame in PPCF_array])
+        # Contributions of each frame and the ones accumulated before each range
+        deltas = np.diff(accumulated, axis=0, prepend=0.)
+        weights = np.asarray(weights, dtype=float)[:, None, None]
+        totals = np.cumsum(weights * deltas, axis=0)
+        previous = totals - weights * deltas
+        running_sum = (deltas * weights * (weights + 1) / 2 + weights * previous).sum(axis=0)
+
+        def to_dataframe(values):
+            return pd.DataFrame(values, index=index, columns=columns).sort_index()
+
+        return cls(to_dataframe(running_sum), to_dataframe(totals[-1]), int(weights.sum()))
+
+    @classmethod
+    def zeros(cls, contributions):
+        zeros = contributions.set_index(['id', 'team'])[
+            contribution_columns(contributions)].sort_index() * 0.
+        return cls(zeros, zeros.copy(), 0)
+
+    def merge(self, following):
+        running_sum = self.running_sum.add(following.running_sum, fill_value=0.).add(
+            self.total * following.frames, fill_value=0.)
+        total = self.total.add(following.total, fill_value=0.)
+        return PartialContributions(running_sum, total, self.frames + following.frames)
+
+    def to_dataframe(self):
+        return self.running_sum.reset_index()
+
+
+class RunningContributions:
+    """
+    Running sum over the frames of the contributions accumulated by the players, updated in
+    place after each frame with the arrays of PitchControl.get_accumulated_contributions instead
+    of saving a dataframe per frame. Each frame is merged as a range of weight frames, as in
+    PartialContributions.from_weighted_frames, so the memory does not grow with the frames
+
+    __init__ Parameters
+    -----------
+    contributions: dataframe of PitchControl.get_individual_contributions, which gives the
+        players and the columns in the order of the arrays
+
+    methods include:
+    -----------
+    add_frame(accumulated, weight): adds the contributions accumulated after a frame
+    to_partial(): returns the PartialContributions of the frames added
+    """
+
+    def __init__(self, contributions):
+        self.index = contributions.set_index(['id', 'team']).index
+        self.columns = contribution_columns(contributions)
+        shape = (len(self.index), len(self.columns))
+        # Contributions accumulated by the players after the last frame
+        self.accumulated = np.zeros(shape)
+        self.total = np.zeros(shape)
+        self.running_sum = np.zeros(shape)
+        self.frames = 0
+
+    def add_frame(self, accumulated, weight=1):
+        """
+        accumulated: array (n_players, n_columns) with the contributions accumulated by the
+            players after the frame
+        weight: number of frames that the frame stands for, with its same contributions
+        """
+        delta = accumulated - self.accumulated
+        self.running_sum += delta * (weight * (weight + 1) / 2) + weight * self.total
+        self.total += weight * delta
+        self.accumulated = accumulated
+        self.frames += weight
+
+    def to_partial(self):
+        def to_dataframe(values):
+            return pd.DataFrame(values, index=self.index, columns=self.columns).sort_index()
+
+        return PartialContributions(to_dataframe(self.running_sum), to_dataframe(self.total),
+                                    int(self.frames))
+
+
+def merge_partial_contributions(partials):
+    """Merges a list of PartialContributions of consecutive ranges, in order"""
+    merged = partials[0]
+    for partial in partials[1:]:
+        merged = merged.merge(partial)
+    return merged
@@ -0,0 +1,180 @@
+"""
+Out-of-core processing of a whole match. The CSV is read in chunks of rows whose size comes from
+a memory limit, so the peak memory does not depend on the length of the match:
+1. a first pass computes the velocities chunk by chunk and feeds the streaming estimator of the
+   percentile velocity of each player (only with individual velocities)
+2. a second pass prepares the chunks again and hands the sampled frames of each one to the
+   pitch control model
+
+The velocities of a frame only depend on its neighbours, so each chunk is extended with CONTEXT
+rows of the previous and following chunks and gets the same velocities as the whole match.
+"""
+import numpy as np
+import pandas as pd
+
+from src.data import utils
+from src.data.quantiles import TDigest
+from src.instrumentation.profiler import NULL_PROFILER
+from src.pitch_control import velocities
+
+# Memory limit in MB used when none is given
+DEFAULT_MEMORY_LIMIT = 512
+
+# Rows of the neighbouring chunks added to each side of a chunk. The velocities need the previous
+# row and the smoothing filters half of their window (7 frames) on each side
+CONTEXT = 8
+
+# Compression of the t-digests of the velocities. On full length matches the percentile
+# velocities are within 0.02 m/s of the exact ones (0.04 m/s with 200) using about 4 KB per player
+VMAX_COMPRESSION = 500
+
+# Copies of a chunk alive at the same time while it is prepared (raw rows, rows with context,
+# velocity columns, their concatenation and the live ball rows), measured on full length matches
+WORKING_COPIES = 9
+
+
+def rows_per_chunk(filepath, memory_limit=DEFAULT_MEMORY_LIMIT, sample_rows=1000, compact=False):
+    """Number of rows of each chunk so that preparing it stays within memory_limit MB"""
+    sample = utils.read_tracking_csv(filepath, compact, nrows=sample_rows)
+    n_players = len(utils.get_jersey_team(sample))
+    # The values are stored in 8 bytes (4 in compact mode) and the velocities add 3 columns per
+    # player and the time
+    value_bytes = 4 if compact else 8
+    bytes_per_row = value_bytes * (sample.shape[1] + 3 * n_players) + 8
+    rows = int(memory_limit * 2 ** 20 / (bytes_per_row * WORKING_COPIES))
+    if rows < 4 * CONTEXT:
+        raise ValueError(f'A memory limit of {memory_limit} MB is too small for {filepath}, '
+                         f'it needs at least '
+                         f'{4 * CONTEXT * bytes_per_row * WORKING_COPIES / 2 ** 20:.1f} MB')
+    return rows
+
+
+def read_prepared_chunks(filepath, chunk_rows, profiler=None, compact=False):
+    """
+    Yields the live ball rows of the match chunk by chunk, with units and velocities as in
+    prepare_df (including its compact mode) and the same values as if the whole match was
+    prepared at once
+    """
+    profiler = profiler or NULL_PROFILER
+    with profiler.stage('load_csv'):
+        reader = utils.read_tracking_csv(filepath, compact, chunksize=chunk_rows)
+        current = next(reader, None)
+    previous = None
+    first_row = 0
+    while current is not None:
+        with profiler.stage('load_csv'):
+            following = next(reader, None)
+        parts = [previous, current, following.head(CONTEXT) if following is not None else None]
+        window = pd.concat([part for part in parts if part is not None], ignore_index=True)
+        start = len(previous) if previous is not None else 0
+
+        with profiler.stage('standardize_units'):
+            window = utils.standardize_units(window, first_row - start)
+        with profiler.stage('velocities'):
+            window = velocities.calculate_player_velocities(
+                window, dtype=np.float32 if compact else float)
+        chunk = window.iloc[start:start + len(current)]
+        chunk.index = current.index
+        if any(pd.isnull(chunk['frame'])):
+            exit(f'There are some NaNs in the frames utils!')
+        yield chunk[chunk['ball_status'] == 1]
+
+        previous = current.tail(CONTEXT)
+        first_row += len(current)
+        current = following
+
+
+def read_sampled_chunks(filepath, chunk_rows, frames_step=None, profiler=None, compact=False):
+    """Yields the frames of each chunk selected with frames_step, as prepare_df does with the
+    live ball rows of the whole match"""
+    live_rows = 0
+    for chunk in read_prepared_chunks(filepath, chunk_rows, profiler, compact):
+        sampled = chunk
+        if frames_step:
+            sampled = chunk.iloc[(-live_rows) % frames_step::frames_step]
+        live_rows += len(chunk)
+        yield sampled
+
+
+class StreamingVmax:
+    """
+    Percentiles of the velocity of each player estimated with a t-digest per player (see
+    src/data/quantiles.py) that is updated chunk by chunk, instead of keeping every velocity
+
+    __init__ Parameters
+    -----------
+    compression: accuracy of the digests, higher is more accurate and uses more memory
+
+    methods include:
+    -----------
+    update(chunk): adds the velocities of the players in a chunk with velocity columns
+    merge(other): adds the velocities seen by another estimator (e.g. of another worker)
+    percentile(team, jersey, q): estimated q-th percentile (0 to 100) of the player velocity
+    """
+
+    def __init__(self, compression=VMAX_COMPRESSION):
+        self.compression = compression
+        self.digests = {}
+
+    def digest(self, team, jersey):
+        key = (team, jersey)
+        if key not in self.digests:
+            self.digests[key] = TDigest(self.compression)
+        return self.digests[key]
+
+    def update(self, chunk):
+        for jersey, team in utils.get_jersey_team(chunk):
+            self.digest(team, jersey).update(chunk[f'{team}_{jersey}_total_v'].values)
+
+    def merge(self, other):
+        for (team, jersey), digest in other.digests.items():
+            self.digest(team, jersey).merge(digest)
+        return self
+
+    def percentile(self, team, jersey, q):
+        digest = self.digests.get((team, jersey))
+        return digest.percentile(q) if digest is not None else np.nan
+
+
+def prepare_match(filepath, chunk_rows, include_player_velocities=False, stamine_home=1.0,
+                  stamine_away=1.0, compression=VMAX_COMPRESSION, profiler=None, profiles=None,
+                  teams=None, compact=False, goalkeepers=None):
+    """
+    First pass over the match, the streaming counterpart of prepare_df (including its profiles,
+    teams, compact and goalkeepers options)
+
+    Returns
+    -----------
+    The first live ball frame (used to find the goalkeepers and initialize the teams) and the
+    dataframes with the max velocity and position of the players of each team
+    """
+    profiler = profiler or NULL_PROFILER
+    estimator = StreamingVmax(compression)
+    first_frame = None
+    for chunk in read_prepared_chunks(filepath, chunk_rows, profiler, compact):
+        if first_frame is None and len(chunk):
+            first_frame = chunk.head(1)
+        if not include_player_velocities:
+            if first_frame is not None:
+                break
+            continue
+        with profiler.stage('vmax_percentiles'):
+            estimator.update(chunk)
+    if first_frame is None:
+        exit(f'There are no frames with the ball alive in {filepath}')
+
+    home_positions, away_positions = utils.default_positions(first_frame.columns)
+    percentile_function = estimator.percentile
+    if profiles is not None:
+        home_positions, away_positions = profiles.player_positions(teams, home_positions,
+                                                                   away_positions)
+        percentile_function = profiles.percentile_function(teams, estimator.percentile)
+    with profiler.stage('vmax_percentiles'):
+        home_velocities, away_velocities = velocities.calculate_player_vmax(
+            first_frame, home_positions, away_positions,
+            include_player_velocities=include_player_velocities,
+            stamine_home=stamine_home, stamine_away=stamine_away,
+            percentile_function=percentile_function, goalkeepers=goalkeepers)
+    merged_home_df = home_velocities.merge(home_positions, left_index=True, right_index=True)
+    merged_away_df = away_velocities.merge(away_positions, left_index=True, right_index=True)
+    return first_frame, merged_home_df, merged_away_df
@@ -0,0 +1,244 @@
+"""
+Store of player profiles accumulated across matches: the distribution of the velocity of each
+player (a mergeable t-digest, see src/data/quantiles.py), his/her positions and the number of
+samples and matches. Runs can take the percentile velocities and positions from the store
+instead of deriving them from the velocities of a single match.
+
+The tracking files only name the teams 'home' and 'away', so the profiles are keyed by the name
+of the team given for each match (e.g. 'Real Madrid'). Without names the teams are 'home' and
+'away' and the profiles only make sense for a single match.
+"""
+import json
+import os
+import uuid
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.data import utils
+from src.data.quantiles import TDigest
+
+PROFILES_COMPRESSION = 500
+
+SIDES = ('home', 'away')
+
+
+class PlayerProfile:
+    """
+    Velocity distribution, positions and samples of a player
+
+    __init__ Parameters
+    -----------
+    team: name of the team
+    jersey: jersey number (string, as in the tracking columns)
+    compression: accuracy of the velocity digest
+
+    methods include:
+    -----------
+    update(velocities, position, match): adds the velocities of a match
+    merge(other): adds the samples of another profile of the same player
+    vmax(percentile): percentile of the velocity
+    position(): most frequent position, None if unknown
+    to_dict() / from_dict(state): serializable state
+    """
+
+    def __init__(self, team, jersey, compression=PROFILES_COMPRESSION):
+        self.team = team
+        self.jersey = str(jersey)
+        self.velocities = TDigest(compression)
+        # Position -> number of samples in that position
+        self.positions = {}
+        self.matches = []
+
+    @property
+    def samples(self):
+        return self.velocities.count
+
+    def update(self, velocities, position=None, match=None):
+        velocities = np.asarray(velocities, dtype=float)
+        self.velocities.update(velocities)
+        if position is not None:
+            self.positions[position] = (self.positions.get(position, 0) +
+                                        int(np.sum(~np.isnan(velocities))))
+        if match is not None and match not in self.matches:
+            self.matches.append(match)
+
+    def merge(self, other):
+        self.velocities.merge(other.velocities)
+        for position, samples in other.positions.items():
+            self.positions[position] = self.positions.get(position, 0) + samples
+        self.matches += [match for match in other.matches if match not in self.matches]
+        return self
+
+    def vmax(self, percentile):
+        return self.velocities.percentile(percentile)
+
+    def position(self):
+        if not self.positions:
+            return None
+        return max(self.positions, key=self.positions.get)
+
+    def to_dict(self):
+        return {'team': self.team, 'jersey': self.jersey, 'samples': self.samples,
+                'positions': self.positions, 'matches': self.matches,
+                'velocities': self.velocities.to_dict()}
+
+    @classmethod
+    def from_dict(cls, state):
+        profile = cls(state['team'], state['jersey'])
+        profile.velocities = TDigest.from_dict(state['velocities'])
+        profile.positions = dict(state['positions'])
+        profile.matches = list(state['matches'])
+        return profile
+
+
+class ProfileStore:
+    """
+    Player profiles indexed by (team, jersey), saved as a JSON file
+
+    __init__ Parameters
+    -----------
+    path: JSON file of the store. If it exists the profiles are loaded from it
+
+    methods include:
+    -----------
+    get(team, jersey): profile of the player or None, in O(1)
+    profile(team, jersey): profile of the player, created if missing
+    add_match(match, chunks, teams, positions): adds the velocities of the players of a match
+    merge(other): merges the profiles of another store
+    percentile_function(teams, fallback): function(side, jersey, percentile) for
+        calculate_player_vmax that reads the store
+    player_positions(teams, home_positions, away_positions): positions with the ones of the store
+    to_dataframe(percentiles): summary with a row per player
+    save(path): writes the store atomically
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path is not None else None
+        self.profiles = {}
+        self.matches = []
+        if self.path is not None and self.path.exists():
+            with open(self.path) as f:
+                state = json.load(f)
+            self.matches = state['matches']
+            for profile_state in state['profiles']:
+                profile = PlayerProfile.from_dict(profile_state)
+                self.profiles[(profile.team, profile.jersey)] = profile
+
+    def __len__(self):
+        return len(self.profiles)
+
+    def get(self, team, jersey):
+        return self.profiles.get((team, str(jersey)))
+
+    def profile(self, team, jersey):
+        key = (team, str(jersey))
+        if key not in self.profiles:
+            self.profiles[key] = PlayerProfile(team, jersey)
+        return self.profiles[key]
+
+    def add_match(self, match, chunks, teams=None, positions=None):
+        """
+        Adds the velocities of the players of a match. A match already in the store is skipped
+
+        Parameters
+        -----------
+        match: name of the match
+        chunks: tracking dataframes of the match with velocities, e.g. [df] with the dataframe
+            of prepare_df or the chunks of chunked.read_prepared_chunks
+        teams: dictionary side ('home', 'away') -> team name. Default is the side
+        positions: optional dictionary (team name, jersey) -> position of the players
+
+        Returns
+        -----------
+        Whether the match was added
+        """
+        if match in self.matches:
+            return False
+        teams = teams or {side: side for side in SIDES}
+        positions = positions or {}
+        for chunk in chunks:
+            for jersey, side in utils.get_jersey_team(chunk):
+                self.profile(teams[side], jersey).update(
+                    chunk[f'{side}_{jersey}_total_v'].values,
+                    positions.get((teams[side], jersey)), match)
+        self.matches.append(match)
+        return True
+
+    def merge(self, other):
+        repeated = set(self.matches) & set(other.matches)
+        if repeated:
+            # The statistics would count the velocities of these matches twice
+            raise ValueError(f'The matches {sorted(repeated)} are in both stores')
+        for (team, jersey), profile in other.profiles.items():
+            if (team, jersey) in self.profiles:
+                self.profiles[(team, jersey)].merge(profile)
+            else:
+                self.profiles[(team, jersey)] = profile
+        self.matches += [match for match in other.matches if match not in self.matches]
+        return self
+
+    def percentile_function(self, teams=None, fallback=None):
+        """Returns function(side, jersey, percentile) with the percentile velocity of the
+        player in the store, or the one given by fallback for players without samples"""
+        teams = teams or {side: side for side in SIDES}
+
+        def percentile(side, jersey, q):
+            profile = self.get(teams[side], jersey)
+            if profile is not None and profile.samples:
+                return profile.vmax(q)
+            return fallback(side, jersey, q) if fallback is not None else np.nan
+
+        return percentile
+
+    def player_positions(self, teams, home_positions, away_positions):
+        """Returns copies of the position dataframes (see utils.default_positions) with the
+        position of the store for the players that have one"""
+        teams = teams or {side: side for side in SIDES}
+        updated = []
+        for side, positions in zip(SIDES, (home_positions, away_positions)):
+            positions = positions.copy()
+            for jersey in positions.index:
+                profile = self.get(teams[side], jersey)
+                if profile is not None and profile.position() is not None:
+                    positions.loc[jersey, 'position'] = profile.position()
+            updated.append(positions)
+        return tuple(updated)
+
+    def to_dataframe(self, percentiles=(95, 99)):
+        """Returns a dataframe with a row per player: team, jersey, position, samples, matches
+        and the given percentiles of the velocity"""
+        rows = []
+        for (team, jersey), profile in sorted(self.profiles.items()):
+            row = {'team': team, 'jersey': jersey, 'position': profile.position(),
+                   'samples': profile.samples, 'matches': len(profile.matches)}
+            for q in percentiles:
+                row[f'vmax_{q}'] = profile.vmax(q)
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    def save(self, path=None):
+        path = Path(path or self.path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        state = {'matches': self.matches,
+                 'profiles': [profile.to_dict() for profile in self.profiles.values()]}
+        temporary = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.tmp')
+        with open(temporary, 'w') as f:
+            json.dump(state, f)
+        os.replace(temporary, path)
+
+
+def read_teams(filepath):
+    """Reads a CSV with the columns match, home and away (team names) into a dictionary
+    match -> {'home': name, 'away': name}"""
+    teams = pd.read_csv(filepath, dtype=str)
+    return {row['match']: {'home': row['home'], 'away': row['away']}
+            for _, row in teams.iterrows()}
+
+
+def read_positions(filepath):
+    """Reads a CSV with the columns team, jersey and position into a dictionary
+    (team, jersey) -> position"""
+    positions = pd.read_csv(filepath, dtype=str)
+    return {(row['team'], row['jersey']): row['position'] for _, row in positions.iterrows()}
@@ -0,0 +1,135 @@
+"""
+Streaming estimation of quantiles with a t-digest (Dunning & Ertl, "Computing extremely accurate
+quantiles using t-digests", 2019). The values are summarized in a few hundred centroids (mean
+and weight), small near the extremes and large around the median, so the high percentiles used
+for the max velocity are accurate while the memory does not depend on the number of values.
+Digests of different chunks or workers can be merged.
+"""
+import numpy as np
+
+DEFAULT_COMPRESSION = 200
+
+
+class TDigest:
+    """
+    Mergeable sketch of the distribution of a stream of values
+
+    __init__ Parameters
+    -----------
+    compression: accuracy of the digest. The number of centroids is of the order of compression
+        and the rank error near a quantile q of the order of q * (1 - q) / compression
+    buffer_size: values kept before they are merged into the centroids. Until then the
+        quantiles are exact
+
+    methods include:
+    -----------
+    update(values): adds an array of values (NaNs are ignored)
+    merge(other): adds the values summarized by another digest
+    quantile(q): estimated q-quantile (0 to 1), interpolated between ranks as np.quantile
+    percentile(q): estimated q-th percentile (0 to 100)
+    to_dict() / from_dict(state): serializable state of the digest
+    """
+
+    def __init__(self, compression=DEFAULT_COMPRESSION, buffer_size=None):
+        self.compression = compression
+        self.buffer_size = buffer_size or 10 * compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.buffer = []
+        self.buffered = 0
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        self.buffer.append(values)
+        self.buffered += len(values)
+        self.count += len(values)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        if self.buffered >= self.buffer_size:
+            self.compress()
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        if len(other.means) == 0:
+            # The other digest only has values in its buffer, which are added as they are
+            self.buffer.extend(other.buffer)
+            self.buffered += other.buffered
+            if self.buffered >= self.buffer_size:
+                self.compress()
+            return self
+        other.compress()
+        self.compress()
+        self.compress(np.concatenate([self.means, other.means]),
+                      np.concatenate([self.weights, other.weights]))
+        return self
+
+    def compress(self, means=None, weights=None):
+        """Merges the buffer into the centroids (or merges the given centroids)"""
+        if means is None:
+            if not self.buffered:
+                return
+            values = np.concatenate(self.buffer)
+            means = np.concatenate([self.means, values])
+            weights = np.concatenate([self.weights, np.ones(len(values))])
+            self.buffer, self.buffered = [], 0
+
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+        # Scale function k1: the centroids that fall in the same unit of k are merged, which makes
+        # them small near q = 0 and q = 1
+        q = (np.cumsum(weights) - weights / 2.) / total
+        k = np.floor(self.compression / (2 * np.pi) * np.arcsin(2 * q - 1))
+        starts = np.flatnonzero(np.r_[True, k[1:] != k[:-1]])
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def quantile(self, q):
+        if self.count == 0:
+            return np.nan
+        if len(self.means) == 0:
+            # Every value is still in the buffer, so the quantile is exact
+            return float(np.quantile(np.concatenate(self.buffer), q))
+        self.compress()
+        # Rank of the center of each centroid, a single value has its exact rank
+        centers = np.cumsum(self.weights) - (self.weights + 1) / 2.
+        ranks = np.r_[0., centers, self.count - 1.]
+        values = np.r_[self.min, self.means, self.max]
+        return float(np.interp(q * (self.count - 1), ranks, values))
+
+    def percentile(self, q):
+        return self.quantile(q / 100.)
+
+    def to_dict(self):
+        # A digest that only has buffered values keeps them, so its quantiles stay exact
+        if len(self.means):
+            self.compress()
+        buffer = np.concatenate(self.buffer).tolist() if self.buffered else []
+        return {'compression': self.compression, 'count': self.count,
+                'min': float(self.min), 'max': float(self.max),
+                'means': self.means.tolist(), 'weights': self.weights.tolist(),
+                'buffer': buffer}
+
+    @classmethod
+    def from_dict(cls, state):
+        digest = cls(state['compression'])
+        digest.count = state['count']
+        digest.min = state['min']
+        digest.max = state['max']
+        digest.means = np.array(state['means'], dtype=float)
+        digest.weights = np.array(state['weights'], dtype=float)
+        buffer = state.get('buffer', [])
+        if buffer:
+            digest.buffer = [np.array(buffer, dtype=float)]
+            digest.buffered = len(buffer)
+        return digest
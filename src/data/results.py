@@ -0,0 +1,97 @@
+import re
+from pathlib import Path
+
+# This module is imported by the CLI before any heavy dependency is loaded, so it
+# must only rely on the standard library
+RESULTS_PATH = Path('results')
+
+DEFAULT_POSITIONS = ['Defender', 'Midfielder', 'Striker', 'Substitute']
+
+
+def get_match_id(filename):
+    """Returns the id of the match, the number at the end of its filename (None if missing)"""
+    match_id = re.search(r'\d+$', filename)
+    return match_id.group() if match_id else None
+
+
+def create_output_filename(filename, include_velocities=None,
+                           home_stamine_factor=None, away_stamine_factor=None,
+                           positions=None, profiles=None, compact=None, adaptive=None,
+                           zones=None, counterfactual=None, integrator=None, surrogate=None,
+                           precision=None):
+    suffix = ''
+    if include_velocities:
+        suffix += '_include_velocities'
+    if home_stamine_factor and not away_stamine_factor:
+        suffix += f'_sh_{home_stamine_factor}_as_1.0'
+    if away_stamine_factor and not home_stamine_factor:
+        suffix += f'_sh_1.0_as_{away_stamine_factor}'
+    if home_stamine_factor and away_stamine_factor:
+        suffix += f'_sh_{home_stamine_factor}_as_{away_stamine_factor}'
+    if positions:
+        for position in positions:
+            suffix += f'_{position}'
+    if profiles:
+        suffix += '_profiles'
+    if compact:
+        suffix += '_compact'
+    if adaptive:
+        suffix += '_adaptive'
+    if zones:
+        suffix += f'_zones_{zones}'
+    if counterfactual:
+        suffix += '_counterfactual'
+    if integrator:
+        suffix += f'_{integrator}_step'
+    if precision:
+        suffix += f'_{precision}_precision'
+    if surrogate:
+        suffix += f'_surrogate_{surrogate}'
+
+    return filename + suffix
+
+
+def one_half_output_name(filename, include_velocities=None, home_stamine_factor=None,
+                         away_stamine_factor=None, positions_to_increase=None, profiles=None,
+                         compact=None, adaptive=None, zone_map=None, counterfactual=None,
+                         integrator=None, surrogate=None, precision=None):
+    """Returns the name (without extension) of the pickle written by calculate_one_half
+
+    profiles: path of the player profile store used in the run, if any
+    compact: whether the run used the float32 tracking data
+    adaptive: whether the frames were selected with the adaptive sampler
+    zone_map: name of the zone map or path of its JSON file (see src/pitch_control/zones.py)
+    counterfactual: whether the result has the pitch control lost without each player
+    integrator: integrator of the contested cells (see PitchControl)
+    surrogate: file of the surrogate model, if the run used the surrogate engine
+    precision: dtype of the arrays of the vectorized engine (see PitchControl)
+    """
+    # The positions are only added to the name when a subset of them was requested
+    positions = None
+    if positions_to_increase is not None and len(positions_to_increase) != len(DEFAULT_POSITIONS):
+        positions = positions_to_increase
+    # Neither is the default zone map, the thirds of the pitch
+    zones = Path(zone_map).stem if zone_map and zone_map != 'thirds' else None
+    # Nor the default integrator, with the fixed time step
+    integrator = integrator if integrator != 'fixed' else None
+    precision = precision if precision != 'float64' else None
+    surrogate = Path(surrogate).stem if surrogate else None
+    return create_output_filename(f'one_half_{filename}', include_velocities,
+                                  home_stamine_factor, away_stamine_factor, positions=positions,
+                                  profiles=profiles, compact=compact, adaptive=adaptive,
+                                  zones=zones, counterfactual=counterfactual,
+                                  integrator=integrator,
+                                  surrogate=surrogate, precision=precision)
+
+
+def one_half_result_path(filename, include_velocities=None, home_stamine_factor=None,
+                         away_stamine_factor=None, positions_to_increase=None,
+                         results_path=RESULTS_PATH, profiles=None, compact=None, adaptive=None,
+                         zone_map=None, counterfactual=None, integrator=None, surrogate=None,
+                         precision=None):
+    """Returns the path of the pickle written by calculate_one_half"""
+    name = one_half_output_name(filename, include_velocities, home_stamine_factor,
+                                away_stamine_factor, positions_to_increase, profiles, compact,
+                                adaptive, zone_map, counterfactual, integrator, surrogate,
+                                precision)
+    return Path(results_path) / f'{name}.pkl'
@@ -0,0 +1,64 @@
+"""
+Adaptive selection of the frames of a half. Instead of one frame every n, a new keyframe is taken
+when the game changed enough since the previous one: a player moved more than a distance, the
+ball moved more than another one or the possession changed (or, at the latest, after max_step
+frames). Each keyframe stands for the frames until the next one, its weight, and the
+contributions of the frames are combined with these weights so that the result approximates the
+one of every frame (-o 1), see analysis.PartialContributions.from_weighted_frames.
+"""
+import numpy as np
+
+# Distances in metres since the last keyframe that make a new keyframe
+PLAYER_DISPLACEMENT = 2.
+BALL_DISPLACEMENT = 3.
+
+
+def change_since(positions, reference):
+    """Maximum displacement of the players from the reference positions in each frame. A player
+    that enters or leaves the frame counts as an infinite displacement"""
+    displacement = np.sqrt(((positions - reference) ** 2).sum(axis=-1))
+    inframe_changed = np.isnan(positions[..., 0]) != np.isnan(reference[..., 0])
+    displacement[inframe_changed] = np.inf
+    return np.where(np.isnan(displacement), 0., displacement).max(axis=-1)
+
+
+def select_keyframes(tracking, max_step=25, player_displacement=PLAYER_DISPLACEMENT,
+                     ball_displacement=BALL_DISPLACEMENT):
+    """
+    Selects the keyframes of a half
+
+    Parameters
+    -----------
+    tracking: TrackingArrays of every frame of the half (see src/data/shared_tracking.py)
+    max_step: maximum number of frames between two keyframes
+    player_displacement: distance (m) that a player has to move to make a new keyframe
+    ball_displacement: distance (m) that the ball has to move to make a new keyframe
+
+    Returns
+    -----------
+    The indexes of the keyframes and their weights, the number of frames that each one stands
+    for (from the keyframe to the next one), which add up to the number of frames
+    """
+    n_frames = len(tracking)
+    if n_frames == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    keyframes = [0]
+    while True:
+        current = keyframes[-1]
+        window = slice(current + 1, min(current + 1 + max_step, n_frames))
+        if window.start >= n_frames:
+            break
+        changed = (change_since(tracking.positions[window], tracking.positions[current])
+                   > player_displacement)
+        ball_moved = np.sqrt(((tracking.ball[window] - tracking.ball[current]) ** 2).sum(axis=-1))
+        changed |= ball_moved > ball_displacement
+        changed |= tracking.ball_owner[window] != tracking.ball_owner[current]
+        # The last frame of the window is taken when nothing changed before it
+        changed[-1] |= window.stop - window.start == max_step
+        first = np.flatnonzero(changed)
+        if len(first) == 0:
+            break
+        keyframes.append(window.start + first[0])
+    keyframes = np.array(keyframes)
+    weights = np.diff(np.append(keyframes, n_frames))
+    return keyframes, weights
@@ -0,0 +1,144 @@
+"""
+Possession segments of a half: runs of consecutive frames where the same team has the ball and
+the ball stays alive. Within a segment the attacking and defending teams (and so the offside
+line and the zones where the contributions go) do not change, so each segment is an
+independent unit of work: it can run in any process, its result (PartialContributions) is
+cached on disk and only the missing or requested segments are run again. The segments are
+merged in order into the result of the half (analysis.merge_partial_contributions) and also
+give a table of contributions per possession.
+"""
+import os
+import pickle
+import uuid
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.batch import frame_pool
+from src.data.shared_tracking import TrackingArrays
+
+
+def find_segments(df, frames_step=1):
+    """
+    Splits the prepared frames of a half (only live ball, every frames_step) in possession
+    segments. A segment ends when the team in possession changes or when frames are missing
+    between two rows, i.e. the ball was dead in between
+
+    Returns
+    -----------
+    Dataframe with a row per segment: segment (number), start and stop (rows [start, stop) of
+    df), possession (team in possession, None if nobody), first_frame, last_frame and frames
+    """
+    if len(df) == 0:
+        return pd.DataFrame(columns=['segment', 'start', 'stop', 'possession', 'first_frame',
+                                     'last_frame', 'frames'])
+    owner = df['ball_owner'].astype(object).where(df['ball_owner'].notna(), None).values
+    frames = df['frame'].values
+    new_owner = owner[1:] != owner[:-1]
+    ball_dead = np.diff(frames) > (frames_step or 1)
+    starts = np.concatenate([[0], np.flatnonzero(new_owner | ball_dead) + 1])
+    stops = np.append(starts[1:], len(df))
+    return pd.DataFrame({'segment': np.arange(len(starts)), 'start': starts, 'stop': stops,
+                         'possession': owner[starts], 'first_frame': frames[starts],
+                         'last_frame': frames[stops - 1], 'frames': stops - starts})
+
+
+class SegmentCache:
+    """
+    PartialContributions of the segments of a half saved as pickles in a directory, one per
+    segment, named after its first and last frame and its number of frames
+
+    __init__ Parameters
+    -----------
+    path: directory of the cache, which must be specific to the match and the options of the run
+
+    methods include:
+    -----------
+    load(segment): cached result of the segment (a row of find_segments) or None
+    save(segment, partial): saves the result of the segment
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def segment_path(self, segment):
+        return self.path / f'{segment.first_frame}-{segment.last_frame}-{segment.frames}.pkl'
+
+    def load(self, segment):
+        path = self.segment_path(segment)
+        if not path.exists():
+            return None
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, segment, partial):
+        self.path.mkdir(parents=True, exist_ok=True)
+        path = self.segment_path(segment)
+        temporary = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.tmp')
+        with open(temporary, 'wb') as f:
+            pickle.dump(partial, f)
+        os.replace(temporary, path)
+
+
+def run_segments(pitch_control, df, segments, cache=None, rerun=None, workers=1, metrics=None):
+    """
+    Runs the segments of a half that are not cached
+
+    Parameters
+    -----------
+    pitch_control: PitchControl of the half
+    df: prepared tracking dataframe of the half
+    segments: dataframe of find_segments
+    cache: optional SegmentCache
+    rerun: numbers of the segments that are run again even if they are cached
+    workers: number of processes, the segments are distributed among them
+    metrics: optional MetricsExporter updated as the segments finish
+
+    Returns
+    -----------
+    List with the PartialContributions of each segment
+    """
+    rerun = set(rerun or [])
+    partials = [None] * len(segments)
+    missing = []
+    for i, segment in enumerate(segments.itertuples(index=False)):
+        if cache is not None and segment.segment not in rerun:
+            partials[i] = cache.load(segment)
+        if partials[i] is None:
+            missing.append(i)
+        elif metrics is not None:
+            metrics.update(segment.frames)
+    print(f'{len(segments) - len(missing)} of {len(segments)} possession segments cached')
+    if not missing:
+        return partials
+
+    ranges = [(segments['start'].iloc[i], segments['stop'].iloc[i]) for i in missing]
+    if workers > 1:
+        results = frame_pool.run_ranges_parallel(pitch_control, df, ranges, workers, metrics)
+    else:
+        tracking = TrackingArrays.from_dataframe(df)
+        results = []
+        for start, stop in ranges:
+            results.append(frame_pool.run_tracking_range(pitch_control, tracking, start, stop))
+            if metrics is not None:
+                metrics.update(stop - start)
+    for i, partial in zip(missing, results):
+        partials[i] = partial
+        if cache is not None:
+            cache.save(segments.iloc[i], partial)
+    return partials
+
+
+def possession_table(segments, partials):
+    """Returns a dataframe with the contributions of each player in each possession segment,
+    with the columns of the segment (see find_segments) followed by id, team and the
+    contributions made during the segment"""
+    tables = []
+    for segment, partial in zip(segments.itertuples(index=False), partials):
+        table = partial.total.reset_index()
+        for column in reversed(segments.columns):
+            table.insert(0, column, getattr(segment, column))
+        tables.append(table)
+    return pd.concat(tables, ignore_index=True)[list(segments.columns) + ['id', 'team'] +
+                                                 list(partials[0].total.columns)]
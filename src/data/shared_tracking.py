@@ -0,0 +1,147 @@
+"""
+Prepared tracking data as NumPy arrays that can be placed in shared memory. Pool workers attach
+to the blocks by name and read the frames through NumPy views, so the data is neither pickled
+for each task nor copied in every worker.
+"""
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Value of ball_owner for each team, -1 when the ball has no owner
+TEAMS = ('home', 'away')
+
+
+class TrackingArrays:
+    """
+    Tracking data of a half with one row per frame and the players in the columns
+
+    __init__ Parameters
+    -----------
+    frame: (n_frames,) frame numbers
+    ball: (n_frames, 2) position of the ball
+    ball_owner: (n_frames,) index in TEAMS of the team in possession, -1 if none
+    positions: (n_frames, n_players, 2) positions of the players, NaN when out of the frame
+    velocities: (n_frames, n_players, 2) velocities of the players
+    players: tag of the player in each column, e.g. 'home_1_' (see Player.tagname)
+
+    methods include:
+    -----------
+    from_dataframe(df): creates the arrays from a prepared tracking dataframe
+    arrays(): dictionary name -> array
+    ball_owner_name(index): name of the team in possession in the index-th frame
+    player_columns(players): columns of a list of players
+    """
+
+    ARRAYS = ('frame', 'ball', 'ball_owner', 'positions', 'velocities')
+
+    def __init__(self, frame, ball, ball_owner, positions, velocities, players):
+        self.frame = frame
+        self.ball = ball
+        self.ball_owner = ball_owner
+        self.positions = positions
+        self.velocities = velocities
+        self.players = list(players)
+        self.column_of_player = {tag: column for column, tag in enumerate(self.players)}
+
+    @classmethod
+    def from_dataframe(cls, df):
+        players = [c[:-1] for c in df.columns if c[:4] in TEAMS and c.endswith('_x')]
+        ball_owner = np.full(len(df), -1, dtype=np.int8)
+        for code, team in enumerate(TEAMS):
+            ball_owner[(df['ball_owner'] == team).values] = code
+        positions = np.stack([df[[f'{tag}x' for tag in players]].values,
+                              df[[f'{tag}y' for tag in players]].values], axis=-1)
+        velocities = np.stack([df[[f'{tag}vx' for tag in players]].values,
+                               df[[f'{tag}vy' for tag in players]].values], axis=-1)
+        # The compact data stays in float32, other columns (e.g. integer positions) are float
+        dtype = np.float32 if positions.dtype == np.float32 else float
+        return cls(df['frame'].values, df[['ball_x', 'ball_y']].values, ball_owner,
+                   positions.astype(dtype, copy=False), velocities.astype(dtype, copy=False),
+                   players)
+
+    def __len__(self):
+        return len(self.frame)
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in self.ARRAYS}
+
+    def ball_owner_name(self, index):
+        code = self.ball_owner[index]
+        return TEAMS[code] if code >= 0 else None
+
+    def player_columns(self, players):
+        return [self.column_of_player[player.tagname] for player in players]
+
+
+class SharedTracking:
+    """
+    TrackingArrays stored in shared memory blocks, one per array. The process that creates them
+    owns the blocks and must unlink them when the workers are done (or use it as a context
+    manager); the workers attach with the descriptor and close them.
+
+    __init__ Parameters
+    -----------
+    blocks: dictionary name -> SharedMemory
+    tracking: TrackingArrays whose arrays are views on the blocks
+    owner: whether the blocks were created by this process
+
+    methods include:
+    -----------
+    create(tracking): copies the arrays to new shared memory blocks
+    attach(descriptor): opens the blocks created by another process
+    descriptor(): names, shapes and types of the blocks, to send to the workers
+    close(): closes the blocks in this process
+    unlink(): frees the blocks (owner only)
+    """
+
+    def __init__(self, blocks, tracking, owner=False):
+        self.blocks = blocks
+        self.tracking = tracking
+        self.owner = owner
+
+    @classmethod
+    def create(cls, tracking):
+        blocks, views = {}, {}
+        try:
+            for name, array in tracking.arrays().items():
+                array = np.ascontiguousarray(array)
+                blocks[name] = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                views[name] = np.ndarray(array.shape, dtype=array.dtype, buffer=blocks[name].buf)
+                views[name][...] = array
+        except Exception:
+            for block in blocks.values():
+                block.close()
+                block.unlink()
+            raise
+        return cls(blocks, TrackingArrays(players=tracking.players, **views), owner=True)
+
+    @classmethod
+    def attach(cls, descriptor):
+        blocks, views = {}, {}
+        for name, (block_name, shape, dtype) in descriptor['arrays'].items():
+            blocks[name] = shared_memory.SharedMemory(name=block_name)
+            views[name] = np.ndarray(shape, dtype=dtype, buffer=blocks[name].buf)
+        return cls(blocks, TrackingArrays(players=descriptor['players'], **views))
+
+    def descriptor(self):
+        arrays = {name: (self.blocks[name].name, array.shape, array.dtype.str)
+                  for name, array in self.tracking.arrays().items()}
+        return {'arrays': arrays, 'players': self.tracking.players}
+
+    def close(self):
+        # The views must be released before the buffers are closed
+        self.tracking = None
+        for block in self.blocks.values():
+            block.close()
+
+    def unlink(self):
+        if self.owner:
+            for block in self.blocks.values():
+                block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        self.unlink()
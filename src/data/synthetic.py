@@ -0,0 +1,154 @@
+import numpy as np
+import pandas as pd
+
+# Formation (4-4-2) of a team defending the left goal, in meters. The first player is the
+# goalkeeper, placed close to the goal line so that find_goalkeeper identifies him/her
+FORMATION = np.array([
+    [-48., 0.],
+    [-35., -22.], [-37., -8.], [-37., 8.], [-35., 22.],
+    [-15., -22.], [-17., -7.], [-17., 7.], [-15., 22.],
+    [-3., -8.], [-3., 8.]
+])
+
+
+def generate_tracking_data(n_frames=1500, n_players=11, n_substitutions=3, nan_gap_rate=0.0005,
+                           possession_switches=20, dead_ball_fraction=0.1,
+                           field_dimen=(106., 68.), first_frame=1, seed=None):
+    """
+    Generates a synthetic match with the same schema as the files in data/processed: positions
+    in centimeters, ball_status, ball_owner ('home' or 'away'), ball_speed and ball_z.
+
+    Parameters
+    -----------
+    n_frames: number of frames (25 per second)
+    n_players: number of starting players of each team (from 2 to 11)
+    n_substitutions: number of substitutions, alternating home and away. The substitute takes
+        the place of the substituted player, who disappears from the data (NaN positions)
+    nan_gap_rate: probability per frame and outfield player of starting a gap of missing
+        positions (between 1 and 25 frames)
+    possession_switches: number of times the possession changes between teams
+    dead_ball_fraction: approximate fraction of frames with the ball out of play
+    field_dimen: x and y size of the field in meters
+    first_frame: number of the first frame
+    seed: seed of the random generator
+
+    Returns
+    -----------
+    Tracking dataframe, with integer positions stored as floats when there are NaN gaps
+    """
+    rng = np.random.default_rng(seed)
+    n_players = min(max(n_players, 2), len(FORMATION))
+    half_length, half_width = field_dimen[0] / 2., field_dimen[1] / 2.
+    data = {'frame': first_frame + np.arange(n_frames)}
+
+    # Ball: interpolation of random waypoints every 4 seconds, starting at the kick off
+    ball = _random_waypoints(rng, n_frames, period=100, scale=15., start=(0., 0.))
+    ball[:, 0] = np.clip(ball[:, 0], -half_length, half_length)
+    ball[:, 1] = np.clip(ball[:, 1], -half_width, half_width)
+
+    # Players follow their place in the formation, shifted towards the ball
+    shift = np.zeros_like(ball)
+    shift[:, 0] = 0.4 * ball[:, 0]
+    shift[:, 1] = 0.2 * ball[:, 1]
+    players = {}
+    for team, side in (('home', 1.), ('away', -1.)):
+        for number in range(n_players):
+            # The goalkeeper barely moves with the team
+            team_shift = shift * (0.1 if number == 0 else 1.)
+            noise = _random_waypoints(rng, n_frames, period=50, scale=3.,
+                                      start=(0., 0.), anchored=True)
+            position = side * (FORMATION[number] + noise) + team_shift
+            position[:, 0] = np.clip(position[:, 0], -half_length, half_length)
+            position[:, 1] = np.clip(position[:, 1], -half_width, half_width)
+            players[(team, number + 1)] = position
+
+    # Substitutions: the new player continues the trajectory of the substituted one
+    outfield = [(team, number) for number in range(2, n_players + 1) for team in ('home', 'away')]
+    substitutes = {'home': 12, 'away': 12}
+    for k in range(min(n_substitutions, len(outfield))):
+        team = 'home' if k % 2 == 0 else 'away'
+        candidates = [p for p in outfield if p[0] == team] or outfield
+        substituted = candidates[rng.integers(len(candidates))]
+        outfield.remove(substituted)
+        team = substituted[0]
+        sub_frame = int(rng.uniform(0.2, 0.9) * n_frames)
+        substitute = np.full((n_frames, 2), np.nan)
+        substitute[sub_frame:] = players[substituted][sub_frame:]
+        players[substituted] = players[substituted].copy()
+        players[substituted][sub_frame:] = np.nan
+        players[(team, substitutes[team])] = substitute
+        substitutes[team] += 1
+
+    # Random gaps of missing data for outfield players (never at the first frame)
+    if nan_gap_rate > 0:
+        for (team, number), position in players.items():
+            if number == 1:
+                continue
+            starts = np.flatnonzero(rng.random(n_frames) < nan_gap_rate)
+            for start in starts[starts > 0]:
+                position[start:start + rng.integers(1, 26)] = np.nan
+
+    for (team, number), position in players.items():
+        data[f'{team}_{number}_x'] = np.round(position[:, 0] * 100)
+        data[f'{team}_{number}_y'] = np.round(position[:, 1] * 100)
+
+    for number in range(3):
+        referee = _random_waypoints(rng, n_frames, period=75, scale=8., start=(0., 0.))
+        data[f'referee_{number}_x'] = np.round(np.clip(referee[:, 0], -half_length, half_length) * 100)
+        data[f'referee_{number}_y'] = np.round(np.clip(referee[:, 1], -half_width, half_width) * 100)
+
+    data['ball_status'] = _dead_ball_status(rng, n_frames, dead_ball_fraction)
+    data['ball_owner'] = _possession(rng, n_frames, possession_switches)
+    ball_speed = np.r_[0., np.linalg.norm(np.diff(ball, axis=0), axis=1) / 0.04]
+    data['ball_speed'] = np.round(ball_speed, 2)
+    data['ball_z'] = np.zeros(n_frames, dtype=int)
+    data['ball_y'] = np.round(ball[:, 1] * 100)
+    data['ball_x'] = np.round(ball[:, 0] * 100)
+
+    return pd.DataFrame(data)
+
+
+def write_tracking_csv(filepath, **kwargs):
+    """Generates a synthetic match (see generate_tracking_data) and saves it as CSV"""
+    df = generate_tracking_data(**kwargs)
+    df.to_csv(filepath, index=False)
+    return df
+
+
+def _random_waypoints(rng, n_frames, period, scale, start, anchored=False):
+    """Linear interpolation of random waypoints placed every 'period' frames. If anchored, the
+    waypoints are random around the start, otherwise they follow a random walk"""
+    n_waypoints = n_frames // period + 2
+    steps = rng.normal(0., scale, size=(n_waypoints, 2))
+    steps[0] = start
+    waypoints = steps if anchored else np.cumsum(steps, axis=0)
+    frames = np.arange(n_frames) / period
+    knots = np.arange(n_waypoints)
+    return np.column_stack([np.interp(frames, knots, waypoints[:, 0]),
+                            np.interp(frames, knots, waypoints[:, 1])])
+
+
+def _possession(rng, n_frames, possession_switches):
+    """Returns the owner of the ball in each frame"""
+    switches = np.sort(rng.choice(np.arange(1, n_frames), size=min(possession_switches,
+                                                                     n_frames - 1),
+                                  replace=False))
+    owner = np.zeros(n_frames, dtype=int)
+    owner[switches] = 1
+    owner = np.cumsum(owner) % 2
+    if rng.random() < 0.5:
+        owner = 1 - owner
+    return np.where(owner == 0, 'home', 'away')
+
+
+def _dead_ball_status(rng, n_frames, dead_ball_fraction):
+    """Returns the ball status (1 in play, 0 out of play), with dead ball periods of 2 to 10
+    seconds. The first frame is always in play"""
+    status = np.ones(n_frames, dtype=int)
+    target = int(dead_ball_fraction * n_frames)
+    while target > 0 and n_frames > 1:
+        length = min(int(rng.integers(50, 251)), target)
+        start = int(rng.integers(1, n_frames))
+        status[start:start + length] = 0
+        target -= length
+    return status
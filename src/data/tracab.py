@@ -0,0 +1,315 @@
+"""
+Reader of the raw Tracab feeds: the frame file (.dat), with one line per frame
+
+    frame:team,target,jersey,x,y,speed;...;:ball_x,ball_y,ball_z,ball_speed,owner,status;:
+
+where team is 1 for the home team, 0 for the away team and other values for referees and
+unknown targets, owner is H or A and status Alive or Dead, and the metadata XML of the match
+(frame rate, pitch size, periods and, in the newer feeds, the players and their positions).
+
+The frames are converted into the layout of data/processed (positions in cm, one column per
+player, see the README) without loading the whole match, either as CSV or as a compressed .npz
+with float32 arrays, and the metadata is written next to them (see metadata_path) so that the
+runs take the goalkeepers and the pitch size from it instead of guessing them.
+"""
+import json
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Codes of the teams in the frame file and in the ball owner field
+TEAM_CODES = {'1': 'home', '0': 'away'}
+OWNER_CODES = {'H': 'home', 'A': 'away'}
+
+GOALKEEPER_POSITIONS = ('G', 'GK', 'Goalkeeper')
+
+# Frames converted at once
+BLOCK_FRAMES = 10000
+
+
+class TracabError(Exception):
+    pass
+
+
+def metadata_path(match_path):
+    """Path of the metadata written next to a converted match"""
+    match_path = Path(match_path)
+    return match_path.with_name(f'{match_path.stem}.meta.json')
+
+
+def read_match_metadata(match_path):
+    """Returns the metadata written next to a converted match, None if there is none"""
+    path = metadata_path(match_path)
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def child_text(element, tag, default=None):
+    child = element.find(tag)
+    return child.text.strip() if child is not None and child.text else default
+
+
+def pitch_size(filepath, length, width, scale=1.):
+    """Pitch length and width in metres from the values of the metadata, which scale converts
+    to metres"""
+    try:
+        return float(length) * scale, float(width) * scale
+    except (TypeError, ValueError):
+        raise TracabError(f'The metadata {filepath} has no valid pitch size: length {length}, '
+                          f'width {width}') from None
+
+
+def empty_metadata():
+    return {'frame_rate': 25, 'pitch_length': None, 'pitch_width': None, 'periods': [],
+            'teams': {}, 'goalkeepers': {}, 'players': {}}
+
+
+def read_metadata(filepath):
+    """
+    Reads the metadata XML of a match, in the old format (a match element with the pitch size and
+    the periods in attributes) or in the new one (one element per field, with the players)
+
+    Returns
+    -----------
+    Dictionary with the frame rate, pitch length and width in metres, the periods (id, start
+    and end frame), the team names, the goalkeepers (jersey of the starting goalkeeper of each
+    team, if the players are listed) and the jerseys of the players of each team
+    """
+    root = ET.parse(filepath).getroot()
+    metadata = empty_metadata()
+
+    match = root if root.tag == 'match' else root.find('match')
+    if match is not None:
+        metadata['frame_rate'] = int(match.get('iFrameRateFps', 25))
+        metadata['pitch_length'], metadata['pitch_width'] = pitch_size(
+            filepath, match.get('fPitchXSizeMeters'), match.get('fPitchYSizeMeters'))
+        for period in match.iter('period'):
+            start, end = int(period.get('iStartFrame')), int(period.get('iEndFrame'))
+            # The periods that were not played have 0 frames
+            if start or end:
+                metadata['periods'].append({'id': int(period.get('iId')), 'start_frame': start,
+                                            'end_frame': end})
+    else:
+        metadata['frame_rate'] = int(child_text(root, 'FrameRate', 25))
+        # The new format gives the pitch size in cm
+        metadata['pitch_length'], metadata['pitch_width'] = pitch_size(
+            filepath, child_text(root, 'PitchLongSide'), child_text(root, 'PitchShortSide'),
+            scale=0.01)
+        for period in range(1, 6):
+            start = int(child_text(root, f'Phase{period}StartFrame', 0))
+            end = int(child_text(root, f'Phase{period}EndFrame', 0))
+            if start or end:
+                metadata['periods'].append({'id': period, 'start_frame': start, 'end_frame': end})
+
+    for team, tag in (('home', 'HomeTeam'), ('away', 'AwayTeam')):
+        element = root.find(tag)
+        if element is None:
+            continue
+        metadata['teams'][team] = child_text(element, 'ShortName') or child_text(element, 'LongName')
+        players = element.findall('Players/Player')
+        metadata['players'][team] = [child_text(player, 'JerseyNo') for player in players]
+        for player in players:
+            if child_text(player, 'StartingPosition') in GOALKEEPER_POSITIONS:
+                metadata['goalkeepers'][team] = child_text(player, 'JerseyNo')
+                break
+    return metadata
+
+
+def parse_frame(line):
+    """
+    Parses a line of the frame file
+
+    Returns
+    -----------
+    The frame number, a dictionary (team, jersey) -> (x, y) in cm with the players of the teams
+    and the ball as (x, y, z, speed, owner, status)
+    """
+    chunks = line.split(':')
+    if len(chunks) < 3:
+        raise TracabError(f'Invalid frame: {line[:50]}')
+    players = {}
+    for target in chunks[1].split(';'):
+        if not target:
+            continue
+        fields = target.split(',')
+        team = TEAM_CODES.get(fields[0])
+        if team is not None:
+            players[(team, fields[2])] = (float(fields[3]), float(fields[4]))
+    fields = chunks[2].rstrip(';').split(',')
+    ball = (float(fields[0]), float(fields[1]), float(fields[2]), float(fields[3]),
+            OWNER_CODES.get(fields[4]), fields[5] == 'Alive')
+    return int(chunks[0]), players, ball
+
+
+def iter_lines(filepath, periods=None):
+    """Yields the lines of the frame file, only the ones in the periods if they are given"""
+    with open(filepath) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if periods:
+                frame = int(line[:line.index(':')])
+                if not any(period['start_frame'] <= frame <= period['end_frame']
+                           for period in periods):
+                    continue
+            yield line
+
+
+def find_players(filepath, periods=None):
+    """First pass over the frame file, returns the (team, jersey) of every player that appears,
+    home players first and by jersey"""
+    players = set()
+    for line in iter_lines(filepath, periods):
+        for target in line.split(':')[1].split(';'):
+            fields = target.split(',')
+            if fields[0] in TEAM_CODES:
+                players.add((TEAM_CODES[fields[0]], fields[2]))
+    return sorted(players, key=lambda player: (player[0] != 'home', int(player[1])))
+
+
+def read_blocks(filepath, players, periods=None, block_frames=BLOCK_FRAMES):
+    """
+    Yields the frames in blocks of block_frames as dictionaries of arrays: frame, positions
+    (n_frames, n_players, 2) in cm (NaN for the players not in the frame), ball (n_frames, 3),
+    ball_speed, ball_owner (index in ('home', 'away'), -1 if none) and ball_status
+    """
+    column_of_player = {player: column for column, player in enumerate(players)}
+
+    def new_block():
+        return {'frame': np.zeros(block_frames, dtype=np.int64),
+                'positions': np.full((block_frames, len(players), 2), np.nan, dtype=np.float32),
+                'ball': np.zeros((block_frames, 3), dtype=np.float32),
+                'ball_speed': np.zeros(block_frames, dtype=np.float32),
+                'ball_owner': np.full(block_frames, -1, dtype=np.int8),
+                'ball_status': np.zeros(block_frames, dtype=np.int8)}
+
+    def cut(block, n):
+        return {name: array[:n] for name, array in block.items()}
+
+    block, n = new_block(), 0
+    for line in iter_lines(filepath, periods):
+        frame, frame_players, ball = parse_frame(line)
+        block['frame'][n] = frame
+        for player, position in frame_players.items():
+            block['positions'][n, column_of_player[player]] = position
+        block['ball'][n] = ball[:3]
+        block['ball_speed'][n] = ball[3]
+        if ball[4] is not None:
+            block['ball_owner'][n] = ('home', 'away').index(ball[4])
+        block['ball_status'][n] = ball[5]
+        n += 1
+        if n == block_frames:
+            yield block
+            block, n = new_block(), 0
+    if n:
+        yield cut(block, n)
+
+
+def player_columns(players):
+    return [f'{team}_{jersey}_{axis}' for team, jersey in players for axis in ('x', 'y')]
+
+
+def block_to_dataframe(block, players):
+    """Converts a block of read_blocks (or the arrays of a .npz match) into the CSV layout"""
+    n_frames = len(block['frame'])
+    df = pd.DataFrame(block['positions'].reshape(n_frames, -1), columns=player_columns(players))
+    df.insert(0, 'frame', block['frame'])
+    df['ball_status'] = block['ball_status']
+    df['ball_owner'] = pd.Series(block['ball_owner']).map({0: 'home', 1: 'away'})
+    df['ball_speed'] = block['ball_speed']
+    df['ball_z'] = block['ball'][:, 2]
+    df['ball_y'] = block['ball'][:, 1]
+    df['ball_x'] = block['ball'][:, 0]
+    return df
+
+
+def read_npz(filepath):
+    """Reads a match converted to .npz into a dataframe with the layout of the CSV files"""
+    with np.load(filepath) as data:
+        arrays = {name: data[name] for name in data.files}
+    players = [tuple(player.split('_')) for player in arrays.pop('players')]
+    return block_to_dataframe(arrays, players)
+
+
+def read_npz_blocks(filepath, block_frames):
+    """Yields the dataframes of a match converted to .npz in blocks of block_frames frames, with
+    the layout and the index of the chunks of a CSV read with pd.read_csv(chunksize=...). The
+    arrays are read at once (about 200 bytes per frame), only the dataframes are built block by
+    block"""
+    with np.load(filepath) as data:
+        arrays = {name: data[name] for name in data.files}
+    players = [tuple(player.split('_')) for player in arrays.pop('players')]
+    for start in range(0, len(arrays['frame']), block_frames):
+        df = block_to_dataframe({name: array[start:start + block_frames]
+                                 for name, array in arrays.items()}, players)
+        df.index = pd.RangeIndex(start, start + len(df))
+        yield df
+
+
+def npz_columns(filepath):
+    """Columns of the dataframe of read_npz, reading only the players of the match"""
+    with np.load(filepath) as data:
+        players = [tuple(player.split('_')) for player in data['players']]
+    return (['frame'] + player_columns(players) +
+            ['ball_status', 'ball_owner', 'ball_speed', 'ball_z', 'ball_y', 'ball_x'])
+
+
+def convert(dat_path, metadata_xml, output_path, period=None, block_frames=BLOCK_FRAMES):
+    """
+    Converts the frame file of a match into the layout of data/processed, streaming it in blocks
+    of frames, and writes its metadata next to it
+
+    Parameters
+    -----------
+    dat_path: Tracab frame file
+    metadata_xml: Tracab metadata XML of the match (optional, None to convert every frame without
+        metadata)
+    output_path: .csv or .npz file. The .npz keeps the arrays of read_blocks, which are concatenated
+        in memory (about 200 bytes per frame) before they are written
+    period: convert only this period (e.g. 1 for the first half)
+
+    Returns
+    -----------
+    The metadata of the match
+    """
+    output_path = Path(output_path)
+    metadata = read_metadata(metadata_xml) if metadata_xml else empty_metadata()
+    periods = metadata['periods']
+    if period is not None:
+        periods = [p for p in periods if p['id'] == period]
+        if not periods:
+            raise TracabError(f'Period {period} is not in the metadata of {dat_path}')
+
+    players = find_players(dat_path, periods)
+    if not players:
+        raise TracabError(f'There are no players in {dat_path}')
+    for team, jersey in metadata['goalkeepers'].items():
+        if (team, jersey) not in players:
+            raise TracabError(f'The goalkeeper {jersey} of the {team} team is not in {dat_path}')
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    n_frames = 0
+    if output_path.suffix == '.npz':
+        blocks = list(read_blocks(dat_path, players, periods, block_frames))
+        arrays = {name: np.concatenate([block[name] for block in blocks]) for name in blocks[0]}
+        np.savez_compressed(output_path, players=np.array([f'{t}_{j}' for t, j in players]),
+                            **arrays)
+        n_frames = len(arrays['frame'])
+    else:
+        header = True
+        for block in read_blocks(dat_path, players, periods, block_frames):
+            block_to_dataframe(block, players).to_csv(output_path, mode='w' if header else 'a',
+                                                      header=header, index=False)
+            header = False
+            n_frames += len(block['frame'])
+
+    metadata = dict(metadata, source=str(dat_path), frames=n_frames,
+                    periods=periods, converted_players=[f'{t}_{j}' for t, j in players])
+    with open(metadata_path(output_path), 'w') as f:
+        json.dump(metadata, f, indent=2)
+    return metadata
@@ -1,24 +1,91 @@
 import re
+from pathlib import Path
+
 import numpy as np
 import pandas as pd
 
 
+from src.data import tracab
+from src.data.results import create_output_filename  # noqa: F401 (kept for old imports)
+from src.instrumentation.profiler import NULL_PROFILER
 from src.pitch_control import velocities
 
-
-def standardize_units(df):
-    """Convert position from cm to m and time to seconds"""
-    # Standardize position
+# Columns of the tracking files that the pitch control model does not use, dropped when the
+# files are read in compact mode
+UNUSED_COLUMNS = re.compile(r'referee_[0-9]+_[xy]|ball_z')
+
+
+def read_tracking_csv(filepath, compact=False, **kwargs):
+    """Reads a tracking file (kwargs are passed to pd.read_csv), a CSV or a .npz converted by
+    src/data/tracab.py
+
+    compact: read only the columns used by the model, the positions as float32 instead of
+    float64 and the team in possession as a category instead of strings. The positions are not
+    kept as integers because the players out of the frame are NaN
+    """
+    if Path(filepath).suffix == '.npz':
+        if set(kwargs) - {'nrows', 'chunksize'}:
+            raise ValueError(f'{filepath} can only be read whole, its first nrows or in chunks '
+                             f'(chunksize), convert it to CSV to use {sorted(kwargs)}')
+        if 'chunksize' in kwargs:
+            return (npz_dtypes(df, compact)
+                    for df in tracab.read_npz_blocks(filepath, kwargs['chunksize']))
+        if 'nrows' in kwargs:
+            return npz_dtypes(next(tracab.read_npz_blocks(filepath, kwargs['nrows'])), compact)
+        return npz_dtypes(tracab.read_npz(filepath), compact)
+    if not compact:
+        return pd.read_csv(filepath, **kwargs)
+    columns = read_tracking_columns(filepath)
+    usecols = [column for column in columns if not UNUSED_COLUMNS.fullmatch(column)]
+    dtype = {column: np.float32 for column in usecols if column[-2:] in ('_x', '_y')}
+    dtype['ball_owner'] = 'category'
+    return pd.read_csv(filepath, usecols=usecols, dtype=dtype, **kwargs)
+
+
+def npz_dtypes(df, compact):
+    """Types of the columns of a dataframe read from a .npz, as read_tracking_csv gives them for
+    a CSV"""
+    if compact:
+        df['ball_owner'] = df['ball_owner'].astype('category')
+        return df.drop(columns=[c for c in df.columns if UNUSED_COLUMNS.fullmatch(c)])
+    float32_columns = df.select_dtypes(np.float32).columns
+    return df.astype({column: float for column in float32_columns})
+
+
+def read_tracking_columns(filepath):
+    """Returns the columns of a tracking file (see read_tracking_csv) reading only its header"""
+    if Path(filepath).suffix == '.npz':
+        return tracab.npz_columns(filepath)
+    return list(pd.read_csv(filepath, nrows=0).columns)
+
+
+def standardize_units(df, first_row=0):
+    """Convert position from cm to m and time to seconds
+
+    first_row: number of rows of the match before the dataframe, when it is a chunk of it
+    """
+    # Standardize position (float32 columns stay float32)
     position_columns = [col for col in df.columns if
                         col.endswith('_x') or col.endswith('_y')]
     df[position_columns] /= 100
 
     # Standardize time
-    df['time'] = [time * 0.04 for time in range(len(df))]
+    df['time'] = np.arange(first_row, first_row + len(df)) * 0.04
 
     return df
 
 
+def memory_report(df, filepath):
+    """Returns the memory used by the tracking dataframe (MB) and the memory it would use with
+    every column of the file and the velocities stored in float64"""
+    columns = read_tracking_columns(filepath)
+    n_players = len(get_jersey_team(df))
+    float64_bytes = 8 * len(df) * (len(columns) + 1 + 3 * n_players)
+    used_bytes = df.memory_usage(deep=True).sum()
+    return {'tracking_mb': used_bytes / 2 ** 20, 'float64_mb': float64_bytes / 2 ** 20,
+            'reduction': 1 - used_bytes / float64_bytes}
+
+
 def get_jersey_team(data):
     """Returns the tuple (jersey,team) for each player"""
     player_ids = [(x.group(2), x.group(1)) for col in data.columns if
@@ -62,18 +129,25 @@ def remove_player(players, jersey_player_to_remove):
     return players
 
 
-def find_goalkeeper(team):
-    """Find the goalkeeper in team, identifying him/her as the player closest to goal at kick off"""
+def find_goalkeeper(team, goalkeepers=None):
+    """Find the goalkeeper in team, identifying him/her as the player closest to goal at kick off
+
+    goalkeepers: optional dictionary team -> jersey of the goalkeeper (e.g. from the metadata of
+    the match, see src/data/tracab.py). Only the halves of the pitch are found then
+    """
     # TODO what if the goalkeeper is substituted?
+    goalkeepers = goalkeepers or {}
     x_columns = [c for c in team.columns if c[-2:].lower() == '_x' and c[:4] in ['home']]
-    GK_col_home = team.iloc[0][x_columns].abs().astype(float).idxmax()
+    GK_col_home = f'home_{goalkeepers["home"]}_x' if 'home' in goalkeepers else \
+        team.iloc[0][x_columns].abs().astype(float).idxmax()
     GK_col_home_id = GK_col_home.split('_')[1]
     max_value_home = team.iloc[0][GK_col_home]
     symbol_home = 'left' if np.sign(max_value_home) == -1 else 'right' if np.sign(max_value_home) == 1 else ''
 
 
     x_columns = [c for c in team.columns if c[-2:].lower() == '_x' and c[:4] in ['away']]
-    GK_col_away = team.iloc[0][x_columns].abs().astype(float).idxmax()
+    GK_col_away = f'away_{goalkeepers["away"]}_x' if 'away' in goalkeepers else \
+        team.iloc[0][x_columns].abs().astype(float).idxmax()
     GK_col_away_id = GK_col_away.split('_')[1]
     max_value_away = team.iloc[0][GK_col_away]
     symbol_away = 'left' if np.sign(max_value_away) == -1 else 'right' if np.sign(max_value_away) == 1 else ''
@@ -112,15 +186,63 @@ def min_and_max_frame(df):
 
 def prepare_df(filepath,filename, frames_step=None,include_player_velocities=False,
                stamine_home=1.0,stamine_away=1.0 ,
-               positions_to_increase = ['Defender','Midfielder','Striker','Substitute']):
-    df = pd.read_csv(filepath)
-    df = standardize_units(df)
+               positions_to_increase = ['Defender','Midfielder','Striker','Substitute'],
+               profiler=None, profiles=None, teams=None, compact=False, goalkeepers=None):
+    """Reads and prepares the tracking data of a match
+
+    profiles: optional ProfileStore (see src/data/profiles.py). The players in it get the
+    position and max velocity of the store instead of the ones of this match
+    teams: dictionary side ('home', 'away') -> team name used to look up the store
+    compact: keep the positions and velocities in float32 and drop the unused columns, printing
+    the memory saved
+    goalkeepers: optional dictionary team -> jersey of the goalkeeper, found in the first frame
+    if not given
+    """
+    profiler = profiler or NULL_PROFILER
+    with profiler.stage('load_csv'):
+        df = read_tracking_csv(filepath, compact)
+    with profiler.stage('standardize_units'):
+        df = standardize_units(df)
     #print(len(df))
-    df = velocities.calculate_player_velocities(df)
+    with profiler.stage('velocities'):
+        df = velocities.calculate_player_velocities(df, dtype=np.float32 if compact else float)
     if any(pd.isnull(df['frame'])):
         exit(f'There are some NaNs in the frames utils!')
     df = df[df['ball_status']==1]
+    if compact:
+        report = memory_report(df, filepath)
+        profiler.observe('tracking_mb', report['tracking_mb'])
+        print(f'Tracking data: {report["tracking_mb"]:.1f} MB instead of '
+              f'{report["float64_mb"]:.1f} MB ({100 * report["reduction"]:.0f}% less)')
+
+    home_positions, away_positions = default_positions(df.columns)
+    percentile_function = None
+    if profiles is not None:
+        home_positions, away_positions = profiles.player_positions(teams, home_positions,
+                                                                   away_positions)
+        # The players that are not in the store use the velocities of this match
+        percentile_function = profiles.percentile_function(
+            teams, lambda team, jersey, q: np.percentile(df[f'{team}_{jersey}_total_v'].dropna(), q))
+
+    with profiler.stage('vmax_percentiles'):
+        home_velocities, away_velocities = velocities.calculate_player_vmax(df, home_positions,away_positions, 
+                                                                            include_player_velocities=include_player_velocities,
+                                                                            stamine_home=stamine_home,stamine_away=stamine_away,
+                                                                            percentile_function=percentile_function,
+                                                                            goalkeepers=goalkeepers)
+    
+
+    merged_home_df = home_velocities.merge(home_positions,left_index = True,right_index=True)
+
+    merged_away_df = away_velocities.merge(away_positions,left_index=True,right_index=True)
+
+    if frames_step:
+        df = select_every_n_rows(df, frames_step)
+    return df, merged_home_df, merged_away_df
 
+
+def default_positions(columns):
+    """Returns the dataframes with the position of each player of the home and away teams"""
     #Here as the user wont have the laliga data due to
     #the fact that it is not available to the public
     #we will have to create the player positions
@@ -130,7 +252,7 @@ def prepare_df(filepath,filename, frames_step=None,include_player_velocities=Fal
     away_positions = []
     set_indexes_home = set()
     set_indexes_away = set()
-    for column in df.columns:
+    for column in columns:
         if column.startswith('home'):
             shirt_number = column.split('_')[1]
             team = column.split('_')[0]
@@ -150,37 +272,4 @@ def prepare_df(filepath,filename, frames_step=None,include_player_velocities=Fal
 
     away_positions = pd.DataFrame(away_positions)
     away_positions.set_index('index', inplace=True)
-
-
-    home_velocities, away_velocities = velocities.calculate_player_vmax(df, home_positions,away_positions, 
-                                                                        include_player_velocities=include_player_velocities,
-                                                                        stamine_home=stamine_home,stamine_away=stamine_away)
-    
-
-    merged_home_df = home_velocities.merge(home_positions,left_index = True,right_index=True)
-
-    merged_away_df = away_velocities.merge(away_positions,left_index=True,right_index=True)
-
-    if frames_step:
-        df = select_every_n_rows(df, frames_step)
-    return df, merged_home_df, merged_away_df
-
-
-def create_output_filename(filename, include_velocities=None,
-                           home_stamine_factor=None, away_stamine_factor=None,
-                           positions=None):
-    suffix = ''
-    if include_velocities:
-        suffix += '_include_velocities'
-    if home_stamine_factor and not away_stamine_factor:
-        suffix += f'_sh_{home_stamine_factor}_as_1.0'
-    if away_stamine_factor and not home_stamine_factor:
-        suffix += f'_sh_1.0_as_{away_stamine_factor}'
-    if home_stamine_factor and away_stamine_factor:
-        suffix += f'_sh_{home_stamine_factor}_as_{away_stamine_factor}'
-    if positions:
-        for position in positions:
-            suffix += f'_{position}'
-        
-
-    return filename + suffix
+    return home_positions, away_positions
@@ -0,0 +1,129 @@
+import json
+import os
+import resource
+import socket
+import sys
+import time
+from pathlib import Path
+
+PROMETHEUS_PREFIX = 'pitch_control'
+
+
+def current_rss_bytes():
+    """Resident memory of the current process in bytes (peak resident memory if the current one
+    is not available in the platform)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes and macOS bytes
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def default_worker():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class MetricsExporter:
+    """
+    Writes machine readable progress counters of a run every 'interval' seconds, so that a
+    scheduler can spot stalled or slow jobs
+
+    __init__ Parameters
+    -----------
+    path: output file. Files ending in .prom are written in the Prometheus textfile format
+        (replaced atomically on each write), any other file gets one JSON line per write. The
+        path can contain {match} and {worker}, which are replaced by the labels
+    match: name of the match, used as label
+    total_frames: number of frames of the run, used for the ETA
+    worker: name of the worker, used as label. Default is <host>-<pid>
+    interval: minimum number of seconds between writes
+    profiler: optional Profiler whose counters (integrated cells, convergence failures) are
+        exported
+
+    methods include:
+    -----------
+    update(frames): adds processed frames and writes the metrics if the interval has passed
+    snapshot(): returns a dictionary with the current metrics
+    write(): writes the current metrics
+    close(): writes the final metrics of the run
+    """
+
+    def __init__(self, path, match, total_frames=None, worker=None, interval=10.,
+                 profiler=None):
+        self.match = match
+        self.worker = worker or default_worker()
+        self.path = Path(str(path).format(match=match, worker=self.worker))
+        self.prometheus = self.path.suffix == '.prom'
+        self.total_frames = total_frames
+        self.interval = interval
+        self.profiler = profiler
+        self.frames_done = 0
+        self.status = 'running'
+        self.start_time = time.time()
+        self.last_write = None
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.write()
+
+    def update(self, frames=1):
+        self.frames_done += frames
+        if time.time() - self.last_write >= self.interval:
+            self.write()
+
+    def snapshot(self):
+        now = time.time()
+        elapsed = now - self.start_time
+        counters = self.profiler.counters if self.profiler is not None else {}
+        frames_per_second = self.frames_done / elapsed if elapsed > 0 else 0.
+        eta = None
+        if self.total_frames is not None and frames_per_second > 0:
+            eta = max(self.total_frames - self.frames_done, 0) / frames_per_second
+        return {
+            'timestamp': now,
+            'match': self.match,
+            'worker': self.worker,
+            'status': self.status,
+            'elapsed_seconds': elapsed,
+            'frames_done': self.frames_done,
+            'frames_total': self.total_frames,
+            'frames_per_second': frames_per_second,
+            'cells_integrated': counters.get('integrated_cells', 0),
+            'cells_integrated_per_second': counters.get('integrated_cells', 0) / elapsed
+            if elapsed > 0 else 0.,
+            'convergence_failures': counters.get('convergence_failures', 0),
+            'rss_bytes': current_rss_bytes(),
+            'eta_seconds': eta,
+        }
+
+    def write(self):
+        snapshot = self.snapshot()
+        if self.prometheus:
+            self.write_prometheus(snapshot)
+        else:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(snapshot) + '\n')
+        self.last_write = time.time()
+
+    def write_prometheus(self, snapshot):
+        labels = f'match="{self.match}",worker="{self.worker}"'
+        lines = []
+        for name, value in snapshot.items():
+            if name in ('match', 'worker', 'status') or value is None:
+                continue
+            metric = f'{PROMETHEUS_PREFIX}_{name}'
+            kind = 'counter' if name in ('frames_done', 'cells_integrated',
+                                         'convergence_failures') else 'gauge'
+            lines.append(f'# TYPE {metric} {kind}')
+            lines.append(f'{metric}{{{labels}}} {value}')
+        lines.append(f'# TYPE {PROMETHEUS_PREFIX}_running gauge')
+        lines.append(f'{PROMETHEUS_PREFIX}_running{{{labels}}} {int(self.status == "running")}')
+        # Write and rename, so that the collector never reads a half written file
+        temporary = self.path.with_name(self.path.name + '.tmp')
+        with open(temporary, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temporary, self.path)
+
+    def close(self, status='finished'):
+        self.status = status
+        self.write()
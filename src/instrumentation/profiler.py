@@ -0,0 +1,136 @@
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class Profiler:
+    """
+    Collects the time spent in each stage of a run together with counters and observations of
+    the pitch control model. It is opt-in: code that receives profiler=None uses NULL_PROFILER,
+    which ignores every call.
+
+    __init__ Parameters
+    -----------
+    name: name of the run, stored in the report
+
+    methods include:
+    -----------
+    stage(name): context manager that adds the time spent inside it to the stage
+    add_time(name, elapsed): adds elapsed seconds to the stage
+    count(name, value): increases a counter
+    observe(name, value): stores count, sum, min and max of a value (e.g. integration steps)
+    observe_array(name, values): observes every value of an array
+    merge(other): adds the counters and observations of another Profiler, e.g. of a worker
+    report(): returns a dictionary with all the information collected
+    save(path): writes the report as JSON
+    """
+
+    enabled = True
+
+    def __init__(self, name=None):
+        self.name = name
+        self.stages = {}
+        self.counters = {}
+        self.observations = {}
+        self.start_time = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, elapsed):
+        stage = self.stages.setdefault(name, {'calls': 0, 'time': 0.})
+        stage['calls'] += 1
+        stage['time'] += elapsed
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        observation = self.observations.get(name)
+        if observation is None:
+            self.observations[name] = {'count': 1, 'sum': value, 'min': value, 'max': value}
+        else:
+            observation['count'] += 1
+            observation['sum'] += value
+            observation['min'] = min(observation['min'], value)
+            observation['max'] = max(observation['max'], value)
+
+    def observe_array(self, name, values):
+        if len(values) == 0:
+            return
+        minimum, maximum = values.min().item(), values.max().item()
+        observation = self.observations.setdefault(name, {'count': 0, 'sum': 0, 'min': minimum,
+                                                          'max': maximum})
+        observation['count'] += len(values)
+        observation['sum'] += values.sum().item()
+        observation['min'] = min(observation['min'], minimum)
+        observation['max'] = max(observation['max'], maximum)
+
+    def merge(self, other):
+        """Adds the counters and observations of another Profiler. Its stages are not added:
+        they are timed in other processes at the same time as the ones of this run"""
+        for name, value in other.counters.items():
+            self.count(name, value)
+        for name, other_observation in other.observations.items():
+            observation = self.observations.get(name)
+            if observation is None:
+                self.observations[name] = dict(other_observation)
+            else:
+                observation['count'] += other_observation['count']
+                observation['sum'] += other_observation['sum']
+                observation['min'] = min(observation['min'], other_observation['min'])
+                observation['max'] = max(observation['max'], other_observation['max'])
+
+    def report(self):
+        """Returns a dictionary with the stages, counters and observations of the run"""
+        total_time = time.perf_counter() - self.start_time
+        stages = {name: {'calls': stage['calls'],
+                         'total_s': stage['time'],
+                         'mean_ms': 1000 * stage['time'] / stage['calls'],
+                         'fraction': stage['time'] / total_time if total_time else 0.}
+                  for name, stage in self.stages.items()}
+        observations = {name: dict(observation, mean=observation['sum'] / observation['count'])
+                        for name, observation in self.observations.items()}
+        return {
+            'name': self.name,
+            'total_s': total_time,
+            'stages': stages,
+            'counters': dict(self.counters),
+            'observations': observations
+        }
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+class NullProfiler:
+    """Profiler with the same interface that does nothing, used when profiling is disabled"""
+
+    enabled = False
+
+    def stage(self, name):
+        return nullcontext()
+
+    def add_time(self, name, elapsed):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def observe_array(self, name, values):
+        pass
+
+    def merge(self, other):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
@@ -0,0 +1,56 @@
+"""
+Compute backends of the vectorized engine. A backend computes the three kernels of a frame:
+    times_to_intercept: time for each player to reach each cell (see
+        vectorized.times_to_intercept)
+    pitch_control_at_targets: early exits and integration of the cells, with the contribution
+        of each player (see vectorized.pitch_control_at_targets)
+    accumulate: sum of the contributions of each player in each zone (see zones.accumulate)
+with the arguments and results of NumpyBackend, the reference implementation with NumPy.
+PitchControl calls the kernels of the backend chosen by name, so the model code does not change
+with the backend.
+
+The other backends may need packages that are not installed on every host, so they are only
+imported when selected and get_backend raises BackendError if they are not available.
+conformance.py checks any backend against NumpyBackend on frames of a match.
+"""
+import importlib
+
+# Backends by name: module in this package and class, imported when they are selected
+BACKENDS = {
+    'numpy': ('numpy_backend', 'NumpyBackend'),
+    'numba': ('numba_backend', 'NumbaBackend'),
+}
+
+# Backends already created, by name
+loaded_backends = {}
+
+
+class BackendError(Exception):
+    pass
+
+
+def get_backend(name):
+    """Returns the backend with that name (see BACKENDS), raising BackendError if it can not be
+    used on this host"""
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown backend {name}, use one of {tuple(BACKENDS)}')
+    if name not in loaded_backends:
+        module, class_name = BACKENDS[name]
+        try:
+            module = importlib.import_module(f'{__name__}.{module}')
+        except ImportError as e:
+            raise BackendError(f'The {name} backend is not available on this host: {e}') from e
+        loaded_backends[name] = getattr(module, class_name)()
+    return loaded_backends[name]
+
+
+def available_backends():
+    """Returns the names of the backends that can be used on this host"""
+    available = []
+    for name in BACKENDS:
+        try:
+            get_backend(name)
+        except BackendError:
+            continue
+        available.append(name)
+    return available
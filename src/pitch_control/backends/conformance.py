@@ -0,0 +1,177 @@
+"""
+Conformance check of a backend against NumpyBackend. The inputs of the three kernels are taken
+from frames of a match (see frame_cases) and each kernel of the backend runs on the same inputs
+as the reference, so an error in one kernel does not spread to the others. The check also times
+both backends, so that the fastest one that conforms can be chosen on each host.
+"""
+import time
+
+import numpy as np
+
+from src.pitch_control.backends import BackendError, get_backend
+
+# Maximum absolute error allowed in the times to intercept, the pitch control of the cells and
+# the contributions. The zone sums add up to n_cells contributions, so their error is divided
+# by the number of cells
+CONFORMANCE_TOLERANCE = 1e-9
+KERNELS = ('times_to_intercept', 'pitch_control_at_targets', 'accumulate')
+
+
+def frame_cases(pitch_control, tracking, rows, offsides=True):
+    """
+    Inputs of the kernels in frames of a half
+
+    Parameters
+    -----------
+    pitch_control: PitchControl of the half, which gives the players, the grid, the zones and
+        the model parameters
+    tracking: TrackingArrays of the half (see src/data/shared_tracking.py)
+    rows: rows of the frames in tracking, the ones without ball are skipped
+    offsides: leave out the attacking players that are offside
+
+    Returns
+    -----------
+    List with a dictionary of inputs for each frame
+    """
+    reference = get_backend('numpy')
+    targets = pitch_control.targets.astype(pitch_control.dtype, copy=False)
+    cases = []
+    for index in rows:
+        ball_position = tracking.ball[index]
+        if np.isnan(ball_position).any():
+            continue
+        pitch_control.update_players_from_arrays(tracking, index)
+        attacking_team, defending_team, attacking_players, defending_players = \
+            pitch_control.select_players(tracking.frame[index], ball_position, offsides)
+        attacking, positions, velocities, vmax, lambdas, constant_values = \
+            pitch_control.player_inputs(attacking_players, defending_players)
+        tti = reference.times_to_intercept(targets, positions, velocities, vmax,
+                                           pitch_control.params['reaction_time'])
+        _, _, contributions, _, _ = reference.pitch_control_at_targets(
+            targets, ball_position.astype(pitch_control.dtype), tti, attacking, lambdas,
+            constant_values, pitch_control.params)
+        cases.append({
+            'frame': int(tracking.frame[index]),
+            'targets': targets,
+            'ball_position': ball_position.astype(pitch_control.dtype),
+            'positions': positions,
+            'velocities': velocities,
+            'vmax': vmax,
+            'tti': tti,
+            'attacking': attacking,
+            'lambdas': lambdas,
+            'constant_values': constant_values,
+            'params': pitch_control.params,
+            'labels': pitch_control.zone_labels([(attacking_team, attacking_players),
+                                                 (defending_team, defending_players)]),
+            'contributions': contributions,
+            'n_bins': len(pitch_control.zone_map) + 1,
+        })
+    return cases
+
+
+def run_kernels(backend, case):
+    """Runs the kernels of the backend on the inputs of a case, returning their outputs and the
+    time of each kernel"""
+    outputs, times = {}, {}
+    start = time.perf_counter()
+    outputs['times_to_intercept'] = backend.times_to_intercept(
+        case['targets'], case['positions'], case['velocities'], case['vmax'],
+        case['params']['reaction_time'])
+    times['times_to_intercept'] = time.perf_counter() - start
+    start = time.perf_counter()
+    outputs['pitch_control_at_targets'] = backend.pitch_control_at_targets(
+        case['targets'], case['ball_position'], case['tti'], case['attacking'], case['lambdas'],
+        case['constant_values'], case['params'])
+    times['pitch_control_at_targets'] = time.perf_counter() - start
+    start = time.perf_counter()
+    outputs['accumulate'] = backend.accumulate(case['labels'], case['contributions'],
+                                               case['n_bins'])
+    times['accumulate'] = time.perf_counter() - start
+    return outputs, times
+
+
+def check_backend(backend, cases, tolerance=CONFORMANCE_TOLERANCE):
+    """
+    Compares the kernels of a backend with the ones of NumpyBackend
+
+    Parameters
+    -----------
+    backend: name of the backend (see BACKENDS)
+    cases: inputs of the kernels, see frame_cases
+    tolerance: maximum error allowed (see CONFORMANCE_TOLERANCE)
+
+    Returns
+    -----------
+    Dictionary with the maximum error of each output, the cells with other integration steps or
+    convergence, the time of each kernel in both backends, the speedup and whether the backend
+    conforms
+    """
+    reference = get_backend('numpy')
+    candidate = get_backend(backend)
+    # The first call may compile the kernels, it is not timed
+    if cases:
+        run_kernels(candidate, cases[0])
+    errors = {'times_to_intercept': 0., 'PPCFatt': 0., 'PPCFdef': 0., 'contributions': 0.,
+              'zone_sums': 0.}
+    step_mismatches = convergence_mismatches = 0
+    reference_times = dict.fromkeys(KERNELS, 0.)
+    candidate_times = dict.fromkeys(KERNELS, 0.)
+    for case in cases:
+        expected, times = run_kernels(reference, case)
+        for kernel in KERNELS:
+            reference_times[kernel] += times[kernel]
+        outputs, times = run_kernels(candidate, case)
+        for kernel in KERNELS:
+            candidate_times[kernel] += times[kernel]
+
+        errors['times_to_intercept'] = max(errors['times_to_intercept'], max_error(
+            outputs['times_to_intercept'], expected['times_to_intercept']))
+        for name, output, output_expected in zip(('PPCFatt', 'PPCFdef', 'contributions'),
+                                                 outputs['pitch_control_at_targets'],
+                                                 expected['pitch_control_at_targets']):
+            errors[name] = max(errors[name], max_error(output, output_expected))
+        steps, converged = outputs['pitch_control_at_targets'][3:]
+        steps_expected, converged_expected = expected['pitch_control_at_targets'][3:]
+        step_mismatches += int(np.sum(steps != steps_expected))
+        convergence_mismatches += int(np.sum(converged != converged_expected))
+        errors['zone_sums'] = max(errors['zone_sums'], max_error(
+            outputs['accumulate'], expected['accumulate']) / len(case['targets']))
+
+    reference_time = sum(reference_times.values())
+    candidate_time = sum(candidate_times.values())
+    report = {
+        'backend': backend,
+        'reference': reference.name,
+        'frames': [case['frame'] for case in cases],
+        'max_errors': errors,
+        'step_mismatches': step_mismatches,
+        'convergence_mismatches': convergence_mismatches,
+        'reference_times_s': reference_times,
+        'candidate_times_s': candidate_times,
+        'speedup': reference_time / candidate_time if candidate_time else None,
+        'tolerance': tolerance,
+    }
+    report['passed'] = (all(error <= tolerance for error in errors.values()) and
+                        not convergence_mismatches)
+    return report
+
+
+def max_error(output, expected):
+    """Maximum absolute difference between two arrays, infinite if their shapes differ"""
+    output, expected = np.asarray(output, dtype=float), np.asarray(expected, dtype=float)
+    if output.shape != expected.shape:
+        return np.inf
+    if not output.size:
+        return 0.
+    # The players out of reach have an infinite time to intercept in both
+    same = (output == expected) | (np.isnan(output) & np.isnan(expected))
+    return float(np.max(np.where(same, 0., np.abs(output - expected))))
+
+
+def check_report(report):
+    """Raises BackendError if the backend does not conform to the reference"""
+    if not report['passed']:
+        raise BackendError(f'The {report["backend"]} backend differs from {report["reference"]}: '
+                           f'max errors {report["max_errors"]}, '
+                           f'{report["convergence_mismatches"]} cells with another convergence')
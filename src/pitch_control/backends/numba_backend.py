@@ -0,0 +1,103 @@
+"""
+Backend with the kernels compiled by numba, an optional dependency (pip install numba). The
+loops over the cells and the players run in machine code without the temporary arrays of
+NumPy: the integration advances each contested cell on its own and only evaluates the logistic
+of its candidate players.
+
+The kernels follow the operations of vectorized.py in the same order, so the results only
+differ by the rounding of the exponential. The integration is compiled for the fixed time step,
+the adaptive integrator (params['integrator']) uses the one of vectorized.py. The kernels are
+compiled on their first call for each dtype and cached next to this file.
+"""
+import math
+
+import numba
+import numpy as np
+
+from src.pitch_control import vectorized
+from src.pitch_control.backends.numpy_backend import NumpyBackend
+
+
+@numba.njit(cache=True)
+def times_to_intercept_kernel(targets, positions, velocities, vmax, reaction_time):
+    """Compiled vectorized.times_to_intercept"""
+    n_targets, n_players = targets.shape[0], positions.shape[0]
+    r_reaction = positions + velocities * reaction_time
+    tti = np.empty((n_targets, n_players), dtype=targets.dtype)
+    for i in range(n_targets):
+        for j in range(n_players):
+            dx = targets[i, 0] - r_reaction[j, 0]
+            dy = targets[i, 1] - r_reaction[j, 1]
+            tti[i, j] = reaction_time + math.sqrt(dx ** 2 + dy ** 2) / vmax[j]
+    return tti
+
+
+@numba.njit(cache=True)
+def integrate_fixed_step_kernel(ball_travel_time, tti, candidates, lambdas, constant_values,
+                                dt, tol, max_int_time):
+    """Compiled vectorized.integrate_fixed_step, cell by cell"""
+    n_cells, n_players = tti.shape
+    PPCF = np.zeros(tti.shape, dtype=tti.dtype)
+    steps = np.zeros(n_cells, dtype=np.int64)
+    converged = np.zeros(n_cells, dtype=np.bool_)
+    for c in range(n_cells):
+        start = ball_travel_time[c] - dt
+        size = math.ceil((ball_travel_time[c] + max_int_time - start) / dt)
+        ptot = 0.
+        i = 1
+        while 1 - ptot > tol and i < size:
+            T = start + i * dt
+            remaining = 1 - ptot
+            ptot = 0.
+            for j in range(n_players):
+                if candidates[c, j]:
+                    # math.exp gives inf instead of overflowing, so the logistic is 0
+                    probability = 1 / (1. + math.exp(constant_values[j] * (T - tti[c, j])))
+                    PPCF[c, j] += remaining * probability * (lambdas[j] * dt)
+                ptot += PPCF[c, j]
+            i += 1
+        steps[c] = i - 1
+        converged[c] = steps[c] + 1 < size
+    return PPCF, steps, converged
+
+
+@numba.njit(cache=True)
+def accumulate_kernel(labels, contributions, n_bins):
+    """Compiled zones.accumulate, adding the cells in the same order as the bincount"""
+    n_cells, n_players = contributions.shape
+    sums = np.zeros((n_players, n_bins))
+    for i in range(n_cells):
+        for j in range(n_players):
+            sums[j, labels[i, j]] += contributions[i, j]
+    return sums
+
+
+def integrate_fixed_step(ball_travel_time, tti, candidates, lambdas, constant_values, params):
+    """vectorized.integrate_fixed_step with the compiled kernel"""
+    return integrate_fixed_step_kernel(ball_travel_time, tti, candidates, lambdas,
+                                       constant_values, float(params['int_dt']),
+                                       float(params['model_converge_tol']),
+                                       float(params['max_int_time']))
+
+
+class NumbaBackend(NumpyBackend):
+    """
+    Kernels of the vectorized engine compiled by numba, with the interface of NumpyBackend
+    """
+
+    name = 'numba'
+
+    def times_to_intercept(self, targets, positions, velocities, vmax, reaction_time):
+        return times_to_intercept_kernel(np.ascontiguousarray(targets), positions, velocities,
+                                         vmax, float(reaction_time))
+
+    def pitch_control_at_targets(self, targets, ball_position, tti, attacking, lambdas,
+                                 constant_values, params):
+        integrate = None
+        if params['integrator'] == 'fixed':
+            integrate = integrate_fixed_step
+        return vectorized.pitch_control_at_targets(targets, ball_position, tti, attacking,
+                                                   lambdas, constant_values, params, integrate)
+
+    def accumulate(self, labels, contributions, n_bins):
+        return accumulate_kernel(np.ascontiguousarray(labels), contributions, n_bins)
@@ -0,0 +1,32 @@
+"""
+Reference backend, the NumPy kernels of vectorized.py and zones.py
+"""
+from src.pitch_control import vectorized, zones
+
+
+class NumpyBackend:
+    """
+    Kernels of the vectorized engine with NumPy arrays, the interface of every backend
+
+    methods include:
+    -----------
+    times_to_intercept(targets, positions, velocities, vmax, reaction_time): array
+        (n_targets, n_players) with the time for each player to reach each target
+    pitch_control_at_targets(targets, ball_position, tti, attacking, lambdas, constant_values,
+        params): PPCFatt, PPCFdef, contributions, steps and converged of the targets
+    accumulate(labels, contributions, n_bins): (n_players, n_bins) sums of the contributions of
+        each player in each zone
+    """
+
+    name = 'numpy'
+
+    def times_to_intercept(self, targets, positions, velocities, vmax, reaction_time):
+        return vectorized.times_to_intercept(targets, positions, velocities, vmax, reaction_time)
+
+    def pitch_control_at_targets(self, targets, ball_position, tti, attacking, lambdas,
+                                 constant_values, params):
+        return vectorized.pitch_control_at_targets(targets, ball_position, tti, attacking,
+                                                   lambdas, constant_values, params)
+
+    def accumulate(self, labels, contributions, n_bins):
+        return zones.accumulate(labels, contributions, n_bins)
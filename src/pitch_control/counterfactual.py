@@ -0,0 +1,60 @@
+"""
+Counterfactual pitch control without each player. Removing a player only changes the cells
+where he/she was the closest player of his/her team (which decides the early exits and which
+players are candidates) or one of the candidates of a contested cell. The other cells keep the
+surface of the frame. So the times to intercept of the frame are reused and only these cells
+are integrated again without the player, those of all the players in a single solve, instead
+of solving the whole frame once per player.
+
+The pitch control lost by the team of each player, summed over the cells, measures his/her
+marginal value in the frame (see PitchControl.counterfactual).
+"""
+import numpy as np
+
+from src.pitch_control import vectorized
+
+
+def removal_losses(targets, ball_position, tti, attacking, lambdas, constant_values, params,
+                   PPCFatt, PPCFdef):
+    """
+    Pitch control lost by the team of each player when he/she is removed from the frame
+
+    Parameters
+    -----------
+    targets, ball_position, tti, attacking, lambdas, constant_values, params: inputs of
+        vectorized.pitch_control_at_targets for the frame
+    PPCFatt, PPCFdef: surfaces of the attacking and defending teams with every player, the
+        output of vectorized.pitch_control_at_targets
+
+    Returns
+    -----------
+    lost: array (n_players,) with the pitch control of his/her team that each player adds,
+        summed over the cells
+    recomputed: array (n_players,) with the number of cells integrated again for each player
+    converged: whether every recomputed cell converged
+    """
+    n_players = tti.shape[1]
+    _, closest_att, closest_def, defending_first, attacking_first, candidates = \
+        vectorized.candidate_players(targets, ball_position, tti, attacking, params)
+    contested = ~(defending_first | attacking_first)
+    affected = ((closest_att[:, None] == np.arange(n_players)) |
+                (closest_def[:, None] == np.arange(n_players)) |
+                (contested[:, None] & candidates))
+
+    # The cells of every player are solved together, each row without its player: an infinite
+    # time to intercept means that the player is never the closest nor a candidate and never
+    # reaches the ball. A team without players then loses every cell in the early exit
+    cells, removed = np.nonzero(affected)
+    rows = np.arange(cells.size)
+    tti_without = tti[cells]
+    tti_without[rows, removed] = np.inf
+    with np.errstate(invalid='ignore', over='ignore'):
+        without_att, without_def, _, _, converged = vectorized.pitch_control_at_targets(
+            targets[cells], ball_position, tti_without, attacking, lambdas, constant_values,
+            params)
+
+    team_PPCF = np.where(attacking[removed], PPCFatt[cells], PPCFdef[cells])
+    team_without = np.where(attacking[removed], without_att, without_def)
+    lost = np.bincount(removed, weights=team_PPCF - team_without, minlength=n_players)
+    recomputed = np.bincount(removed, minlength=n_players)
+    return lost, recomputed, bool(np.all(converged))
@@ -0,0 +1,25 @@
+"""
+Probability that a player has arrived at the target at time T, 1 / (1 + exp(u)) with
+u = constant_value * (T - time_to_intercept) (see Eq 4 in Spearman, 2018 and
+Player.probability_intercept_ball). It is evaluated for every player in every step of the
+integration: logistic_scalar for the loops of the reference engine, with math.exp on Python
+floats instead of NumPy scalars, and logistic for the arrays of vectorized.py.
+"""
+import math
+
+import numpy as np
+
+# math.exp overflows above this argument, where the logistic is 0 in double precision
+MAX_EXPONENT = 709.
+
+
+def logistic_scalar(u):
+    """Logistic 1 / (1 + exp(u)) of a float"""
+    if u > MAX_EXPONENT:
+        return 0.
+    return 1 / (1. + math.exp(u))
+
+
+def logistic(u):
+    """Logistic 1 / (1 + exp(u)) of an array"""
+    return 1 / (1. + np.exp(u))
@@ -0,0 +1,119 @@
+"""
+Offside lines of every frame of a half at once. The same rule as check_offsides in
+pitch_control.py: the defending goalkeeper gives the half that the defending team defends, the
+offside line is the furthest of the second-deepest defender (goalkeeper included), the ball and
+the half-way line, plus a tolerance, and the attacking players beyond it are left out of the
+pitch control of the frame.
+
+The lines are computed from the position arrays of TrackingArrays (see
+src/data/shared_tracking.py) before the frames run, and PitchControl filters the attacking
+players with them (see PitchControl.set_offside_lines) instead of checking each frame. A frame
+whose defending goalkeeper is not in the frame does not stop the run as in check_offsides: its
+players are all kept and the frame is reported in missing_goalkeeper.
+"""
+import numpy as np
+
+from src.data.shared_tracking import TEAMS
+
+# Margin (m) that a player can be beyond the line without being offside
+OFFSIDE_TOLERANCE = 0.2
+
+
+class OffsideLines:
+    """
+    Offside lines of the frames of a half
+
+    __init__ Parameters
+    -----------
+    frame: (n_frames,) frame numbers, in increasing order
+    defending_half: (n_frames,) side defended by the defending team (-1: left goal, +1: right
+        goal, 0 if its goalkeeper is missing)
+    second_deepest_defender: (n_frames,) x of the second-deepest defender measured towards the
+        defended goal, -inf if there are less than two defenders
+    offside_line: (n_frames,) offside line measured towards the defended goal, tolerance included
+    onside: (n_frames, n_players) whether each player can take part in the frame, False only for
+        the attacking players beyond the offside line
+    missing_goalkeeper: (n_frames,) whether the defending goalkeeper is not in the frame
+    players: tag of the player in each column (see Player.tagname)
+
+    methods include:
+    -----------
+    row(frame): row of the frame, None if it is not in the lines
+    onside_players(row, players): the players that are not offside in the row
+    missing_goalkeeper_frames(): frame numbers without the defending goalkeeper
+    """
+
+    def __init__(self, frame, defending_half, second_deepest_defender, offside_line, onside,
+                 missing_goalkeeper, players):
+        self.frame = frame
+        self.defending_half = defending_half
+        self.second_deepest_defender = second_deepest_defender
+        self.offside_line = offside_line
+        self.onside = onside
+        self.missing_goalkeeper = missing_goalkeeper
+        self.players = list(players)
+        self.column_of_player = {tag: column for column, tag in enumerate(self.players)}
+
+    def __len__(self):
+        return len(self.frame)
+
+    def row(self, frame):
+        row = np.searchsorted(self.frame, frame)
+        if row < len(self.frame) and self.frame[row] == frame:
+            return row
+        return None
+
+    def onside_players(self, row, players):
+        return [p for p in players if self.onside[row, self.column_of_player[p.tagname]]]
+
+    def missing_goalkeeper_frames(self):
+        return self.frame[self.missing_goalkeeper]
+
+
+def compute_offside_lines(tracking, goalkeepers, tol=OFFSIDE_TOLERANCE):
+    """
+    Computes the offside lines of every frame of the tracking data
+
+    Parameters
+    -----------
+    tracking: TrackingArrays of the frames (see src/data/shared_tracking.py)
+    goalkeepers: dictionary team -> jersey of its goalkeeper, e.g. {'home': '1', 'away': '13'}
+    tol: tolerance, see check_offsides
+
+    Returns
+    -----------
+    OffsideLines of the frames
+    """
+    n_frames = len(tracking)
+    x = tracking.positions[..., 0]
+    inframe = ~np.isnan(x)
+    team_of_column = np.array([TEAMS.index(tag[:4]) for tag in tracking.players], dtype=int)
+
+    # The home team attacks when it has the ball, otherwise the away team (see solve_frame)
+    attacking = np.where(tracking.ball_owner == TEAMS.index('home'), 0, 1)
+    defending = 1 - attacking
+    defenders = (team_of_column[None, :] == defending[:, None]) & inframe
+
+    # Column of the goalkeeper of each team, -1 if he is not in the tracking data
+    goalkeeper_columns = np.array([tracking.column_of_player.get(f'{team}_{goalkeepers[team]}_',
+                                                                 -1) for team in TEAMS])
+    goalkeeper = goalkeeper_columns[defending]
+    rows = np.arange(n_frames)
+    missing_goalkeeper = (goalkeeper < 0) | ~inframe[rows, np.maximum(goalkeeper, 0)]
+    defending_half = np.where(missing_goalkeeper, 0.,
+                              np.sign(x[rows, np.maximum(goalkeeper, 0)]))
+
+    depth = np.where(defenders, defending_half[:, None] * x, -np.inf)
+    if depth.shape[1] >= 2:
+        second_deepest_defender = -np.partition(-depth, 1, axis=1)[:, 1]
+    else:
+        second_deepest_defender = np.full(n_frames, -np.inf)
+    # fmax ignores a missing ball as max() does in check_offsides
+    offside_line = np.fmax(np.fmax(second_deepest_defender,
+                                   defending_half * tracking.ball[:, 0]), 0.) + tol
+
+    attackers = (team_of_column[None, :] == attacking[:, None]) & inframe
+    offside = attackers & (defending_half[:, None] * x > offside_line[:, None])
+    offside[missing_goalkeeper] = False
+    return OffsideLines(tracking.frame, defending_half, second_deepest_defender, offside_line,
+                        ~offside, missing_goalkeeper, tracking.players)
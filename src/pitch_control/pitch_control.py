@@ -1,7 +1,22 @@
 import numpy as np
 import pandas as pd
+from src.instrumentation.profiler import NULL_PROFILER
+from src.pitch_control import vectorized, zones
+from src.pitch_control.backends import get_backend
+from src.pitch_control.counterfactual import removal_losses
+from src.pitch_control.offsides import compute_offside_lines
+from src.pitch_control.precision import PRECISIONS, PrecisionDeviation
+from src.pitch_control.queries import pitch_control_at_points
 from src.pitch_control.team import Team
 
+# 'reference' solves the model cell by cell and player by player, 'vectorized' solves all the
+# cells of the frame at once with NumPy arrays and 'surrogate' predicts the contested cells with
+# a trained SurrogateModel instead of integrating them (see surrogate.py)
+ENGINES = ('reference', 'vectorized', 'surrogate')
+# Cells solved at once by the vectorized and surrogate engines in the aggregates-only mode, which
+# bounds the (n_cells, n_players) arrays of a frame whatever the size of the grid
+AGGREGATE_CHUNK_CELLS = 2048
+
 
 class PitchControl:
     """
@@ -14,12 +29,58 @@ class PitchControl:
     individual_velocities: dataframe with the maximum velocity of each player
     field_dimen: x and y size of the field in meters
     n_grid_cells_x: number of cells in the horizontal dimension
+    engine: 'reference', 'vectorized' or 'surrogate' (see ENGINES)
+    profiler: optional Profiler that collects stage timings and model counters
+    goalkeepers: optional dictionary team -> jersey of the goalkeeper, e.g. from the metadata of
+        the match. By default the goalkeepers are found in the first frame
+    zone_map: zones where the contributions of the players are added, the name of a map or a
+        JSON file with polygons (see zones.create_zone_map). Default: the thirds of the pitch
+    counterfactual: also estimate in each frame the pitch control lost by the team of each
+        player without him/her (see counterfactual.py). Needs the vectorized engine
+    integrator: 'fixed' integrates the contested cells with the time step params['int_dt'],
+        'adaptive' with an error-controlled step of accuracy params['int_tol'] (see
+        vectorized.integrate_adaptive)
+    surrogate: SurrogateModel of the surrogate engine, trained with the same model parameters
+        (see surrogate.py)
+    aggregates_only: only accumulate the contributions of the players and the convergence
+        statistics of the frames, without keeping the surfaces (solve_frame returns None). The
+        reference engine adds the contributions of each cell to the zones of the players and the
+        vectorized and surrogate engines solve the cells in chunks of AGGREGATE_CHUNK_CELLS, so
+        their per-cell arrays do not grow with the grid beyond a chunk
+    precision: 'float64' or 'float32', dtype of the arrays of the vectorized engine, with the
+        per-player sums in float64 and a check of one frame out of every
+        precision.CHECK_INTERVAL against float64 (see precision.py)
+    backend: name of the backend that computes the times to intercept, the cells and the zone
+        sums of the vectorized and surrogate engines, 'numpy' or an accelerated one available
+        on the host (see backends/)
 
     methods include:
     -----------
-    calculate_cells: estimates the size of the cells in both directions
+    calculate_cells: estimates the size of the cells in both directions and their zones
+    reset_contributions: sets the accumulated contributions of all players to zero
+    set_offside_lines(tracking): precomputes the offside lines of the frames (see offsides.py)
     generate_pitch_control_for_event: estimates pitch control for the frame
+    generate_pitch_control_for_arrays: estimates pitch control for a frame of TrackingArrays
+    generate_pitch_control_at_points: estimates pitch control at query points of any frames
+    solve_frame: estimates pitch control once the players are updated
+    generate_surface_reference: pitch control surface solved cell by cell
+    generate_surface_vectorized: pitch control surface solved for all cells at once
+    accumulate_chunks: contributions of the frame solved in chunks of cells (aggregates only)
+    solve_cells: pitch control of a set of cells with the vectorized or surrogate engine
+    add_zone_contributions: adds the pitch control of the frame to the zones of the players
+    add_zone_PPCF: adds the sums of the contributions in each zone to the players
+    add_removal_losses: adds the pitch control lost without each player in the frame
+    check_precision: adds the deviation of the frame from float64 to precision_deviation
+    get_removal_impact: dataframe with the pitch control lost without each player
+    get_accumulated_contributions: array with the contributions accumulated by the players
+    get_convergence_stats: statistics of the checksums of the frames solved
     calculate_pitch_control_at_target: estimates pitch control for a single cell
+    integrate_adaptive_at_target: integrates a single cell with the adaptive step
+    update_players_from_arrays: updates the players for a frame of TrackingArrays
+    select_players: teams of the frame and their players in frame and onside
+    player_inputs: arrays of the players in the frame for the times to intercept
+    player_arrays: arrays of the players for vectorized.pitch_control_at_targets
+    zone_labels: zone of each cell (or of a slice of cells) for each player
     update_player(frame_data): updates the position and velocity for that frame
     simple_time_to_intercept(r_final): time take for player to get to target position (r_final)
     probability_intercept_ball(T): probability player will have controlled ball at time T
@@ -28,15 +89,54 @@ class PitchControl:
     def __init__(self, tracking_df,
                  include_individual_velocities=False, home_individual_velocities=None,
                  away_individual_velocities=None, home_stamine_factor=None, away_stamine_factor=None,
-                 field_dimen=(106., 68.,), n_grid_cells_x=50):
+                 field_dimen=(106., 68.,), n_grid_cells_x=50, engine='reference', profiler=None,
+                 goalkeepers=None, zone_map='thirds', counterfactual=False, integrator='fixed',
+                 surrogate=None, aggregates_only=False, precision='float64', backend='numpy'):
+        if engine not in ENGINES:
+            raise ValueError(f'Unknown engine {engine}, use one of {ENGINES}')
+        if integrator not in vectorized.INTEGRATORS:
+            raise ValueError(f'Unknown integrator {integrator}, use one of '
+                             f'{tuple(vectorized.INTEGRATORS)}')
+        if counterfactual and engine != 'vectorized':
+            raise ValueError('The counterfactual mode needs the vectorized engine')
+        if engine == 'surrogate' and surrogate is None:
+            raise ValueError('The surrogate engine needs a trained SurrogateModel')
+        if precision not in PRECISIONS:
+            raise ValueError(f'Unknown precision {precision}, use one of {PRECISIONS}')
+        if precision != 'float64' and engine != 'vectorized':
+            raise ValueError(f'The {precision} precision needs the vectorized engine')
+        if backend != 'numpy' and engine == 'reference':
+            raise ValueError(f'The reference engine solves the model cell by cell, the {backend} '
+                             f'backend needs the vectorized or the surrogate engine')
+        self.engine = engine
+        self.surrogate = surrogate if engine == 'surrogate' else None
+        self.backend = get_backend(backend)
+        self.aggregates_only = aggregates_only
+        # Running statistics of the checksums (mean pitch control of both teams over the cells)
+        # of the frames solved
+        self.checksum_frames = 0
+        self.checksum_sum = 0.
+        self.checksum_min = np.inf
+        self.dtype = np.dtype(precision)
+        # Deviation of the frames solved in float32 from float64
+        self.precision_deviation = PrecisionDeviation() if precision != 'float64' else None
+        self.counterfactual = counterfactual
+        # Cells integrated again without each player and the ones of solving the frame once
+        # per player
+        self.counterfactual_cells = 0
+        self.counterfactual_rerun_cells = 0
+        self.profiler = profiler or NULL_PROFILER
         self.field_dimen = field_dimen
         self.n_grid_cells_x = n_grid_cells_x
         self.n_grid_cells_y = None
         self.xgrid = None
         self.ygrid = None
-        self.first_zone = None
-        self.second_zone = None
-        self.third_zone = None
+        # (x, y) of every cell, row by row as in the surface, and their zones
+        self.targets = None
+        self.zone_map_spec = zone_map
+        self.zone_map = None
+        # Offside lines precomputed for the frames of the half, see set_offside_lines
+        self.offside_lines = None
         # This will populate n_grid and xygrid
         self.calculate_cells()
 
@@ -54,7 +154,10 @@ class PitchControl:
             'int_dt': 0.04,
             'max_int_time': 50,
             'model_converge_tol': 0.01,
-            'time_to_control_veto': 3
+            'time_to_control_veto': 3,
+            'integrator': integrator,
+            # Error allowed in each step of the adaptive integrator
+            'int_tol': 1e-3
         }
 
         # Computed parameters
@@ -64,14 +167,31 @@ class PitchControl:
                 np.sqrt(3) * self.params['tti_sigma'] / np.pi + 1 / self.params['lambda_att'])
         self.params['time_to_control_def'] = self.params['time_to_control_veto'] * np.log(10) * (
                 np.sqrt(3) * self.params['tti_sigma'] / np.pi + 1 / self.params['lambda_def'])
+        if self.surrogate is not None:
+            self.surrogate.check_params(self.params)
 
         # Store each team
         self.team_home = Team('home', tracking_df.head(1), self.params,
                               include_individual_velocities, home_individual_velocities,
-                              home_stamine_factor)
+                              home_stamine_factor, goalkeepers, len(self.zone_map))
         self.team_away = Team('away', tracking_df.head(1), self.params,
                               include_individual_velocities, away_individual_velocities,
-                              away_stamine_factor)
+                              away_stamine_factor, goalkeepers, len(self.zone_map))
+
+    def reset_contributions(self):
+        """Sets the accumulated contributions of all players to zero"""
+        self.team_home.reset_contributions()
+        self.team_away.reset_contributions()
+
+    def set_offside_lines(self, tracking):
+        """Computes the offside lines of all the frames of the TrackingArrays at once, which
+        solve_frame uses instead of check_offsides for these frames. Returns the OffsideLines"""
+        with self.profiler.stage('offsides'):
+            self.offside_lines = compute_offside_lines(
+                tracking, {team.name: team.gk_id for team in (self.team_home, self.team_away)})
+        self.profiler.count('missing_goalkeeper_frames',
+                            int(np.sum(self.offside_lines.missing_goalkeeper)))
+        return self.offside_lines
 
     def calculate_cells(self):
         self.n_grid_cells_y = int(self.n_grid_cells_x * self.field_dimen[1] / self.field_dimen[0])
@@ -80,10 +200,11 @@ class PitchControl:
         dy = self.field_dimen[1] / self.n_grid_cells_y
         self.ygrid = np.arange(self.n_grid_cells_y) * dy - self.field_dimen[1] / 2. + dy / 2.
 
-        self.first_zone = len(self.xgrid) / 3.
-        self.second_zone = len(self.xgrid) / 3. * 2
-        self.third_zone = len(self.xgrid)
-        
+        xx, yy = np.meshgrid(self.xgrid, self.ygrid)
+        self.targets = np.column_stack([xx.ravel(), yy.ravel()])
+        self.zone_map = zones.create_zone_map(self.zone_map_spec, self.xgrid, self.ygrid,
+                                              self.field_dimen)
+
     def generate_pitch_control_for_event(self, frame_data, offsides=True):
         """
         Evaluates pitch control surface over the entire field at the given frame
@@ -103,9 +224,78 @@ class PitchControl:
         # Update information for the current frame
         ball_position = [frame_data['ball_x'].iloc[0], frame_data['ball_y'].iloc[0]]
 
-        self.team_home.update_players(frame_data)
-        self.team_away.update_players(frame_data)
+        with self.profiler.stage('update_players'):
+            self.team_home.update_players(frame_data)
+            self.team_away.update_players(frame_data)
+
+        return self.solve_frame(frame_data['frame'].iloc[0], ball_position, offsides)
 
+    def generate_pitch_control_for_arrays(self, tracking, index, offsides=True):
+        """
+        Same as generate_pitch_control_for_event for the index-th frame of a TrackingArrays
+        (see src/data/shared_tracking.py), without building a dataframe for the frame
+        """
+        self.update_players_from_arrays(tracking, index)
+        return self.solve_frame(tracking.frame[index], list(tracking.ball[index]), offsides)
+
+    def update_players_from_arrays(self, tracking, index):
+        """Updates the players of both teams for the index-th frame of a TrackingArrays"""
+        with self.profiler.stage('update_players'):
+            ball_owner = tracking.ball_owner_name(index)
+            for team in (self.team_home, self.team_away):
+                columns = tracking.player_columns(team.players)
+                team.update_players_from_arrays(ball_owner, tracking.positions[index, columns],
+                                                tracking.velocities[index, columns])
+
+    def generate_pitch_control_at_points(self, tracking, frames, x, y, attribution=False,
+                                         offsides=True):
+        """
+        Evaluates pitch control only at the query points (frames[i], x[i], y[i]) of the frames
+        of a TrackingArrays, all of them at once (see queries.pitch_control_at_points). It does
+        not change the accumulated contributions of the players
+
+        Returns
+        -----------
+        Dataframe with the pitch control of both teams at each query and, with attribution, a
+        dataframe with the contribution of each player to each query
+        """
+        return pitch_control_at_points(self, tracking, frames, x, y, attribution, offsides)
+
+    def solve_frame(self, frame, ball_position, offsides=True):
+        """Evaluates the pitch control surface once the players have been updated for the frame
+        (see generate_pitch_control_for_event)"""
+        attacking_team, defending_team, attacking_players, defending_players = \
+            self.select_players(frame, ball_position, offsides)
+
+        if self.engine in ('vectorized', 'surrogate'):
+            PPCFa, PPCF_sum = self.generate_surface_vectorized(frame, attacking_team,
+                                                               defending_team, attacking_players,
+                                                               defending_players, ball_position)
+        else:
+            PPCFa, PPCF_sum = self.generate_surface_reference(frame, attacking_team,
+                                                              defending_team, attacking_players,
+                                                              defending_players, ball_position)
+
+        # Check probabilitiy sums within convergence
+        checksum = PPCF_sum / float(self.n_grid_cells_y * self.n_grid_cells_x)
+        self.checksum_frames += 1
+        self.checksum_sum += checksum
+        self.checksum_min = min(self.checksum_min, checksum)
+        if 1 - checksum > self.params['model_converge_tol']:
+            self.profiler.count('checksum_failures')
+            raise AssertionError(f'Checksum failed {1 - checksum}')
+
+        return PPCFa
+
+    def select_players(self, frame, ball_position, offsides=True):
+        """
+        Teams of the frame and their players that take part in the pitch control: the players in
+        frame, without the attacking players that are offside
+
+        Returns
+        -----------
+        attacking_team, defending_team, attacking_players, defending_players
+        """
         attacking_team = self.team_home if self.team_home.possession == 'attacking' else self.team_away
         defending_team = self.team_home if self.team_home.possession == 'defending' else self.team_away
 
@@ -115,12 +305,47 @@ class PitchControl:
 
         # Find any attacking players that are offside and remove them from calculation
         if offsides:
-            attacking_players = check_offsides(attacking_players, defending_players,
-                                               ball_position, defending_team.gk_id)
+            row = None if self.offside_lines is None else self.offside_lines.row(frame)
+            if row is not None:
+                attacking_players = self.offside_lines.onside_players(row, attacking_players)
+            else:
+                attacking_players = check_offsides(attacking_players, defending_players,
+                                                   ball_position, defending_team.gk_id)
+
+        return attacking_team, defending_team, attacking_players, defending_players
+
+    def generate_surface_reference(self, frame, attacking_team, defending_team,
+                                   attacking_players, defending_players, ball_position):
+        """
+        Evaluates the pitch control surface cell by cell with calculate_pitch_control_at_target
+        and adds the contributions of the players to their zones
 
-        # Initialise pitch control grids for attacking and defending teams
-        PPCFa = np.zeros(shape=(len(self.ygrid), len(self.xgrid)))
-        PPCFd = np.zeros(shape=(len(self.ygrid), len(self.xgrid)))
+        Returns
+        -----------
+        PPCFa: Pitch control surface for the attacking team, None in the aggregates-only mode
+        PPCF_sum: Pitch control of both teams summed over the cells
+        """
+        # Initialise pitch control grid for the attacking team, not kept in the aggregates-only
+        # mode, and the sum of both teams
+        PPCFa = None
+        if not self.aggregates_only:
+            PPCFa = np.zeros(shape=(len(self.ygrid), len(self.xgrid)))
+        PPCF_sum = 0.
+        players = attacking_team.players + defending_team.players
+        team_players = [(attacking_team, attacking_team.players),
+                        (defending_team, defending_team.players)]
+        if self.aggregates_only:
+            # Sums of the contributions of each player in each zone, added cell by cell in the
+            # order of the bincount of add_zone_contributions
+            zone_PPCF = np.zeros((len(players), len(self.zone_map) + 1))
+            rows = np.arange(len(players))
+            # Zone of each cell for the players of each team
+            team_labels = np.stack([self.zone_map.cell_labels(team.team_half)
+                                    for team, _ in team_players])
+            player_teams = np.repeat([0, 1], [len(team_players[0][1]), len(team_players[1][1])])
+        else:
+            # Contribution of each player of both teams in each cell, row by row
+            contributions = np.zeros((len(self.targets), len(players)))
 
         # Calculate pitch control model at each location on the pitch
         for i in range(len(self.ygrid)):
@@ -131,27 +356,269 @@ class PitchControl:
                     # this updates all the players even though we will only use the ones contained
                     # in attacking_players and defending_players. If we used attacking_team.players
                     # we would lose the inframe and offside filters
-                    attacking_team.update_players_time_to_intercept(target_position)
-                    defending_team.update_players_time_to_intercept(target_position)
+                    with self.profiler.stage('time_to_intercept'):
+                        attacking_team.update_players_time_to_intercept(target_position)
+                        defending_team.update_players_time_to_intercept(target_position)
+
+                    with self.profiler.stage('integration'):
+                        PPCFatt, PPCFdef = self.calculate_pitch_control_at_target(
+                            target_position, attacking_players, defending_players, ball_position)
+                    PPCF_sum += PPCFatt + PPCFdef
+                    if PPCFa is not None:
+                        PPCFa[i, j] = PPCFatt
+
+                    with self.profiler.stage('attribution'):
+                        cell = i * len(self.xgrid) + j
+                        if self.aggregates_only:
+                            zone_PPCF[rows, team_labels[player_teams, cell]] += \
+                                [p.PPCF for p in players]
+                        else:
+                            contributions[cell] = [p.PPCF for p in players]
 
-                    flag = self.get_flag_zone(j)
+                except (BallMissingError, ConvergenceError, ProbabilityEstimationError,
+                        MissingGoalKeeper) as e:
+                    raise AssertionError(f'Caught a custom exception {e} in frame {frame}')
 
-                    PPCFa[i, j], PPCFd[i, j] = self.calculate_pitch_control_at_target(
-                        target_position, attacking_players, defending_players, ball_position)
+        with self.profiler.stage('attribution'):
+            if self.aggregates_only:
+                self.add_zone_PPCF(team_players, zone_PPCF)
+            else:
+                self.add_zone_contributions(team_players, contributions)
+        return PPCFa, PPCF_sum
 
-                    attacking_team.update_players_PCCF(flag)
-                    defending_team.update_players_PCCF(flag)
+    def generate_surface_vectorized(self, frame, attacking_team, defending_team,
+                                    attacking_players, defending_players, ball_position):
+        """
+        Evaluates the pitch control surface for all the cells at once (see vectorized.py) and
+        adds the contribution of each player to its zones, with the same results as
+        generate_surface_reference up to rounding
 
-                except (BallMissingError, ConvergenceError, ProbabilityEstimationError,
-                        MissingGoalKeeper) as e:
-                    raise AssertionError(f'Caught a custom exception {e} in frame {frame_data.frame.iloc[0]}')
+        Returns
+        -----------
+        PPCFa: Pitch control surface for the attacking team, None in the aggregates-only mode
+        PPCF_sum: Pitch control of both teams summed over the cells
+        """
+        if ball_position is None or any(np.isnan(ball_position)):
+            raise AssertionError(f'Caught a custom exception ball is not present in the frame '
+                                 f'in frame {frame}')
+
+        players = attacking_players + defending_players
+        team_players = [(attacking_team, attacking_players), (defending_team, defending_players)]
+        # The precision checks and the counterfactual need the arrays of the whole frame
+        check = self.precision_deviation is not None and self.precision_deviation.should_check()
+        if self.aggregates_only and not check and not self.counterfactual:
+            return None, self.accumulate_chunks(frame, team_players, ball_position)
+
+        attacking, tti, lambdas, constant_values = self.player_arrays(attacking_players,
+                                                                      defending_players)
+        PPCFatt, PPCFdef, contributions = self.solve_cells(frame, self.targets, ball_position,
+                                                           tti, attacking, lambdas,
+                                                           constant_values)
+
+        if check:
+            with self.profiler.stage('precision_check'):
+                self.check_precision(attacking_players, defending_players, ball_position,
+                                     PPCFatt, contributions)
+
+        with self.profiler.stage('attribution'):
+            self.add_zone_contributions(team_players, contributions)
+
+        if self.counterfactual:
+            with self.profiler.stage('counterfactual'):
+                self.add_removal_losses(players, ball_position, tti, attacking, lambdas,
+                                        constant_values, PPCFatt, PPCFdef)
+
+        PPCF_sum = PPCFatt.sum(dtype=float) + PPCFdef.sum(dtype=float)
+        if self.aggregates_only:
+            return None, PPCF_sum
+        return PPCFatt.reshape(self.n_grid_cells_y, self.n_grid_cells_x), PPCF_sum
+
+    def accumulate_chunks(self, frame, team_players, ball_position):
+        """
+        Solves the cells of the frame in chunks of AGGREGATE_CHUNK_CELLS and adds their
+        contributions to the zones of the players, without building the (n_cells, n_players)
+        arrays of the whole frame (aggregates-only mode)
 
-        # Check probabilitiy sums within convergence
-        checksum = np.sum(PPCFa + PPCFd) / float(self.n_grid_cells_y * self.n_grid_cells_x)
-        if 1 - checksum > self.params['model_converge_tol']:
-            raise AssertionError(f'Checksum failed {1 - checksum}')
+        Parameters
+        -----------
+        frame: number of the frame, for the errors
+        team_players: list of (team, players) of the frame, the attacking team first
+        ball_position: position of the ball
 
-        return PPCFa
+        Returns
+        -----------
+        Pitch control of both teams summed over the cells
+        """
+        (_, attacking_players), (_, defending_players) = team_players
+        attacking, positions, velocities, vmax, lambdas, constant_values = self.player_inputs(
+            attacking_players, defending_players)
+        targets = self.targets.astype(self.dtype, copy=False)
+        n_bins = len(self.zone_map) + 1
+        zone_PPCF = np.zeros((len(attacking), n_bins))
+        PPCF_sum = 0.
+        for start in range(0, len(targets), AGGREGATE_CHUNK_CELLS):
+            cells = slice(start, start + AGGREGATE_CHUNK_CELLS)
+            with self.profiler.stage('time_to_intercept'):
+                tti = self.backend.times_to_intercept(targets[cells], positions, velocities,
+                                                      vmax, self.params['reaction_time'])
+            PPCFatt, PPCFdef, contributions = self.solve_cells(frame, targets[cells],
+                                                               ball_position, tti, attacking,
+                                                               lambdas, constant_values)
+            with self.profiler.stage('attribution'):
+                zone_PPCF += self.backend.accumulate(self.zone_labels(team_players, cells),
+                                                     contributions, n_bins)
+            PPCF_sum += PPCFatt.sum(dtype=float) + PPCFdef.sum(dtype=float)
+        with self.profiler.stage('attribution'):
+            self.add_zone_PPCF(team_players, zone_PPCF)
+        return PPCF_sum
+
+    def solve_cells(self, frame, targets, ball_position, tti, attacking, lambdas,
+                    constant_values):
+        """
+        Pitch control of the targets with the vectorized engine (integrated by the backend) or
+        the surrogate engine, counting the early exits and the integrated cells
+
+        Returns
+        -----------
+        PPCFatt, PPCFdef: arrays (n_targets,) with the pitch control of each team
+        contributions: array (n_targets, n_players) with the pitch control of each player
+        """
+        if self.engine == 'surrogate':
+            solve, stage = self.surrogate.pitch_control_at_targets, 'surrogate'
+        else:
+            solve, stage = self.backend.pitch_control_at_targets, 'integration'
+        with self.profiler.stage(stage):
+            PPCFatt, PPCFdef, contributions, steps, converged = solve(
+                targets.astype(self.dtype, copy=False),
+                np.array(ball_position, dtype=self.dtype), tti, attacking, lambdas,
+                constant_values, self.params)
+        integrated = steps > 0
+        self.profiler.count('early_exit_cells', int(np.sum(~integrated)))
+        self.profiler.count('integrated_cells', int(np.sum(integrated)))
+        self.profiler.observe_array('integration_steps', steps[integrated])
+        if not np.all(converged):
+            self.profiler.count('convergence_failures', int(np.sum(~converged)))
+            ptot = PPCFatt[~converged] + PPCFdef[~converged]
+            raise AssertionError(f'Caught a custom exception Integration failed to converge: '
+                                 f'{ptot.min()} in frame {frame}')
+        return PPCFatt, PPCFdef, contributions
+
+    def player_inputs(self, attacking_players, defending_players, dtype=None):
+        """
+        Arrays of the players of the frame, the attacking players first, in dtype (the one of the
+        precision by default)
+
+        Returns
+        -----------
+        attacking: boolean array (n_players,), True for the attacking players
+        positions, velocities: arrays (n_players, 2) with the position and velocity of each player
+        vmax: array (n_players,) with the maximum speed of each player
+        lambdas: array (n_players,) with the ball control rate of each player
+        constant_values: array (n_players,) with the constant of the intercept probability
+        """
+        dtype = dtype or self.dtype
+        players = attacking_players + defending_players
+        attacking = np.arange(len(players)) < len(attacking_players)
+        lambdas = np.array([p.lambda_att for p in attacking_players] +
+                           [p.lambda_def for p in defending_players], dtype)
+        return (attacking, np.array([p.position for p in players], dtype),
+                np.array([p.velocity for p in players], dtype),
+                np.array([p.vmax for p in players], dtype), lambdas,
+                np.array([p.constant_value for p in players], dtype))
+
+    def player_arrays(self, attacking_players, defending_players, dtype=None, backend=None):
+        """
+        Arrays of the players of the frame for vectorized.pitch_control_at_targets, the attacking
+        players first, in dtype (the one of the precision by default), with the times to
+        intercept computed by the backend (the one of the PitchControl by default)
+
+        Returns
+        -----------
+        attacking: boolean array (n_players,), True for the attacking players
+        tti: array (n_cells, n_players) with the time to intercept of each player at each cell
+        lambdas: array (n_players,) with the ball control rate of each player
+        constant_values: array (n_players,) with the constant of the intercept probability
+        """
+        dtype = dtype or self.dtype
+        attacking, positions, velocities, vmax, lambdas, constant_values = self.player_inputs(
+            attacking_players, defending_players, dtype)
+        with self.profiler.stage('time_to_intercept'):
+            tti = (backend or self.backend).times_to_intercept(
+                self.targets.astype(dtype, copy=False), positions, velocities, vmax,
+                self.params['reaction_time'])
+        return attacking, tti, lambdas, constant_values
+
+    def check_precision(self, attacking_players, defending_players, ball_position, PPCFatt,
+                        contributions):
+        """Solves the frame again in float64 and adds the deviation of the surface and of the
+        contributions solved in the precision of the engine to precision_deviation"""
+        attacking, tti, lambdas, constant_values = self.player_arrays(
+            attacking_players, defending_players, np.dtype(float), get_backend('numpy'))
+        reference_att, _, reference_contributions, _, _ = vectorized.pitch_control_at_targets(
+            self.targets, np.array(ball_position, dtype=float), tti, attacking, lambdas,
+            constant_values, self.params)
+        self.precision_deviation.add(PPCFatt, reference_att, contributions,
+                                     reference_contributions)
+
+    def add_zone_contributions(self, team_players, contributions):
+        """
+        Adds the pitch control of the frame to the zones of the players with a single weighted
+        bincount over the zone raster (see zones.accumulate), computed by the backend
+
+        Parameters
+        -----------
+        team_players: list of (team, players) in the order of the columns of contributions
+        contributions: (n_cells, n_players) pitch control of each player in each cell, row by row
+        """
+        zone_PPCF = self.backend.accumulate(self.zone_labels(team_players), contributions,
+                                            len(self.zone_map) + 1)
+        self.add_zone_PPCF(team_players, zone_PPCF)
+
+    def add_zone_PPCF(self, team_players, zone_PPCF):
+        """Adds to the players of team_players, a list of (team, players), the rows of zone_PPCF
+        (n_players, len(zone_map) + 1), their sums in each zone and outside every zone"""
+        start = 0
+        for team, players in team_players:
+            team.add_players_zone_PPCF(dict(zip(players, zone_PPCF[start:start + len(players)])))
+            start += len(players)
+
+    def zone_labels(self, team_players, cells=slice(None)):
+        """(n_cells, n_players) zone of each cell (of the slice cells) for each player of
+        team_players, a list of (team, players), with len(zone_map) for the cells outside every
+        zone"""
+        return np.column_stack([self.zone_map.cell_labels(team.team_half)[cells]
+                                for team, players in team_players for _ in players])
+
+    def add_removal_losses(self, players, ball_position, tti, attacking, lambdas,
+                           constant_values, PPCFatt, PPCFdef):
+        """Adds to the players the pitch control lost by their team without each of them in the
+        frame, reusing the times to intercept and the surfaces of the frame (see
+        counterfactual.removal_losses)"""
+        lost, recomputed, converged = removal_losses(
+            self.targets.astype(self.dtype, copy=False), np.array(ball_position, self.dtype),
+            tti, attacking, lambdas, constant_values, self.params, PPCFatt, PPCFdef)
+        self.counterfactual_cells += int(recomputed.sum())
+        self.counterfactual_rerun_cells += len(self.targets) * len(players)
+        self.profiler.count('counterfactual_cells', int(recomputed.sum()))
+        if not converged:
+            self.profiler.count('counterfactual_convergence_failures')
+        for player, value in zip(players, lost):
+            player.PPCF_lost += value
+            player.counterfactual_frames += 1
+
+    def get_removal_impact(self):
+        """Returns a dataframe with the pitch control lost by the team of each player without
+        him/her, in total and per frame where the player took part"""
+        impact = []
+        for team in (self.team_home, self.team_away):
+            for player in team.players:
+                frames = player.counterfactual_frames
+                impact.append({'id': player.id, 'team': team.name, 'frames': frames,
+                               'PPCF_lost': player.PPCF_lost,
+                               'PPCF_lost_per_frame': player.PPCF_lost / frames if frames
+                               else 0.})
+        return pd.DataFrame(impact).sort_values('PPCF_lost', ascending=False,
+                                                ignore_index=True)
 
     def calculate_pitch_control_at_target(self, target_position, attacking_players,
                                           defending_players, ball_position):
@@ -188,9 +655,11 @@ class PitchControl:
         # to solve the pitch control model
         if tau_min_att - max(ball_travel_time, tau_min_def) >= self.params['time_to_control_def']:
             closest_player_def.PPCF += 1
+            self.profiler.count('early_exit_cells')
             return 0., 1.
         elif tau_min_def - max(ball_travel_time, tau_min_att) >= self.params['time_to_control_att']:
             closest_player_att.PPCF += 1
+            self.profiler.count('early_exit_cells')
             return 1., 0.
         else:
             # Solve pitch control model by integrating equation 3 in Spearman et al.
@@ -202,6 +671,9 @@ class PitchControl:
             defending_players = [p for p in defending_players if
                                  p.time_to_intercept - tau_min_def < self.params[
                                      'time_to_control_def']]
+            if self.params['integrator'] == 'adaptive':
+                return self.integrate_adaptive_at_target(ball_travel_time, attacking_players,
+                                                         defending_players)
             # Set up integration arrays
             dT_array = np.arange(ball_travel_time - self.params['int_dt'],
                                  ball_travel_time + self.params['max_int_time'],
@@ -236,60 +708,102 @@ class PitchControl:
                 ptot = PPCF_defending_team[i] + PPCF_attacking_team[i]
                 i += 1
 
+            self.profiler.count('integrated_cells')
+            self.profiler.observe('integration_steps', i - 1)
             if i >= dT_array.size:
+                self.profiler.count('convergence_failures')
                 raise ConvergenceError(f'Integration failed to converge: {ptot}')
 
             return PPCF_attacking_team[i - 1], PPCF_defending_team[i - 1]
 
+    def integrate_adaptive_at_target(self, ball_travel_time, attacking_players,
+                                     defending_players):
+        """
+        Integrates the cell with the adaptive time step of vectorized.integrate_adaptive, player
+        by player, for the candidate players of calculate_pitch_control_at_target
+
+        Returns
+        -----------
+        PPCFatt: Pitch control probability for the attacking team
+        PPCFdef: Pitch control probability for the defending team
+        """
+        tol = self.params['model_converge_tol']
+        int_tol = self.params['int_tol']
+        players = attacking_players + defending_players
+        lambdas = ([p.lambda_att for p in attacking_players] +
+                   [p.lambda_def for p in defending_players])
+
+        def control_rate(T):
+            return [lambda_value * p.probability_intercept_ball(T)
+                    for p, lambda_value in zip(players, lambdas)]
+
+        T = ball_travel_time
+        end = ball_travel_time + self.params['max_int_time']
+        dt = self.params['int_dt']
+        remaining = 1.
+        a_start = control_rate(T)
+        steps = 0
+        while True:
+            dt = min(dt, end - T)
+            a_half = control_rate(T + dt / 2)
+            a_end = control_rate(T + dt)
+            r2, r3, r4, r_end = vectorized.runge_kutta_remaining(remaining, dt, sum(a_start),
+                                                                 sum(a_half), sum(a_end))
+            error = dt / 6 * abs(r4 - r_end) * max(a_end)
+            steps += 1
+
+            if error <= int_tol and r_end > 0:
+                weights = (dt / 6 * remaining, dt / 3 * (r2 + r3), dt / 6 * r4)
+                if r_end <= tol:
+                    weights = vectorized.last_step_weights(dt, remaining, r_end, *weights, tol)
+                for player, values in zip(players, zip(a_start, a_half, a_end)):
+                    dPPCF = sum(w * value for w, value in zip(weights, values))
+                    if dPPCF < 0:
+                        raise ProbabilityEstimationError('Invalid player probability')
+                    player.PPCF += dPPCF
+                if r_end <= tol:
+                    break
+                T, remaining, a_start = T + dt, r_end, a_end
+                if T >= end:
+                    self.profiler.count('convergence_failures')
+                    raise ConvergenceError(f'Integration failed to converge: {1 - remaining}')
+            dt = dt * float(vectorized.next_step_factor(error, r_end, int_tol))
+
+        self.profiler.count('integrated_cells')
+        self.profiler.observe('integration_steps', steps)
+        return (sum(p.PPCF for p in attacking_players),
+                sum(p.PPCF for p in defending_players))
+
     def get_individual_contributions(self):
         """Returns a dataframe with the individual contributions from each player in the frame"""
+        columns = self.zone_map.columns()
         player_attributes = []
-        for player in self.team_home.players:
-            player_attributes.append({
-                'id': player.id,
-                'team': self.team_home.name,
-                'PPCF': player.PPCF_total,
-                'PPCF_attacking_first_zone' : player.PPCF_attacking_first_zone,
-                'PPCF_attacking_second_zone' : player.PPCF_attacking_second_zone,
-                'PPCF_attacking_third_zone' : player.PPCF_attacking_third_zone,
-                'PPCF_defending_first_zone' : player.PPCF_defending_first_zone,
-                'PPCF_defending_second_zone' : player.PPCF_defending_second_zone,
-                'PPCF_defending_third_zone' : player.PPCF_defending_third_zone
-            })
-
-        for player in self.team_away.players:
-            player_attributes.append({
-                'id': player.id,
-                'team': self.team_away.name,
-                'PPCF': player.PPCF_total,
-                'PPCF_attacking_first_zone' : player.PPCF_attacking_first_zone,
-                'PPCF_attacking_second_zone' : player.PPCF_attacking_second_zone,
-                'PPCF_attacking_third_zone' : player.PPCF_attacking_third_zone,
-                'PPCF_defending_first_zone' : player.PPCF_defending_first_zone,
-                'PPCF_defending_second_zone' : player.PPCF_defending_second_zone,
-                'PPCF_defending_third_zone' : player.PPCF_defending_third_zone
-            })
+        for team in (self.team_home, self.team_away):
+            for player in team.players:
+                attributes = {'id': player.id, 'team': team.name, 'PPCF': player.PPCF_total}
+                attributes.update(zip(columns, player.PPCF_zones.ravel()))
+                player_attributes.append(attributes)
 
         df = pd.DataFrame(player_attributes)
         return df
 
+    def get_accumulated_contributions(self):
+        """Returns the values of get_individual_contributions in an array (n_players, n_columns),
+        without building the dataframe (see analysis.RunningContributions)"""
+        return np.array([[player.PPCF_total, *player.PPCF_zones.ravel()]
+                         for team in (self.team_home, self.team_away) for player in team.players])
+
+    def get_convergence_stats(self):
+        """Returns the number of frames solved and the mean and minimum of their checksums"""
+        frames = self.checksum_frames
+        return {'frames': frames, 'mean_checksum': self.checksum_sum / frames if frames else None,
+                'min_checksum': self.checksum_min if frames else None}
+
     def get_vmax_df(self):
         home_velocities_df = self.team_home.get_players_vmax()
         away_velocities_df = self.team_away.get_players_vmax()
         df = pd.concat([home_velocities_df, away_velocities_df], ignore_index=True)
         return df
-    def get_flag_zone(self,j):
-        # Check the zone and set the flag variable accordingly
-        if j < self.first_zone:
-            flag = 'first'
-        elif self.first_zone <= j < self.second_zone:
-            flag = 'second'
-        elif self.second_zone <= j < self.third_zone:
-            flag = 'third'
-        else:
-            flag = 'outside'
-            raise outoffieldError('you are out of the field')
-        return flag
 
 
 class BallMissingError(Exception):
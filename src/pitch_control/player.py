@@ -1,5 +1,7 @@
 import numpy as np
 
+from src.pitch_control.kernels import logistic_scalar
+
 
 class Player:
     """
@@ -14,16 +16,19 @@ class Player:
     is_gk: flag to indicate if he is the goalkeeper
     include_individual_velocities: flag to indicate if individual max velocities should be used
     individual_velocities: dataframe with the maximum velocity of each player
+    n_zones: number of zones of the zone map (see zones.py)
 
     methods include:
     -----------
     update_player(frame_data): updates the position and velocity for that frame
+    set_state(position, velocity): sets the position and velocity
+    reset_contributions(): sets the accumulated contributions to zero
     simple_time_to_intercept(r_final): time take for player to get to target position (r_final)
     probability_intercept_ball(T): probability player will have controlled ball at time T
     """
 
     def __init__(self, pid, teamname, params, is_gk, include_individual_velocities=False,
-                 individual_velocities=None, stamine_factor=None):
+                 individual_velocities=None, stamine_factor=None, n_zones=3):
         self.id = pid
         self.is_gk = is_gk
         self.tagname = "%s_%s_" % (teamname, pid)
@@ -33,15 +38,15 @@ class Player:
         self.tti_sigma = params['tti_sigma']  # (see Eq 4 in Spearman, 2018)
         self.lambda_att = params['lambda_att']  # (see Eq 4 in Spearman, 2018)
         self.lambda_def = params['lambda_gk'] if self.is_gk else params['lambda_def']
-        self.constant_value = -np.pi / np.sqrt(3.0) / self.tti_sigma
+        self.constant_value = float(-np.pi / np.sqrt(3.0) / self.tti_sigma)
         # Variables that should be updated each frame
         self.PPCF_total = 0
-        self.PPCF_attacking_first_zone = 0
-        self.PPCF_attacking_second_zone = 0
-        self.PPCF_attacking_third_zone = 0
-        self.PPCF_defending_first_zone = 0
-        self.PPCF_defending_second_zone = 0
-        self.PPCF_defending_third_zone = 0
+        # Contributions in each zone while attacking and while defending (see zones.PHASES)
+        self.PPCF_zones = np.zeros((2, n_zones))
+        # Pitch control lost by the team without the player and frames where it was estimated
+        # (see PitchControl counterfactual)
+        self.PPCF_lost = 0
+        self.counterfactual_frames = 0
         self.PPCF = None
         self.velocity = None
         self.inframe = None
@@ -51,14 +56,26 @@ class Player:
 
     def update_player(self, frame_data):
         """Updates the position and velocity for the given frame"""
-        self.position = np.array([frame_data[f'{self.tagname}x'].iloc[0],
-                                  frame_data[f'{self.tagname}y'].iloc[0]])
+        self.set_state(np.array([frame_data[f'{self.tagname}x'].iloc[0],
+                                 frame_data[f'{self.tagname}y'].iloc[0]]),
+                       np.array([frame_data[f'{self.tagname}vx'].iloc[0],
+                                 frame_data[f'{self.tagname}vy'].iloc[0]]))
+
+    def set_state(self, position, velocity):
+        """Sets the position and velocity, the player is out of the frame if the position is NaN"""
+        self.position = position
         self.inframe = not np.any(np.isnan(self.position))
-        self.velocity = np.array([frame_data[f'{self.tagname}vx'].iloc[0],
-                                  frame_data[f'{self.tagname}vy'].iloc[0]])
+        self.velocity = velocity
         if np.any(np.isnan(self.velocity)):
             self.velocity = np.array([0., 0.])
 
+    def reset_contributions(self):
+        """Sets the accumulated pitch control contributions to zero"""
+        self.PPCF_total = 0
+        self.PPCF_zones = np.zeros_like(self.PPCF_zones)
+        self.PPCF_lost = 0
+        self.counterfactual_frames = 0
+
     def update_time_to_intercept(self, r_final):
         """Estimates the time to intercept the ball at position r_final. Assumes that the player
         continues at current velocity for 'reaction_time' seconds and then runs at full speed"""
@@ -67,15 +84,13 @@ class Player:
         # TODO: what if the player is heading already towards the ball and
         #  gets there within reaction_time?
         r_reaction = self.position + self.velocity * self.reaction_time
-        self.time_to_intercept = (self.reaction_time + np.linalg.norm(r_final - r_reaction) /
-                                  self.vmax)
+        self.time_to_intercept = float(self.reaction_time +
+                                       np.linalg.norm(r_final - r_reaction) / self.vmax)
 
     def probability_intercept_ball(self, T):
         """Probability of a player arriving at target location at time T given their expected
         time to intercept as described in Spearman 2018"""
-        # Change to improve performance
-        # f = 1 / (1. + np.exp(-np.pi / np.sqrt(3.0) / self.tti_sigma * (T - self.time_to_intercept)))
+        # 1 / (1. + np.exp(-np.pi / np.sqrt(3.0) / self.tti_sigma * (T - self.time_to_intercept)))
         # TODO time to intercept
-        f = 1 / (1. + np.e ** (self.constant_value * (T - self.time_to_intercept)))
-        return f
+        return logistic_scalar(self.constant_value * (T - self.time_to_intercept))
 
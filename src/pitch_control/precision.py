@@ -0,0 +1,90 @@
+"""
+Precision of the arrays of the vectorized engine. In float32 the times to intercept, the
+intercept probabilities and the integration of the contested cells, the (n_cells, n_players)
+arrays that dominate the memory traffic of a frame, take half the bytes. The per-player sums
+stay in float64: the contributions of a frame go to the zones of the players with a bincount,
+which always accumulates in float64, and the players add them to their float64 totals, so the
+rounding of float32 does not grow with the frames of a half.
+
+The deviation from float64 is measured on the run's own frames: every check_interval frames
+the frame is solved again in float64 and the surfaces and contributions of both solves are
+compared (see PrecisionDeviation and PitchControl.check_precision).
+"""
+import numpy as np
+
+# Precisions of the vectorized engine, see params['precision']
+PRECISIONS = ('float64', 'float32')
+# Frames between two checks against float64
+CHECK_INTERVAL = 50
+
+
+class PrecisionDeviation:
+    """
+    Running statistics of the deviation of the frames solved in float32 from float64
+
+    __init__ Parameters
+    -----------
+    check_interval: frames between two checks, one out of every check_interval frames is
+        solved again in float64
+
+    methods include:
+    -----------
+    should_check(): whether the next frame is checked, counting the frames
+    add(surface, reference_surface, contributions, reference_contributions): adds a checked frame
+    merge(other): adds the frames checked by another PrecisionDeviation, e.g. of a worker
+    to_dict(): report of the deviation
+    """
+
+    def __init__(self, check_interval=CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.solved_frames = 0
+        self.frames = 0
+        self.cells = 0
+        self.max_surface_error = 0.
+        self.sum_surface_error = 0.
+        self.max_contribution_error = 0.
+        # Largest error of the sum of the contributions of a player over the cells of a frame
+        self.max_player_error = 0.
+
+    def should_check(self):
+        check = self.solved_frames % self.check_interval == 0
+        self.solved_frames += 1
+        return check
+
+    def add(self, surface, reference_surface, contributions, reference_contributions):
+        """
+        surface, reference_surface: (n_cells,) pitch control of the attacking team in float32
+            and float64
+        contributions, reference_contributions: (n_cells, n_players) pitch control of each
+            player in float32 and float64
+        """
+        surface_error = np.abs(surface.astype(float) - reference_surface)
+        contribution_error = contributions.astype(float) - reference_contributions
+        self.frames += 1
+        self.cells += surface_error.size
+        self.max_surface_error = max(self.max_surface_error, float(surface_error.max()))
+        self.sum_surface_error += float(surface_error.sum())
+        self.max_contribution_error = max(self.max_contribution_error,
+                                          float(np.abs(contribution_error).max()))
+        self.max_player_error = max(self.max_player_error,
+                                    float(np.abs(contribution_error.sum(axis=0)).max()))
+
+    def merge(self, other):
+        self.solved_frames += other.solved_frames
+        self.frames += other.frames
+        self.cells += other.cells
+        self.max_surface_error = max(self.max_surface_error, other.max_surface_error)
+        self.sum_surface_error += other.sum_surface_error
+        self.max_contribution_error = max(self.max_contribution_error,
+                                          other.max_contribution_error)
+        self.max_player_error = max(self.max_player_error, other.max_player_error)
+
+    def to_dict(self):
+        return {
+            'solved_frames': self.solved_frames,
+            'checked_frames': self.frames,
+            'max_surface_error': self.max_surface_error,
+            'mean_surface_error': self.sum_surface_error / self.cells if self.cells else None,
+            'max_contribution_error': self.max_contribution_error,
+            'max_player_frame_error': self.max_player_error,
+        }
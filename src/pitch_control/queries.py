@@ -0,0 +1,118 @@
+"""
+Pitch control at arbitrary points of arbitrary frames, e.g. the end locations of the passes of a
+match or the points along the trajectory of the ball, without solving the whole grid of each
+frame. All the query points are solved at once with the vectorized model, so the cost grows
+with the number of queries instead of with the size of the grid.
+
+Each query is a row with the players of its frame in fixed slots: the attacking team first and
+the defending team after it, each with its goalkeeper in the first slot so that the ball control
+rates of the slots (lambda_att, lambda_gk, lambda_def) are the same in every row. The players
+out of the frame, offside or in empty slots have an infinite time to intercept, so they are
+never candidates and never reach the ball.
+"""
+import numpy as np
+import pandas as pd
+
+from src.data.shared_tracking import TEAMS
+from src.pitch_control import vectorized
+from src.pitch_control.offsides import compute_offside_lines
+
+
+def team_columns(tracking, team):
+    """Columns of the players of the team in the tracking arrays, with the goalkeeper first"""
+    players = sorted(team.players, key=lambda player: not player.is_gk)
+    return players, tracking.player_columns(players)
+
+
+def pitch_control_at_points(pitch_control, tracking, frames, x, y, attribution=False,
+                            offsides=True):
+    """
+    Evaluates pitch control at query points of the frames of a half
+
+    Parameters
+    -----------
+    pitch_control: PitchControl of the half, which gives the players and the model parameters
+    tracking: TrackingArrays of the half (see src/data/shared_tracking.py)
+    frames: (n_queries,) frame of each query
+    x, y: (n_queries,) position of each query in metres, in the coordinates of the tracking
+        data (origin at the centre of the pitch)
+    attribution: also return the contribution of each player to each query
+    offsides: leave out the attacking players that are offside (see offsides.py)
+
+    Returns
+    -----------
+    Dataframe with a row per query: frame, x, y, attacking (team in possession), PPCF_attacking,
+    PPCF_defending and converged. The queries whose frame is not in the tracking data (e.g. the
+    ball was dead) or without ball have NaN pitch control. With attribution, also a dataframe
+    with the query (row of the first one), id, team and PPCF of each player that contributes
+    """
+    frames = np.asarray(frames)
+    points = np.column_stack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)])
+    n_queries = len(frames)
+
+    rows = np.minimum(np.searchsorted(tracking.frame, frames), len(tracking) - 1)
+    found = tracking.frame[rows] == frames
+    ball = np.where(found[:, None], tracking.ball[rows], np.nan)
+    valid = found & ~np.isnan(ball).any(axis=1)
+
+    # Slots of the players of each team, padded with -1 to the size of the largest team
+    teams = (pitch_control.team_home, pitch_control.team_away)
+    slots = max(len(team.players) for team in teams)
+    team_players, team_slots = [], []
+    for team in teams:
+        players, columns = team_columns(tracking, team)
+        team_players.append(players + [None] * (slots - len(players)))
+        team_slots.append(np.array(columns + [-1] * (slots - len(columns))))
+    # The home team attacks when it has the ball, otherwise the away team (see solve_frame)
+    attacking_team = np.where(tracking.ball_owner[rows] == TEAMS.index('home'), 0, 1)
+    columns = np.concatenate([np.stack(team_slots)[attacking_team],
+                              np.stack(team_slots)[1 - attacking_team]], axis=1)
+
+    positions = tracking.positions[rows[:, None], columns]
+    velocities = np.nan_to_num(tracking.velocities[rows[:, None], columns], nan=0.)
+    vmax = np.stack([[p.vmax if p is not None else 1. for p in players]
+                     for players in team_players])
+    vmax = np.concatenate([vmax[attacking_team], vmax[1 - attacking_team]], axis=1)
+    available = (columns >= 0) & ~np.isnan(positions[..., 0])
+    if offsides:
+        goalkeepers = {team.name: team.gk_id for team in teams}
+        lines = compute_offside_lines(tracking, goalkeepers)
+        available &= lines.onside[rows[:, None], np.maximum(columns, 0)]
+
+    params = pitch_control.params
+    r_reaction = positions + velocities * params['reaction_time']
+    distance = np.sqrt(((points[:, None, :] - r_reaction) ** 2).sum(axis=-1))
+    tti = np.where(available, params['reaction_time'] + distance / vmax, np.inf)
+
+    attacking = np.arange(2 * slots) < slots
+    lambdas = np.concatenate([np.full(slots, params['lambda_att']),
+                              [params['lambda_gk']], np.full(slots - 1, params['lambda_def'])])
+    constant_values = np.full(2 * slots, -np.pi / np.sqrt(3.0) / params['tti_sigma'])
+
+    PPCFatt = np.full(n_queries, np.nan)
+    PPCFdef = np.full(n_queries, np.nan)
+    contributions = np.zeros((n_queries, 2 * slots))
+    converged = np.zeros(n_queries, dtype=bool)
+    solved = np.flatnonzero(valid)
+    if solved.size:
+        with pitch_control.profiler.stage('queries'), np.errstate(invalid='ignore', over='ignore'):
+            PPCFatt[solved], PPCFdef[solved], contributions[solved], _, converged[solved] = \
+                vectorized.pitch_control_at_targets(points[solved], ball[solved], tti[solved],
+                                                    attacking, lambdas, constant_values, params)
+    pitch_control.profiler.count('query_points', int(solved.size))
+
+    result = pd.DataFrame({'frame': frames, 'x': points[:, 0], 'y': points[:, 1],
+                           'attacking': np.where(valid, np.array(TEAMS)[attacking_team], None),
+                           'PPCF_attacking': PPCFatt, 'PPCF_defending': PPCFdef,
+                           'converged': converged})
+    if not attribution:
+        return result
+
+    query, slot = np.nonzero(contributions)
+    team = np.where(slot < slots, attacking_team[query], 1 - attacking_team[query])
+    players = [team_players[t][s % slots] for t, s in zip(team, slot)]
+    player_contributions = pd.DataFrame({'query': query,
+                                         'id': [player.id for player in players],
+                                         'team': np.array(TEAMS)[team],
+                                         'PPCF': contributions[query, slot]})
+    return result, player_contributions
@@ -0,0 +1,431 @@
+"""
+Learned surrogate of the pitch control model for fast approximate surfaces. The early exits of
+the model (the cells where the closest player of a team arrives well before the other team) are
+cheap and stay exact, as the choice of the candidate players of each cell (see
+vectorized.candidate_players). Only the contested cells, which the model integrates, are
+predicted by two regressors trained on the output of the exact model:
+
+- the pitch control of each team at the cell (its logit), from features of the cell: the ball
+  travel time, the arrival of the closest player of each team and the margins of the early
+  exits, the gap to the second player of each team, the players of each team that arrive within
+  TIME_WINDOWS and the ball control rate of each team at RATE_DELAYS after the first arrival
+- the share of each candidate player in the pitch control of his/her team, from the same times
+  relative to the player and his/her share of the control rate of the team, normalized so that
+  the shares of a team add up to one in each cell
+
+The features are cheap compared to the integration, and SurrogateModel.predict_frames predicts
+the surfaces and the shares of the players of many frames in batches. The surrogate is
+approximate: its errors against the exact model are measured on frames that were not used to
+train it (see validation.compare_engines) and saved with it.
+"""
+import pickle
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.pitch_control import vectorized
+from src.pitch_control.kernels import logistic
+
+# Seconds after the first arrival at a cell in which the players of each team are counted
+TIME_WINDOWS = (0.25, 0.5, 1., 2.)
+# Seconds after the first arrival at which the ball control rate of each team is a feature
+RATE_DELAYS = (0., 0.5, 1., 2.)
+# Cap of the time gaps to players that do not exist, e.g. the second player of a team of one
+MAX_GAP = 10.
+# The pitch control of the cells is learned as its logit, which keeps the error relative to the
+# pitch control small in the cells that a team nearly controls, clipped to this distance from 0
+# and 1. Both teams are learned because their sum is not 1 but stops between
+# 1 - params['model_converge_tol'] and 1
+LOGIT_EPSILON = 1e-4
+# Smallest predicted share of a candidate player, so that the shares of a team can be normalized
+MIN_SHARE = 1e-6
+# Parameters of the model that the surrogate learns, it only applies to runs with the same ones
+MODEL_PARAMS = ('reaction_time', 'tti_sigma', 'lambda_att', 'lambda_def', 'lambda_gk',
+                'average_ball_speed', 'time_to_control_att', 'time_to_control_def')
+# Hidden layers of the neural networks of the pitch control of the cells and of the shares of
+# the players. The shares are predicted for every candidate player, about 8 per contested cell,
+# so their network is smaller
+SURFACE_LAYERS = (32, 32)
+SHARE_LAYERS = (16,)
+MAX_ITERATIONS = 200
+# Maximum number of samples (cells or candidate players) that each regressor is trained with
+MAX_SAMPLES = 200000
+# Frames whose features are predicted in one call by predict_frames, which saves the overhead of
+# a call per frame. Larger batches are not faster, their arrays do not fit in the cache
+BATCH_FRAMES = 16
+
+
+class SurrogateError(Exception):
+    pass
+
+
+def contested_features(ball_travel_time, tti, attacking, lambdas, constant_values, closest_att,
+                       closest_def, candidates):
+    """
+    Features of the contested cells and of their candidate players for the regressors
+
+    Parameters
+    -----------
+    ball_travel_time, closest_att, closest_def, candidates: output of
+        vectorized.candidate_players for the cells
+    tti, attacking, lambdas, constant_values: inputs of vectorized.pitch_control_at_targets
+
+    Returns
+    -----------
+    cell_features: array (n_cells, n_cell_features) for the pitch control of the attacking team
+    cells, players: arrays (n_pairs,) with the cell and the player of each candidate
+    player_features: array (n_pairs, n_player_features) for the share of each candidate in the
+        pitch control of his/her team
+    """
+    n_cells, n_players = tti.shape
+    rows = np.arange(n_cells)
+    tau_att = tti[rows, closest_att]
+    tau_def = tti[rows, closest_def]
+    # The ball can be controlled from the first arrival of a player or of the ball
+    start = np.maximum(ball_travel_time, np.minimum(tau_att, tau_def))
+    cells, players = np.nonzero(candidates)
+    own = attacking[players]
+    tti_player = tti[cells, players]
+
+    # The margins of the early exits are compared with params['time_to_control_att'/'_def']
+    cell_features = [ball_travel_time, tau_att - ball_travel_time, tau_def - ball_travel_time,
+                     tau_att - tau_def, tau_def - np.maximum(ball_travel_time, tau_att),
+                     tau_att - np.maximum(ball_travel_time, tau_def), lambdas[closest_att],
+                     lambdas[closest_def]]
+    player_features = [tti_player - np.where(own, tau_att[cells], tau_def[cells]),
+                       tti_player - np.where(own, tau_def[cells], tau_att[cells]),
+                       tti_player - ball_travel_time[cells], lambdas[players], own]
+
+    rank = np.zeros(tti.shape, dtype=np.intp)
+    team_candidates = []
+    for team in (attacking, ~attacking):
+        team_tti = tti[:, team]
+        if team_tti.shape[1] > 1:
+            first_two = np.partition(team_tti, 1, axis=1)
+            cell_features.append(np.minimum(first_two[:, 1] - first_two[:, 0], MAX_GAP))
+        else:
+            cell_features.append(np.full(n_cells, MAX_GAP))
+        cell_features += [np.sum(team_tti <= (start + window)[:, None], axis=1)
+                          for window in TIME_WINDOWS]
+        # Rank of each candidate in the team, whose candidates sort first in order of arrival
+        in_team = candidates & team
+        team_rank = np.empty_like(rank)
+        np.put_along_axis(team_rank, np.argsort(np.where(in_team, tti, np.inf), axis=1),
+                          np.broadcast_to(np.arange(n_players), rank.shape), axis=1)
+        rank = np.where(in_team, team_rank, rank)
+        team_candidates.append(in_team)
+    player_features += [rank[cells, players],
+                        np.where(own, team_candidates[0].sum(axis=1)[cells],
+                                 team_candidates[1].sum(axis=1)[cells])]
+
+    for delay in RATE_DELAYS:
+        # Ball control rate of each player (lambda times the probability of having arrived, see
+        # Player.probability_intercept_ball) and of each team
+        rate = lambdas * logistic(constant_values * ((start + delay)[:, None] - tti))
+        rate_att = np.sum(rate, axis=1, where=team_candidates[0])
+        rate_def = np.sum(rate, axis=1, where=team_candidates[1])
+        cell_features += [rate_att, rate_def]
+        team_rate = np.where(own, rate_att[cells], rate_def[cells])
+        player_features.append(np.divide(rate[cells, players], team_rate,
+                                         out=np.zeros(len(cells)), where=team_rate > 0))
+    return np.column_stack(cell_features), cells, players, np.column_stack(player_features)
+
+
+def split_cells(targets, ball_position, tti, attacking, params):
+    """
+    Solves the early exits of vectorized.pitch_control_at_targets exactly and leaves the
+    contested cells for the surrogate
+
+    Returns
+    -----------
+    PPCFatt, PPCFdef, contributions: as in vectorized.pitch_control_at_targets, with the
+        contested cells still at zero
+    contested: indices of the contested cells
+    inputs: ball_travel_time, closest_att, closest_def and candidates of the contested cells
+    """
+    n_targets, n_players = tti.shape
+    ball_travel_time, closest_att, closest_def, defending_first, attacking_first, candidates = \
+        vectorized.candidate_players(targets, ball_position, tti, attacking, params)
+    rows = np.arange(n_targets)
+
+    PPCFatt = np.zeros(n_targets)
+    PPCFdef = np.zeros(n_targets)
+    contributions = np.zeros((n_targets, n_players))
+    PPCFdef[defending_first] = 1.
+    contributions[rows[defending_first], closest_def[defending_first]] = 1.
+    PPCFatt[attacking_first] = 1.
+    contributions[rows[attacking_first], closest_att[attacking_first]] = 1.
+
+    contested = np.flatnonzero(~(defending_first | attacking_first))
+    inputs = (ball_travel_time[contested], closest_att[contested], closest_def[contested],
+              candidates[contested])
+    return PPCFatt, PPCFdef, contributions, contested, inputs
+
+
+class SurrogateModel:
+    """
+    Regressors that approximate the pitch control of the contested cells
+
+    __init__ Parameters
+    -----------
+    surface_model: regressor of the logits of the pitch control of the attacking and the
+        defending teams from the features of the cell (see contested_features)
+    share_model: regressor of the share of a candidate player in the pitch control of his/her
+        team from the features of the player
+    params: model parameters of the PitchControl whose output it learned
+    training: dictionary with the frames and the samples it was trained with
+
+    methods include:
+    -----------
+    check_params(params): raises SurrogateError if the model parameters are not the learned ones
+    pitch_control_at_targets: same as vectorized.pitch_control_at_targets with the regressors
+    predict_frames: pitch control surfaces of many frames of TrackingArrays at once
+    save(path): saves the model in a pickle (see load_surrogate)
+    """
+
+    def __init__(self, surface_model, share_model, params, training=None):
+        self.surface_model = surface_model
+        self.share_model = share_model
+        self.params = {key: params[key] for key in MODEL_PARAMS}
+        self.training = training or {}
+        # Accuracy against the exact model on held-out frames, see validation.compare_engines
+        self.report = None
+
+    def check_params(self, params):
+        different = [key for key in MODEL_PARAMS if not np.isclose(params[key], self.params[key])]
+        if different:
+            raise SurrogateError(f'The surrogate was trained with other model parameters: '
+                                 f'{", ".join(different)}')
+
+    def pitch_control_at_targets(self, targets, ball_position, tti, attacking, lambdas,
+                                 constant_values, params):
+        """
+        Approximates vectorized.pitch_control_at_targets: the early exits are exact and the
+        contested cells are predicted
+
+        Returns
+        -----------
+        PPCFatt, PPCFdef, contributions, steps, converged: as in
+            vectorized.pitch_control_at_targets, with a step for each predicted cell and every
+            cell converged
+        """
+        prepared = self.prepare(targets, ball_position, tti, attacking, lambdas, constant_values,
+                                params)
+        _, cells, _, pairs = prepared
+        PPCF, shares = self.predict(cells, pairs)
+        PPCFatt, PPCFdef, contributions, contested = self.finish(prepared, attacking, PPCF,
+                                                                 shares)
+        steps = np.zeros(len(targets), dtype=int)
+        steps[contested] = 1
+        return PPCFatt, PPCFdef, contributions, steps, np.ones(len(targets), dtype=bool)
+
+    def predict(self, cells, pairs):
+        """Pitch control of both teams at the contested cells, array (n_cells, 2), and shares of
+        the candidate players from their features"""
+        if not len(cells):
+            return np.zeros((0, 2)), np.zeros(0)
+        return 1 / (1 + np.exp(-self.surface_model.predict(cells))), self.share_model.predict(pairs)
+
+    def prepare(self, targets, ball_position, tti, attacking, lambdas, constant_values, params):
+        """Exact early exits and features of the contested cells and their candidate players"""
+        PPCFatt, PPCFdef, contributions, contested, inputs = split_cells(
+            targets, ball_position, tti, attacking, params)
+        ball_travel_time, closest_att, closest_def, candidates = inputs
+        arguments = (ball_travel_time, tti[contested], attacking, lambdas, constant_values,
+                     closest_att, closest_def, candidates)
+        with np.errstate(over='ignore'):
+            cells, pair_cells, players, pairs = contested_features(*arguments)
+        return (PPCFatt, PPCFdef, contributions, contested, pair_cells, players), cells, \
+            (pair_cells, players), pairs
+
+    def finish(self, prepared, attacking, PPCF, shares):
+        """Adds the predicted pitch control and shares of the contested cells to the exact early
+        exits of prepare"""
+        (PPCFatt, PPCFdef, contributions, contested, cells, players), _, _, _ = prepared
+        PPCFatt[contested] = PPCF[:, 0]
+        PPCFdef[contested] = PPCF[:, 1]
+
+        # The shares of the candidates of each team add up to one in each cell
+        own = attacking[players]
+        group = 2 * cells + own
+        shares = np.maximum(shares, MIN_SHARE)
+        totals = np.bincount(group, weights=shares, minlength=2 * len(contested))
+        team_PPCF = np.where(own, PPCF[cells, 0], PPCF[cells, 1])
+        contributions[contested[cells], players] = shares / totals[group] * team_PPCF
+        return PPCFatt, PPCFdef, contributions, contested
+
+    def predict_frames(self, pitch_control, tracking, rows, offsides=True):
+        """
+        Approximate pitch control surfaces of many frames, whose features are predicted in
+        batches of BATCH_FRAMES frames instead of frame by frame
+
+        Parameters
+        -----------
+        pitch_control: PitchControl of the half, which gives the players and the grid
+        tracking: TrackingArrays of the half (see src/data/shared_tracking.py)
+        rows: rows of the frames in tracking
+        offsides: leave out the attacking players that are offside
+
+        Returns
+        -----------
+        surfaces: array (n_frames, n_grid_cells_y, n_grid_cells_x) with the pitch control of the
+            attacking team, NaN for the frames without ball
+        shares: dataframe with the frame, id, team and PPCF (summed over the cells) of each
+            player in each frame
+        """
+        self.check_params(pitch_control.params)
+        shape = (pitch_control.n_grid_cells_y, pitch_control.n_grid_cells_x)
+        surfaces = np.full((len(rows),) + shape, np.nan)
+        frames, ids, teams, shares = [], [], [], []
+        for start in range(0, len(rows), BATCH_FRAMES):
+            batch = []
+            for i in range(start, min(start + BATCH_FRAMES, len(rows))):
+                index = rows[i]
+                ball_position = tracking.ball[index]
+                if np.isnan(ball_position).any():
+                    continue
+                pitch_control.update_players_from_arrays(tracking, index)
+                attacking_team, defending_team, attacking_players, defending_players = \
+                    pitch_control.select_players(tracking.frame[index], ball_position, offsides)
+                attacking, tti, lambdas, constant_values = pitch_control.player_arrays(
+                    attacking_players, defending_players)
+                prepared = self.prepare(pitch_control.targets, ball_position, tti, attacking,
+                                        lambdas, constant_values, pitch_control.params)
+                players = [(p.id, attacking_team.name) for p in attacking_players] + \
+                    [(p.id, defending_team.name) for p in defending_players]
+                batch.append((i, players, attacking, prepared))
+            if not batch:
+                continue
+
+            with pitch_control.profiler.stage('surrogate'):
+                cells = np.concatenate([prepared[1] for _, _, _, prepared in batch])
+                pairs = np.concatenate([prepared[3] for _, _, _, prepared in batch])
+                PPCF, all_shares = self.predict(cells, pairs)
+            cell_offsets = np.cumsum([0] + [len(prepared[1]) for _, _, _, prepared in batch])
+            pair_offsets = np.cumsum([0] + [len(prepared[3]) for _, _, _, prepared in batch])
+            for j, (i, players, attacking, prepared) in enumerate(batch):
+                PPCFatt, _, contributions, _ = self.finish(
+                    prepared, attacking, PPCF[cell_offsets[j]:cell_offsets[j + 1]],
+                    all_shares[pair_offsets[j]:pair_offsets[j + 1]])
+                surfaces[i] = PPCFatt.reshape(shape)
+                frames += [tracking.frame[rows[i]]] * len(players)
+                ids += [player_id for player_id, _ in players]
+                teams += [team for _, team in players]
+                shares.append(contributions.sum(axis=0))
+        shares = np.concatenate(shares) if shares else np.zeros(0)
+        return surfaces, pd.DataFrame({'frame': frames, 'id': ids, 'team': teams, 'PPCF': shares})
+
+    def save(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'wb') as f:
+            pickle.dump(self, f)
+
+
+def load_surrogate(path):
+    """Loads a SurrogateModel saved with SurrogateModel.save"""
+    path = Path(path)
+    if not path.exists():
+        raise SurrogateError(f'There is no surrogate model in {path}')
+    try:
+        with open(path, 'rb') as f:
+            model = pickle.load(f)
+    except ImportError as e:
+        raise SurrogateError(f'The surrogate model in {path} needs scikit-learn: {e}')
+    if not isinstance(model, SurrogateModel):
+        raise SurrogateError(f'{path} is not a surrogate model')
+    return model
+
+
+def collect_samples(pitch_control, tracking, rows, offsides=True):
+    """
+    Features and targets of the contested cells of the frames, solved with the exact vectorized
+    model
+
+    Returns
+    -----------
+    cells, PPCF: features of the contested cells and pitch control of the attacking and the
+        defending teams, array (n_cells, 2)
+    pairs, shares: features of their candidate players and share of each one in the pitch
+        control of his/her team
+    """
+    cells, PPCF, pairs, shares = [], [], [], []
+    for index in rows:
+        ball_position = tracking.ball[index]
+        if np.isnan(ball_position).any():
+            continue
+        pitch_control.update_players_from_arrays(tracking, index)
+        _, _, attacking_players, defending_players = pitch_control.select_players(
+            tracking.frame[index], ball_position, offsides)
+        attacking, tti, lambdas, constant_values = pitch_control.player_arrays(
+            attacking_players, defending_players)
+        PPCFatt, PPCFdef, contributions, _, _ = vectorized.pitch_control_at_targets(
+            pitch_control.targets, ball_position, tti, attacking, lambdas, constant_values,
+            pitch_control.params)
+
+        _, _, _, contested, inputs = split_cells(pitch_control.targets, ball_position, tti,
+                                                 attacking, pitch_control.params)
+        ball_travel_time, closest_att, closest_def, candidates = inputs
+        arguments = (ball_travel_time, tti[contested], attacking, lambdas, constant_values,
+                     closest_att, closest_def, candidates)
+        with np.errstate(over='ignore'):
+            cell_features, pair_cells, players, features = contested_features(*arguments)
+        cells.append(cell_features)
+        PPCF.append(np.column_stack([PPCFatt[contested], PPCFdef[contested]]))
+        pairs.append(features)
+        team_PPCF = np.where(attacking[players], PPCFatt[contested][pair_cells],
+                             PPCFdef[contested][pair_cells])
+        shares.append(np.divide(contributions[contested[pair_cells], players], team_PPCF,
+                                out=np.zeros(len(players)), where=team_PPCF > 0))
+    if not cells:
+        raise SurrogateError('There are no frames with ball to train the surrogate')
+    return np.concatenate(cells), np.concatenate(PPCF), np.concatenate(pairs), \
+        np.concatenate(shares)
+
+
+def train(pitch_control, tracking, rows, offsides=True, max_samples=MAX_SAMPLES, seed=0):
+    """
+    Trains a surrogate on the output of the exact model in the frames
+
+    Parameters
+    -----------
+    pitch_control: PitchControl of the half, which gives the players, the grid and the model
+        parameters
+    tracking: TrackingArrays of the half (see src/data/shared_tracking.py)
+    rows: rows of the training frames in tracking
+    offsides: leave out the attacking players that are offside
+    max_samples: maximum number of samples of each regressor, drawn at random from all of them
+    seed: seed of the random draw and of the regressors
+
+    Returns
+    -----------
+    SurrogateModel
+    """
+    try:
+        import sklearn
+        from sklearn.neural_network import MLPRegressor
+        from sklearn.pipeline import make_pipeline
+        from sklearn.preprocessing import StandardScaler
+    except ImportError:
+        raise SurrogateError('Training a surrogate needs scikit-learn (see requirements.txt)')
+
+    with pitch_control.profiler.stage('surrogate_samples'):
+        cells, PPCF, pairs, shares = collect_samples(pitch_control, tracking, rows, offsides)
+    rng = np.random.default_rng(seed)
+
+    def fit(features, target, hidden_layers):
+        if len(target) > max_samples:
+            sample = rng.choice(len(target), max_samples, replace=False)
+            features, target = features[sample], target[sample]
+        regressor = MLPRegressor(hidden_layers, max_iter=MAX_ITERATIONS, early_stopping=True,
+                                 random_state=seed)
+        return make_pipeline(StandardScaler(), regressor).fit(features, target)
+
+    with pitch_control.profiler.stage('surrogate_training'):
+        PPCF = np.clip(PPCF, LOGIT_EPSILON, 1 - LOGIT_EPSILON)
+        surface_model = fit(cells, np.log(PPCF / (1 - PPCF)), SURFACE_LAYERS)
+        share_model = fit(pairs, shares, SHARE_LAYERS)
+    training = {'frames': int(len(rows)), 'cells': int(len(PPCF)), 'pairs': int(len(shares)),
+                'sklearn_version': sklearn.__version__}
+    return SurrogateModel(surface_model, share_model, pitch_control.params, training)
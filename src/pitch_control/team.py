@@ -3,6 +3,7 @@ import pandas as pd
 
 from src.data.utils import find_goalkeeper
 from src.pitch_control.player import Player
+from src.pitch_control.zones import PHASES
 
 
 class Team:
@@ -17,38 +18,44 @@ class Team:
     params: dictionary containing all the model parameters
     include_individual_velocities: flag to indicate if individual max velocities should be used
     individual_velocities: dataframe with the maximum velocity of each player
+    goalkeepers: optional dictionary team -> jersey of the goalkeeper, found in the first frame
+        if not given
+    n_zones: number of zones of the zone map (see zones.py)
 
     methods include:
     -----------
     get_goalkeeper_id: obtains the goalkeeper id using information from the first frame
     initialize_players: initializes and stores all the players in the team
     update_players: updates the position and velocity of all players for the frame
+    update_players_from_arrays: updates the players from arrays of positions and velocities
+    reset_contributions: sets the accumulated contributions of all players to zero
     update_players_time_to_intercept: updates the time to intercept at the position for all players
     get_players_inframe: returns the list of players in the frame
+    add_players_zone_PPCF: adds the pitch control of the frame in each zone to the players
     """
 
     def __init__(self, team_name, first_frame, params, include_individual_velocities=False,
-                 individual_velocities=None, stamine_plus=None):
+                 individual_velocities=None, stamine_plus=None, goalkeepers=None, n_zones=3):
         self.params = params
         self.name = team_name
-        self.gk_id, self.team_half = self.get_goalkeeper_id(first_frame)
+        self.gk_id, self.team_half = self.get_goalkeeper_id(first_frame, goalkeepers)
         self.possession = None
         self.players = self.initialize_players(first_frame, include_individual_velocities,
-                                               individual_velocities, stamine_plus)
+                                               individual_velocities, stamine_plus, n_zones)
         self.PPCF = None
         # Initialize the position and velocities, not really necessary
         self.update_players(first_frame)
 
-    def get_goalkeeper_id(self, first_frame):
+    def get_goalkeeper_id(self, first_frame, goalkeepers=None):
         """Returns the id of the goalkeeper"""
-        goalkeepers,team_pitch_halfs = find_goalkeeper(first_frame)
+        goalkeepers,team_pitch_halfs = find_goalkeeper(first_frame, goalkeepers)
         gk_id = goalkeepers[self.name]
         team_half = team_pitch_halfs[self.name]
         #print(f'the pitch of the {self.name} is {team_pitch_halfs[self.name]}')
         return gk_id,team_half
 
     def initialize_players(self, first_frame, include_individual_velocities, individual_velocities,
-                           stamine_factor=None):
+                           stamine_factor=None, n_zones=3):
         """Initializes all players and stores them in a list"""
         player_ids = np.unique([c.split('_')[1] for c in first_frame.keys() if c[:4] == self.name])
 
@@ -56,7 +63,7 @@ class Team:
         for p in player_ids:
             team_player = Player(p, self.name, self.params, p == self.gk_id,
                                  include_individual_velocities, individual_velocities,
-                                 stamine_factor)
+                                 stamine_factor, n_zones)
             team_players.append(team_player)
         return team_players
 
@@ -67,6 +74,20 @@ class Team:
         for player in self.players:
             player.update_player(frame_data)
 
+    def update_players_from_arrays(self, ball_owner, positions, velocities):
+        """Same as update_players with the state of the players in arrays
+
+        ball_owner: name of the team in possession
+        positions, velocities: arrays of shape (n_players, 2) in the order of self.players
+        """
+        self.possession = 'attacking' if self.name == ball_owner else 'defending'
+        for player, position, velocity in zip(self.players, positions, velocities):
+            player.set_state(position, velocity)
+
+    def reset_contributions(self):
+        for player in self.players:
+            player.reset_contributions()
+
     def update_players_time_to_intercept(self, r_final):
         """Updates the time to intercept to r_final for all players"""
         for player in self.players:
@@ -77,41 +98,17 @@ class Team:
         players_list = [player for player in self.players if player.inframe]
         return players_list
 
-    def update_players_PCCF(self,flag):
-        for player in self.players:
-            player.PPCF_total += player.PPCF
-
-            if self.team_half == 'left' and self.possession == 'attacking':
-                if flag=='first':
-                    player.PPCF_attacking_first_zone += player.PPCF
-                elif flag=='second':
-                    player.PPCF_attacking_second_zone += player.PPCF
-                elif flag=='third':
-                    player.PPCF_attacking_third_zone += player.PPCF
-            elif self.team_half == 'right' and self.possession == 'attacking':
-                if flag=='first':
-                    player.PPCF_attacking_third_zone += player.PPCF
-                elif flag=='second':
-                    player.PPCF_attacking_second_zone += player.PPCF
-                elif flag=='third':
-                    player.PPCF_attacking_first_zone += player.PPCF
-            elif self.team_half == 'left' and self.possession == 'defending':
-                if flag=='first':
-                    player.PPCF_defending_first_zone += player.PPCF
-                elif flag=='second':
-                    player.PPCF_defending_second_zone += player.PPCF
-                elif flag=='third':
-                    player.PPCF_defending_third_zone += player.PPCF
-            elif self.team_half == 'right' and self.possession == 'defending':
-                if flag=='first':
-                    player.PPCF_defending_third_zone += player.PPCF
-                elif flag=='second':
-                    player.PPCF_defending_second_zone += player.PPCF
-                elif flag=='third':
-                    player.PPCF_defending_first_zone += player.PPCF
-
-
-        
+    def add_players_zone_PPCF(self, zone_PPCF):
+        """Adds the pitch control of the frame in each zone to the players
+
+        zone_PPCF: dictionary player -> array with the sum of his/her contributions in each zone
+            of the zone map followed by the sum outside every zone. Players not included have no
+            contribution
+        """
+        phase = PHASES.index(self.possession)
+        for player, values in zone_PPCF.items():
+            player.PPCF_total += values.sum()
+            player.PPCF_zones[phase] += values[:-1]
 
     def get_players_vmax(self):
         velocities = []
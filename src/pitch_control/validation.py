@@ -0,0 +1,105 @@
+"""
+Differential validation of the pitch control engines. A candidate configuration (a faster
+engine or approximation) is run side by side with the reference model on sampled frames and
+the surfaces and the individual contributions of both are compared.
+"""
+import time
+import numpy as np
+
+from src.pitch_control.pitch_control import PitchControl
+
+# Maximum error allowed in the surface and in the per-player zone sums (normalized by the number
+# of cells and frames), of the order of the convergence tolerance of the model
+DEFAULT_TOLERANCE = 0.01
+
+REFERENCE = {'engine': 'reference'}
+
+
+class ValidationError(Exception):
+    pass
+
+
+def sample_frames(df, n_frames):
+    """Returns n_frames frames evenly spaced along the dataframe"""
+    n_frames = min(n_frames, len(df))
+    index = np.unique(np.linspace(0, len(df) - 1, n_frames).round().astype(int))
+    return df['frame'].iloc[index].tolist()
+
+
+def run_engine(df, frames, options, pitch_control_args):
+    """Runs a PitchControl with the given options over the frames
+
+    Returns the surfaces, the individual contributions after the last frame and the time spent
+    """
+    pitch_control = PitchControl(df, **pitch_control_args, **options)
+    surfaces = []
+    start = time.perf_counter()
+    for frame in frames:
+        surfaces.append(pitch_control.generate_pitch_control_for_event(df.loc[df['frame'] == frame]))
+    elapsed = time.perf_counter() - start
+    return np.array(surfaces), pitch_control.get_individual_contributions(), elapsed
+
+
+def compare_engines(df, frames, candidate, reference=REFERENCE, pitch_control_args=None,
+                    tolerance=DEFAULT_TOLERANCE):
+    """
+    Runs the reference and the candidate configuration on the same frames and compares them
+
+    Parameters
+    -----------
+    df: prepared tracking dataframe
+    frames: list of frames to evaluate
+    candidate: dictionary of PitchControl arguments of the configuration to validate, for
+        example {'engine': 'vectorized'}
+    reference: dictionary of PitchControl arguments of the reference configuration
+    pitch_control_args: arguments shared by both configurations (individual velocities, grid...)
+    tolerance: maximum error allowed in the surface and in the normalized zone sums
+
+    Returns
+    -----------
+    Dictionary with the maximum and mean surface errors, the zone sum deltas of each player, the
+    time of both configurations, the speedup and whether the candidate passed
+    """
+    pitch_control_args = pitch_control_args or {}
+    reference_surfaces, reference_contributions, reference_time = run_engine(
+        df, frames, reference, pitch_control_args)
+    candidate_surfaces, candidate_contributions, candidate_time = run_engine(
+        df, frames, candidate, pitch_control_args)
+
+    surface_error = np.abs(candidate_surfaces - reference_surfaces)
+    columns = [c for c in reference_contributions.columns if c.startswith('PPCF')]
+    merged = reference_contributions.merge(candidate_contributions, on=['id', 'team'],
+                                           suffixes=('_reference', '_candidate'))
+    zone_deltas = merged[['id', 'team']].copy()
+    for column in columns:
+        zone_deltas[column] = merged[f'{column}_candidate'] - merged[f'{column}_reference']
+    # The zone sums are sums of cells over frames, so they are normalized to compare them with
+    # the error of a single cell
+    n_cells = reference_surfaces[0].size
+    zone_error = np.abs(zone_deltas[columns].values).max() / (n_cells * len(frames))
+
+    report = {
+        'reference': reference,
+        'candidate': candidate,
+        'frames': [int(frame) for frame in frames],
+        'max_surface_error': float(surface_error.max()),
+        'mean_surface_error': float(surface_error.mean()),
+        'max_zone_error': float(zone_error),
+        'zone_deltas': zone_deltas.to_dict(orient='records'),
+        'reference_time_s': reference_time,
+        'candidate_time_s': candidate_time,
+        'speedup': reference_time / candidate_time if candidate_time else None,
+        'tolerance': tolerance,
+    }
+    report['passed'] = (report['max_surface_error'] <= tolerance and
+                        report['max_zone_error'] <= tolerance)
+    return report
+
+
+def check_report(report):
+    """Raises ValidationError if the candidate went over the tolerance"""
+    if not report['passed']:
+        raise ValidationError(f'{report["candidate"]} differs from the reference: max surface '
+                              f'error {report["max_surface_error"]:.2e}, max zone error '
+                              f'{report["max_zone_error"]:.2e} (tolerance '
+                              f'{report["tolerance"]:.2e})')
@@ -0,0 +1,317 @@
+"""
+Vectorized version of the pitch control model. It solves all the cells of a frame at once with
+NumPy arrays instead of looping over cells and players, following the same steps as
+PitchControl.calculate_pitch_control_at_target: early exit when one team arrives clearly
+first and otherwise integration of equation 3 in Spearman et al., with a fixed time step or
+with an adaptive one (see integrate_adaptive and params['integrator']).
+
+The arrays of the cells take the dtype of the times to intercept, float64 or float32 (see
+precision.py).
+"""
+import numpy as np
+
+from src.pitch_control.kernels import logistic
+
+
+def times_to_intercept(targets, positions, velocities, vmax, reaction_time):
+    """
+    Time for each player to reach each target. Assumes that the player continues at current
+    velocity for 'reaction_time' seconds and then runs at full speed (see
+    Player.update_time_to_intercept)
+
+    Parameters
+    -----------
+    targets: array (n_targets, 2) of target positions
+    positions: array (n_players, 2) with the position of each player
+    velocities: array (n_players, 2) with the velocity of each player
+    vmax: array (n_players,) with the maximum speed of each player
+    reaction_time: reaction time of the players
+
+    Returns
+    -----------
+    Array (n_targets, n_players) with the time to intercept
+    """
+    r_reaction = positions + velocities * reaction_time
+    difference = targets[:, None, :] - r_reaction[None, :, :]
+    distance = np.sqrt(difference[..., 0] ** 2 + difference[..., 1] ** 2)
+    return reaction_time + distance / vmax
+
+
+def pitch_control_at_targets(targets, ball_position, tti, attacking, lambdas, constant_values,
+                             params, integrate=None):
+    """
+    Pitch control probability at each target for the attacking and defending teams, together
+    with the contribution of each player
+
+    Parameters
+    -----------
+    targets: array (n_targets, 2) of target positions
+    ball_position: current position of the ball (start position for a pass)
+    tti: array (n_targets, n_players) with the time to intercept of each player
+    attacking: boolean array (n_players,), True for the players of the attacking team
+    lambdas: array (n_players,) with the ball control rate of each player (lambda_att for the
+        attacking players and lambda_def or lambda_gk for the defending ones)
+    constant_values: array (n_players,) with the constant of the logistic intercept probability
+        (see Player.probability_intercept_ball)
+    params: dictionary containing all the model parameters
+    integrate: integrator of the contested cells, with the arguments and results of
+        integrate_fixed_step. Default: INTEGRATORS[params['integrator']]
+
+    Returns
+    -----------
+    PPCFatt: array (n_targets,) with the pitch control probability of the attacking team
+    PPCFdef: array (n_targets,) with the pitch control probability of the defending team
+    contributions: array (n_targets, n_players) with the pitch control of each player
+    steps: array (n_targets,) with the integration steps of each cell (0 for early exits)
+    converged: boolean array (n_targets,), False for the cells where the integration reached
+        params['max_int_time'] before converging
+    """
+    n_targets, n_players = tti.shape
+    ball_travel_time, closest_att, closest_def, defending_first, attacking_first, candidates = \
+        candidate_players(targets, ball_position, tti, attacking, params)
+    rows = np.arange(n_targets)
+
+    PPCFatt = np.zeros(n_targets, dtype=tti.dtype)
+    PPCFdef = np.zeros(n_targets, dtype=tti.dtype)
+    contributions = np.zeros((n_targets, n_players), dtype=tti.dtype)
+    steps = np.zeros(n_targets, dtype=int)
+    converged = np.ones(n_targets, dtype=bool)
+
+    PPCFdef[defending_first] = 1.
+    contributions[rows[defending_first], closest_def[defending_first]] = 1.
+    PPCFatt[attacking_first] = 1.
+    contributions[rows[attacking_first], closest_att[attacking_first]] = 1.
+
+    contested = np.flatnonzero(~(defending_first | attacking_first))
+    if contested.size:
+        integrate = integrate or INTEGRATORS[params['integrator']]
+        PPCF, steps[contested], converged[contested] = integrate(
+            ball_travel_time[contested], tti[contested], candidates[contested], lambdas,
+            constant_values, params)
+        contributions[contested] = PPCF
+        PPCFatt[contested] = PPCF[:, attacking].sum(axis=1)
+        PPCFdef[contested] = PPCF[:, ~attacking].sum(axis=1)
+
+    return PPCFatt, PPCFdef, contributions, steps, converged
+
+
+def candidate_players(targets, ball_position, tti, attacking, params):
+    """
+    Players that take part in the pitch control of each target (see pitch_control_at_targets)
+
+    Returns
+    -----------
+    ball_travel_time: array (n_targets,) with the time for the ball to reach each target
+    closest_att, closest_def: arrays (n_targets,) with the closest player of each team
+    defending_first, attacking_first: boolean arrays (n_targets,), True for the targets where
+        the closest player of the team arrives significantly before the other team, which are
+        not integrated
+    candidates: boolean array (n_targets, n_players) with the players that are not far (in
+        time) from the target compared to the closest player of their team
+    """
+    ball_travel_time = (np.sqrt(np.sum((targets - ball_position) ** 2, axis=1)) /
+                        params['average_ball_speed'])
+
+    attacking_index = np.flatnonzero(attacking)
+    defending_index = np.flatnonzero(~attacking)
+    # argmin keeps the first player in case of a tie, as get_closest_player_to_current_position
+    closest_att = attacking_index[np.argmin(tti[:, attacking_index], axis=1)]
+    closest_def = defending_index[np.argmin(tti[:, defending_index], axis=1)]
+    rows = np.arange(len(tti))
+    tau_min_att = tti[rows, closest_att]
+    tau_min_def = tti[rows, closest_def]
+
+    # If the closest player from one team can arrive significantly before the other, no need
+    # to solve the pitch control model
+    defending_first = (tau_min_att - np.maximum(ball_travel_time, tau_min_def) >=
+                       params['time_to_control_def'])
+    attacking_first = ~defending_first & (tau_min_def - np.maximum(ball_travel_time, tau_min_att)
+                                          >= params['time_to_control_att'])
+
+    # Remove any player that is far (in time) from the target location
+    candidates = np.where(attacking,
+                          tti - tau_min_att[:, None] < params['time_to_control_att'],
+                          tti - tau_min_def[:, None] < params['time_to_control_def'])
+    return ball_travel_time, closest_att, closest_def, defending_first, attacking_first, candidates
+
+
+def integrate_fixed_step(ball_travel_time, tti, candidates, lambdas, constant_values, params):
+    """
+    Integrates equation 3 of Spearman 2018 for several cells at once with the time step
+    params['int_dt'], until convergence or params['max_int_time']. Every cell advances one step
+    per iteration and leaves the loop as soon as it converges.
+
+    Parameters
+    -----------
+    ball_travel_time: array (n_cells,) with the time for the ball to reach each cell
+    tti: array (n_cells, n_players) with the time to intercept of each player
+    candidates: boolean array (n_cells, n_players) with the players taken into account in each
+        cell
+    lambdas: array (n_players,) with the ball control rate of each player
+    constant_values: array (n_players,) with the constant of the logistic intercept probability
+    params: dictionary containing all the model parameters
+
+    Returns
+    -----------
+    PPCF: array (n_cells, n_players) with the pitch control of each player
+    steps: array (n_cells,) with the integration steps of each cell
+    converged: boolean array (n_cells,), False if the cell did not converge
+    """
+    dt = params['int_dt']
+    tol = params['model_converge_tol']
+    start = ball_travel_time - dt
+    # Same number of points as np.arange(start, ball_travel_time + max_int_time, dt)
+    size = np.ceil((ball_travel_time + params['max_int_time'] - start) / dt).astype(int)
+    rates = np.where(candidates, lambdas, 0.) * dt
+
+    n_cells = tti.shape[0]
+    PPCF = np.zeros(tti.shape, dtype=tti.dtype)
+    ptot = np.zeros(n_cells, dtype=tti.dtype)
+    steps = np.zeros(n_cells, dtype=int)
+    active = np.arange(n_cells)
+    i = 1
+    while active.size:
+        running = (1 - ptot[active] > tol) & (i < size[active])
+        steps[active[~running]] = i - 1
+        active = active[running]
+        if not active.size:
+            break
+        T = start[active] + i * dt
+        probability = logistic(constant_values * (T[:, None] - tti[active]))
+        dPPCF = (1 - ptot[active])[:, None] * probability * rates[active]
+        PPCF[active] += dPPCF
+        ptot[active] = PPCF[active].sum(axis=1)
+        i += 1
+
+    converged = steps + 1 < size
+    return PPCF, steps, converged
+
+
+def integrate_adaptive(ball_travel_time, tti, candidates, lambdas, constant_values, params):
+    """
+    Integrates equation 3 of Spearman 2018 for several cells at once with an adaptive time step
+    per cell, until convergence or params['max_int_time'], with the same inputs and outputs as
+    integrate_fixed_step.
+
+    The equation is dPPCF_j/dT = (1 - sum(PPCF)) * a_j(T), where a_j(T) (the ball control rate
+    of the player times the probability that he/she has arrived) only depends on T. So each
+    step of the classical Runge-Kutta of order 4 evaluates a_j at T + dt/2 and T + dt only (the
+    two middle stages share the time and the last stage is the first one of the next step) and
+    its stages only need the remaining probability 1 - sum(PPCF) of each cell, a scalar (see
+    runge_kutta_remaining). The error of each step is estimated with the embedded order 3
+    solution that uses a_j(T + dt) at the end of the step, the step is rejected if it is above
+    params['int_tol'] and the next time step is chosen from it. The first step is
+    params['int_dt'] and params['int_tol'] must be well below params['model_converge_tol'].
+
+    The last step is cut where the remaining probability reaches params['model_converge_tol']
+    (see last_step_weights), so the cells stop at the same remaining probability whatever the
+    size of their steps.
+
+    Returns
+    -----------
+    PPCF: array (n_cells, n_players) with the pitch control of each player
+    steps: array (n_cells,) with the steps of each cell, rejected ones included, each one
+        evaluates a_j twice
+    converged: boolean array (n_cells,), False if the cell did not converge
+    """
+    tol = params['model_converge_tol']
+    int_tol = params['int_tol']
+    n_cells, n_players = tti.shape
+    PPCF = np.zeros((n_cells, n_players), dtype=tti.dtype)
+    steps = np.zeros(n_cells, dtype=int)
+    converged = np.zeros(n_cells, dtype=bool)
+
+    # State of the cells that are still running, compacted as they finish
+    cells = np.arange(n_cells)
+    rates = np.where(candidates, lambdas, 0.)
+    cell_tti = np.where(candidates, tti, 0.)
+    T = np.asarray(ball_travel_time, dtype=tti.dtype)
+    end = T + params['max_int_time']
+    dt = np.full(n_cells, params['int_dt'], dtype=tti.dtype)
+    remaining = np.ones(n_cells, dtype=tti.dtype)
+    cell_PPCF = np.zeros((n_cells, n_players), dtype=tti.dtype)
+
+    def control_rate(T):
+        return rates * logistic(constant_values * (T[:, None] - cell_tti))
+
+    a_start = control_rate(T)
+    while cells.size:
+        dt = np.minimum(dt, end - T)
+        a_half = control_rate(T + dt / 2)
+        a_end = control_rate(T + dt)
+        r2, r3, r4, r_end = runge_kutta_remaining(remaining, dt, a_start.sum(axis=1),
+                                                  a_half.sum(axis=1), a_end.sum(axis=1))
+        error = dt / 6 * np.abs(r4 - r_end) * a_end.max(axis=1)
+        steps[cells] += 1
+
+        accepted = (error <= int_tol) & (r_end > 0)
+        done = accepted & (r_end <= tol)
+        # Weights of a_start, a_half and a_end in the step, zero if it is rejected
+        w_start = np.where(accepted, dt / 6 * remaining, 0.)
+        w_half = np.where(accepted, dt / 3 * (r2 + r3), 0.)
+        w_end = np.where(accepted, dt / 6 * r4, 0.)
+        if done.any():
+            w_start[done], w_half[done], w_end[done] = last_step_weights(
+                dt[done], remaining[done], r_end[done], w_start[done], w_half[done],
+                w_end[done], tol)
+        cell_PPCF += w_start[:, None] * a_start + w_half[:, None] * a_half + w_end[:, None] * a_end
+
+        T = np.where(accepted, T + dt, T)
+        remaining = np.where(accepted, r_end, remaining)
+        a_start = np.where(accepted[:, None], a_end, a_start)
+        dt = dt * next_step_factor(error, r_end, int_tol)
+
+        finished = done | (T >= end)
+        if finished.any():
+            PPCF[cells[finished]] = cell_PPCF[finished]
+            converged[cells[done]] = True
+            running = ~finished
+            cells, T, end, dt, remaining = (cells[running], T[running], end[running],
+                                            dt[running], remaining[running])
+            cell_PPCF, a_start = cell_PPCF[running], a_start[running]
+            rates, cell_tti = rates[running], cell_tti[running]
+
+    return PPCF, steps, converged
+
+
+def runge_kutta_remaining(remaining, dt, sum_start, sum_half, sum_end):
+    """
+    Remaining probability 1 - sum(PPCF) at the stages of a step of integrate_adaptive, from the
+    one at the start of the step and the sums of a_j at T, T + dt/2 and T + dt
+
+    Returns
+    -----------
+    r2, r3, r4: remaining probability of the second, third and fourth stages
+    r_end: remaining probability at the end of the step
+    """
+    r2 = remaining - dt / 2 * remaining * sum_start
+    r3 = remaining - dt / 2 * r2 * sum_half
+    r4 = remaining - dt * r3 * sum_half
+    r_end = remaining - dt / 6 * (remaining * sum_start + 2 * (r2 + r3) * sum_half +
+                                  r4 * sum_end)
+    return r2, r3, r4, r_end
+
+
+def last_step_weights(dt, remaining, r_end, w_start, w_half, w_end, tol):
+    """Weights of a_j at T, T + dt/2 and T + dt of a step where the remaining probability goes
+    from remaining to r_end below tol, cut at the fraction of the step where it reaches tol with
+    the cubic Hermite interpolation of the step"""
+    # The remaining probability decays about exponentially within the step
+    theta = np.log(remaining / tol) / np.log(remaining / r_end)
+    theta2, theta3 = theta ** 2, theta ** 3
+    scale = 3 * theta2 - 2 * theta3
+    return (scale * w_start + (theta3 - 2 * theta2 + theta) * dt * remaining,
+            scale * w_half,
+            scale * w_end + (theta3 - theta2) * dt * r_end)
+
+
+def next_step_factor(error, r_end, int_tol):
+    """Factor of the next time step of integrate_adaptive from the error of the step, shorter
+    if the step left no remaining probability"""
+    with np.errstate(divide='ignore'):
+        return np.where(r_end > 0, np.clip(0.9 * np.divide(int_tol, error) ** 0.25, 0.2, 5.),
+                        0.2)
+
+
+# Integrators of the contested cells by name, see params['integrator']
+INTEGRATORS = {'fixed': integrate_fixed_step, 'adaptive': integrate_adaptive}
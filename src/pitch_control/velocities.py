@@ -1,12 +1,12 @@
 import re
+from functools import partial
 import numpy as np
 import pandas as pd
-import scipy.signal as signal
 import src.data.utils as utils
 
 
 def calculate_player_velocities(team, smoothing=True, filter_='moving-average', window=7,
-                                polyorder=1, maxspeed=12):
+                                polyorder=1, maxspeed=12, dtype=float):
     """
     Calculate player velocities in x & y direciton, and total player speed at each timestamp of the
     tracking data
@@ -22,6 +22,8 @@ def calculate_player_velocities(team, smoothing=True, filter_='moving-average',
     to the velcoity, so gradient is the acceleration
     maxspeed: the maximum speed that a player can realisitically achieve (in meters/second). Speed
     measures that exceed maxspeed are tagged as outliers and set to NaN.
+    dtype: type of the velocity columns, e.g. np.float32 to halve their memory. They are always
+    computed in float64
 
     Returns
     -------
@@ -48,6 +50,8 @@ def calculate_player_velocities(team, smoothing=True, filter_='moving-average',
 
         if smoothing:
             if filter_ == 'Savitzky-Golay':
+                # scipy is slow to import and only needed for this filter
+                import scipy.signal as signal
                 vx = signal.savgol_filter(vx, window_length=window, polyorder=polyorder)
                 vy = signal.savgol_filter(vy, window_length=window, polyorder=polyorder)
             elif filter_ == 'moving average':
@@ -55,9 +59,9 @@ def calculate_player_velocities(team, smoothing=True, filter_='moving-average',
                 vx = np.convolve(vx, ma_window, mode='same')
                 vy = np.convolve(vy, ma_window, mode='same')
 
-        data[f'{player}_vx'] = pd.Series(vx, dtype=float)
-        data[f'{player}_vy'] = pd.Series(vy, dtype=float)
-        data[f'{player}_total_v'] = pd.Series(np.sqrt(vx ** 2 + vy ** 2), dtype=float)
+        data[f'{player}_vx'] = pd.Series(vx, dtype=dtype)
+        data[f'{player}_vy'] = pd.Series(vy, dtype=dtype)
+        data[f'{player}_total_v'] = pd.Series(np.sqrt(vx ** 2 + vy ** 2), dtype=dtype)
         max_value = data[f'{player}_vx'].max()
         #print(f'max v : {max_value}')
 
@@ -102,7 +106,8 @@ def calculate_player_vmax(tracking_df, home_player_positions, away_player_positi
                           include_player_velocities = False,
                           percentile=95, GK_percentile=99,
                           stamine_home = 1.0,
-                          stamine_away = 1.0):
+                          stamine_away = 1.0,
+                          percentile_function=None, goalkeepers=None):
     """
     Obtains the percentile velocity of each player for both teams
 
@@ -111,6 +116,11 @@ def calculate_player_vmax(tracking_df, home_player_positions, away_player_positi
     tracking_df: tracking dataframe with velocities already calculated
     percentile: percentile to use for normal players (from 0 to 100)
     GK_percentile: percentile to use for the goalkeepers
+    percentile_function: optional function(team, jersey, percentile) returning the percentile of
+    the velocity of a player, used instead of the velocity columns of tracking_df when they are
+    not in memory (e.g. estimated while streaming the match). tracking_df is still used to find
+    the goalkeepers, so it only needs the first frame
+    goalkeepers: optional dictionary team -> jersey of the goalkeeper (see utils.find_goalkeeper)
 
     Returns
     -------
@@ -123,19 +133,23 @@ def calculate_player_vmax(tracking_df, home_player_positions, away_player_positi
         #Go through the players
         for player in player_ids:
             #Compute the percentiles
-            team_velocity = data[f'{team}_{player}_total_v'].dropna()
+            if percentile_function is None:
+                team_velocity = data[f'{team}_{player}_total_v'].dropna()
+                player_percentile = partial(np.percentile, team_velocity)
+            else:
+                player_percentile = partial(percentile_function, team, player)
 
             #Apply the stamine factor only to the positions
             if stamine_dict[team]:
-                team_percentile = np.percentile(team_velocity, percentile) * stamine_dict[team] \
+                team_percentile = player_percentile(percentile) * stamine_dict[team] \
                     if position_dict[team].loc[player]['position'] in positions_to_increase else \
-                        np.percentile(team_velocity, percentile)
+                        player_percentile(percentile)
             else:
-                team_percentile = np.percentile(team_velocity, percentile)
+                team_percentile = player_percentile(percentile)
 
             #GK more percentile
             if player == GK_ids[team]:
-                team_percentile = np.percentile(team_velocity, GK_percentile)
+                team_percentile = player_percentile(GK_percentile)
             team_data.append(team_percentile)
         return team_data
     
@@ -165,7 +179,7 @@ def calculate_player_vmax(tracking_df, home_player_positions, away_player_positi
     home_player_ids = home_player_positions.index
     away_player_ids = away_player_positions.index
     # Obtain the ids of the goalkeepers
-    GK_ids,_ = utils.find_goalkeeper(tracking_df)
+    GK_ids,_ = utils.find_goalkeeper(tracking_df, goalkeepers)
 
 
     # Create dataframes for both teams
@@ -0,0 +1,191 @@
+"""
+Zone maps of the pitch. A zone map splits the cells of the grid in named zones (thirds, channels,
+the boxes or any polygons) and is computed once into a raster with the zone of each cell, so
+that the contributions of all the players in a frame go to their zones with a single weighted
+bincount, whatever the number of zones (see accumulate).
+
+The zones are defined for a team that defends the left goal and attacks towards +x, in metres
+from the centre of the pitch, with the left of the attacking direction at +y. For a team that
+defends the right goal the raster is rotated 180 degrees, so that e.g. the left wing is always
+on the left of the attacking direction, unless the map gives its own raster for that half.
+"""
+import json
+from pathlib import Path
+
+import numpy as np
+
+# Size (m) of the penalty and goal areas
+PENALTY_AREA_LENGTH = 16.5
+PENALTY_AREA_WIDTH = 40.32
+GOAL_AREA_WIDTH = 18.32
+
+# Phases in which the contributions are split, see Team.possession
+PHASES = ('attacking', 'defending')
+
+
+class ZoneMapError(Exception):
+    pass
+
+
+class ZoneMap:
+    """
+    Zones of the cells of the grid
+
+    __init__ Parameters
+    -----------
+    name: name of the map, e.g. 'thirds'
+    zones: names of the zones
+    labels: (n_grid_cells_y, n_grid_cells_x) raster with the index in zones of the zone of each
+        cell, -1 for the cells outside every zone, for a team that defends the left goal
+    right_labels: optional raster for a team that defends the right goal, labels rotated 180
+        degrees by default
+
+    methods include:
+    -----------
+    columns(): names of the contribution columns of the zones, e.g. 'PPCF_attacking_first_zone'
+    cell_labels(team_half): zone of each cell, row by row, for a team defending the goal on
+        team_half ('left' or 'right'), with len(zones) for the cells outside every zone
+    """
+
+    def __init__(self, name, zones, labels, right_labels=None):
+        self.name = name
+        self.zones = list(zones)
+        self.labels = np.asarray(labels, dtype=np.intp)
+        right_labels = self.labels[::-1, ::-1] if right_labels is None else \
+            np.asarray(right_labels, dtype=np.intp)
+        self.labels_by_half = {'left': self.no_zone_labels(self.labels),
+                               'right': self.no_zone_labels(right_labels)}
+
+    def no_zone_labels(self, labels):
+        """Flat labels with len(zones) for the cells outside every zone"""
+        if labels.shape != self.labels.shape or labels.max(initial=-1) >= len(self.zones) or \
+                labels.min(initial=-1) < -1:
+            raise ZoneMapError(f'The labels of the zone map {self.name} do not match its zones')
+        return np.where(labels < 0, len(self.zones), labels).ravel()
+
+    def __len__(self):
+        return len(self.zones)
+
+    def columns(self):
+        return [f'PPCF_{phase}_{zone}' for phase in PHASES for zone in self.zones]
+
+    def cell_labels(self, team_half):
+        labels = self.labels_by_half.get(team_half)
+        if labels is None:
+            # The half of the team is unknown, its contributions do not go to any zone
+            labels = np.full(self.labels.size, len(self.zones), dtype=np.intp)
+        return labels
+
+
+def thirds(xgrid, ygrid, field_dimen):
+    """First, second and third of the columns of the grid from the goal of the team. The columns
+    are split from the left and only the names of the first and third zones are swapped for a team
+    that defends the right goal, so the thirds are the same for both teams even when the number
+    of columns is not a multiple of 3"""
+    columns = np.arange(len(xgrid))
+    column_labels = (columns >= len(xgrid) / 3.).astype(int) + (columns >= len(xgrid) / 3. * 2)
+    labels = np.tile(column_labels, (len(ygrid), 1))
+    return ['first_zone', 'second_zone', 'third_zone'], labels, 2 - labels
+
+
+def channels(xgrid, ygrid, field_dimen):
+    """Vertical channels along the pitch: the wings outside the width of the penalty areas, the
+    half-spaces between the penalty and the goal areas and the centre in the width of the goal
+    areas"""
+    y = np.abs(ygrid)
+    lane = np.where(y <= GOAL_AREA_WIDTH / 2, 0, np.where(y <= PENALTY_AREA_WIDTH / 2, 1, 2))
+    # 0: left wing ... 4: right wing, the left being +y
+    lane = np.where(ygrid > 0, 2 - lane, 2 + lane)
+    zones = ['left_wing', 'left_half_space', 'centre', 'right_half_space', 'right_wing']
+    return zones, np.tile(lane[:, None], (1, len(xgrid))), None
+
+
+def boxes(xgrid, ygrid, field_dimen):
+    """The penalty areas of the team and of the opponent, the rest of the pitch has no zone"""
+    xx, yy = np.meshgrid(xgrid, ygrid)
+    in_width = np.abs(yy) <= PENALTY_AREA_WIDTH / 2
+    goal_line = field_dimen[0] / 2
+    labels = np.full(xx.shape, -1)
+    labels[in_width & (xx <= -goal_line + PENALTY_AREA_LENGTH)] = 0
+    labels[in_width & (xx >= goal_line - PENALTY_AREA_LENGTH)] = 1
+    return ['own_box', 'opponent_box'], labels, None
+
+
+def inside_polygon(x, y, vertices):
+    """Whether each point (x, y) is inside the polygon (even-odd rule)"""
+    inside = np.zeros(np.shape(x), dtype=bool)
+    vertices = np.asarray(vertices, dtype=float)
+    for (x1, y1), (x2, y2) in zip(vertices, np.roll(vertices, -1, axis=0)):
+        crosses = (y1 > y) != (y2 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (x < x_cross)
+    return inside
+
+
+def polygons(zones):
+    """
+    Zone map builder from polygons
+
+    zones: dictionary name -> list of (x, y) vertices in metres. A cell in several polygons goes
+        to the first one
+    """
+    def build(xgrid, ygrid, field_dimen):
+        xx, yy = np.meshgrid(xgrid, ygrid)
+        labels = np.full(xx.shape, -1)
+        for label, vertices in reversed(list(enumerate(zones.values()))):
+            labels[inside_polygon(xx, yy, vertices)] = label
+        return list(zones), labels, None
+    return build
+
+
+# Builders of the zone maps by name. A builder takes the centres of the cells and the size of the
+# field and returns the names of the zones, the raster and the raster of the right half (or None)
+ZONE_MAPS = {'thirds': thirds, 'channels': channels, 'boxes': boxes}
+
+
+def create_zone_map(spec, xgrid, ygrid, field_dimen):
+    """
+    Creates the zone map of a grid
+
+    Parameters
+    -----------
+    spec: name of a map in ZONE_MAPS or path of a JSON file with the polygons of the zones
+        ({"name": [[x, y], ...], ...}, see polygons)
+    xgrid, ygrid: centres of the cells
+    field_dimen: x and y size of the field in meters
+
+    Returns
+    -----------
+    ZoneMap
+    """
+    if spec in ZONE_MAPS:
+        name, builder = spec, ZONE_MAPS[spec]
+    else:
+        path = Path(spec)
+        if path.suffix != '.json' or not path.exists():
+            raise ZoneMapError(f'Unknown zone map {spec}, use one of {tuple(ZONE_MAPS)} or a '
+                               f'JSON file with polygons')
+        with open(path) as f:
+            name, builder = path.stem, polygons(json.load(f))
+    return ZoneMap(name, *builder(xgrid, ygrid, field_dimen))
+
+
+def accumulate(labels, contributions, n_bins):
+    """
+    Sums the contributions of each player in each zone with one weighted bincount
+
+    Parameters
+    -----------
+    labels: (n_cells, n_players) bin of each cell for each player
+    contributions: (n_cells, n_players) pitch control of each player in each cell
+    n_bins: number of bins (zones plus the one for the cells outside every zone)
+
+    Returns
+    -----------
+    (n_players, n_bins) array with the sum of the contributions of each player in each bin
+    """
+    n_players = contributions.shape[1]
+    index = labels + n_bins * np.arange(n_players)
+    return np.bincount(index.ravel(), weights=contributions.ravel(),
+                       minlength=n_bins * n_players).reshape(n_players, n_bins)
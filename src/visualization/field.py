@@ -7,7 +7,6 @@ Created on Tue Aug  8 19:33:10 2023
 import re
 import matplotlib.pyplot as plt
 import numpy as np
-import matplotlib.animation as animation
 
 
 def plot_pitch(field_dimen=(106.0, 68.0), field_color='green', linewidth=2, markersize=20):
@@ -256,6 +255,8 @@ def save_match_clip(tracking_df, PPCF, fpath, fname='clip_test', figax=None, fra
     # check that indices match first
     # assert np.all( hometeam.index==awayteam.index ), "Home and away team Dataframe indices must be the same"
     # in which case use home team index
+    import matplotlib.animation as animation
+
     index = tracking_df.index
     # Set figure and movie settings
     FFMpegWriter = animation.writers['ffmpeg']
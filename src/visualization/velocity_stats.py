@@ -1,11 +1,11 @@
-import seaborn as sns
 import matplotlib.pyplot as plt
 from matplotlib import cm
-import joypy
 
 
 def compare_velocity_teams(df, opacity=0.6):
     """Velocity density plot of each team"""
+    import seaborn as sns
+
     # Create a figure and axis object
     fig, ax = plt.subplots()
 
@@ -26,6 +26,8 @@ def compare_velocity_teams(df, opacity=0.6):
 
 def joyplot_team(df, team='home', max_velocity=6):
     """Velocity joyploy of each team"""
+    import joypy
+
     df = df[(df['team'] == team) & (df['velocity'] < max_velocity)]
 
     fig, ax = joypy.joyplot(df, by='jersey', column='velocity', colormap=cm.summer,